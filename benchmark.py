@@ -0,0 +1,1084 @@
+# benchmark.py (オフライン性能計測用スクリプト: 本番環境には不要)
+# Firestore / Secret Manager / Gemini をインメモリのスタブに差し替えて main.py を読み込み、計測する。
+# 使い方:
+#   python benchmark.py ttfb --chunks 20 --chunk-delay 0.05
+#   python benchmark.py coldstart --runs 5 --firestore-init 0.3 --secret 0.2
+#   python benchmark.py load --requests 500 --concurrency 16 --post-ratio 0.3 --firestore-rpc 0.01
+#   python benchmark.py load --store buckets --history 100 --no-history-cache
+#   python benchmark.py async --requests 400 --concurrency 64
+#   python benchmark.py burst --requests 20
+#   python benchmark.py resilience --calls 400 --error-rate 0.05 --hang-rate 0.05   (期待値を満たさなければ終了コード 1)
+#   python benchmark.py payload --messages 20 50
+#   python benchmark.py routing --requests 40 --slow-first-token 0.3
+#   python benchmark.py recall --history 600
+import argparse
+import asyncio
+import contextvars
+import itertools
+import json
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import types
+import uuid
+from datetime import datetime, timezone
+
+
+# --- Stub latency & operation counters ---
+LATENCY = {
+    'firestore_init': 0.0, # firestore.Client() の生成
+    'firestore_rpc': 0.0,  # get / stream / commit 1回あたり
+    'secret': 0.0,         # Secret Manager access_secret_version
+    'gemini_init': 0.0,    # genai.configure
+    'first_token': 0.0,    # 最初のチャンクまで
+    'chunk': 0.0,          # 以降のチャンクごと
+}
+COUNTERS = {'firestore_reads': 0, 'firestore_writes': 0, 'model_calls': 0}
+_counter_lock = threading.Lock()
+_request_counters = contextvars.ContextVar('request_counters', default=None) # リクエスト単位の集計 (スレッド / asyncio タスクごと)
+
+def _count(name: str, n: int = 1):
+    with _counter_lock:
+        COUNTERS[name] += n
+    per_request = _request_counters.get()
+    if per_request is not None: per_request[name] = per_request.get(name, 0) + n
+
+def _sleep(name: str):
+    if LATENCY[name] > 0: time.sleep(LATENCY[name])
+
+async def _async_sleep(name: str):
+    if LATENCY[name] > 0: await asyncio.sleep(LATENCY[name])
+
+
+# --- In-memory Firestore stand-in ---
+SERVER_TIMESTAMP = object()
+_store_lock = threading.RLock()
+_write_clock = itertools.count()
+
+class Increment:
+    def __init__(self, value):
+        self.value = value
+
+class ArrayUnion:
+    def __init__(self, values):
+        self.values = list(values)
+
+class FieldFilter:
+    def __init__(self, field_path, op_string, value):
+        self.field_path, self.op_string, self.value = field_path, op_string, value
+
+def _apply_write(existing, data: dict, merge: bool) -> dict:
+    out = dict(existing or {}) if merge else {}
+    now = datetime.now(timezone.utc)
+    for key, value in data.items():
+        if value is SERVER_TIMESTAMP: out[key] = now
+        elif isinstance(value, Increment): out[key] = (out.get(key) or 0) + value.value
+        elif isinstance(value, ArrayUnion): out[key] = list(out.get(key) or []) + [v for v in value.values if v not in (out.get(key) or [])]
+        else: out[key] = value
+    return out
+
+class DocumentSnapshot:
+    def __init__(self, reference, data):
+        self.reference, self.id, self._data = reference, reference.id, data
+        self.exists = data is not None
+    def to_dict(self):
+        return dict(self._data) if self._data is not None else None
+    def get(self, field):
+        return (self._data or {}).get(field)
+
+class DocumentReference:
+    def __init__(self, client, path: tuple):
+        self._client, self._path, self.id = client, path, path[-1]
+    @property
+    def path(self): return "/".join(self._path)
+    def collection(self, name): return CollectionReference(self._client, self._path + (name,))
+    def get(self, transaction=None, **kwargs):
+        if transaction is None: _sleep('firestore_rpc')
+        return self._read()
+    def _read(self):
+        _count('firestore_reads')
+        with _store_lock:
+            data = self._client._docs.get(self._path)
+            return DocumentSnapshot(self, dict(data) if data is not None else None)
+    def _write(self, data, merge):
+        with _store_lock:
+            self._client._docs[self._path] = _apply_write(self._client._docs.get(self._path), data, merge)
+            self._client._order[self._path] = next(_write_clock)
+        _count('firestore_writes')
+    def _update(self, data):
+        with _store_lock:
+            if self._path not in self._client._docs: raise LookupError(f"No document to update: {self.path}")
+            self._write(data, True)
+    def set(self, data, merge=False):
+        _sleep('firestore_rpc'); self._write(data, merge)
+    def update(self, data):
+        _sleep('firestore_rpc'); self._update(data)
+
+class Query:
+    ASCENDING = 'ASCENDING'
+    DESCENDING = 'DESCENDING'
+    _OPS = {'>': lambda a, b: a > b, '>=': lambda a, b: a >= b, '<': lambda a, b: a < b, '<=': lambda a, b: a <= b, '==': lambda a, b: a == b}
+
+    def __init__(self, collection, orders=(), limit=None, filters=(), start_after=None):
+        self._collection, self._orders, self._limit, self._filters, self._start_after = collection, orders, limit, filters, start_after
+    def _copy(self, **changes):
+        fields = dict(orders=self._orders, limit=self._limit, filters=self._filters, start_after=self._start_after)
+        fields.update(changes)
+        return Query(self._collection, **fields)
+    def order_by(self, field, direction=ASCENDING): return self._copy(orders=self._orders + ((field, direction),))
+    def limit(self, count): return self._copy(limit=count)
+    def where(self, field_path=None, op_string=None, value=None, *, filter=None):
+        if filter is not None: field_path, op_string, value = filter.field_path, filter.op_string, filter.value
+        return self._copy(filters=self._filters + ((field_path, op_string, value),))
+    def start_after(self, snapshot_or_values): return self._copy(start_after=snapshot_or_values)
+    def stream(self, transaction=None):
+        if transaction is None: _sleep('firestore_rpc')
+        return iter(self._run())
+    def _run(self) -> list:
+        client, parent = self._collection._client, self._collection._path
+        with _store_lock:
+            items = [(path, dict(data)) for path, data in client._docs.items() if len(path) == len(parent) + 1 and path[:-1] == parent]
+            orders = {path: client._order.get(path, 0) for path, _ in items}
+        for field, op, value in self._filters:
+            items = [(p, d) for p, d in items if d.get(field) is not None and self._OPS[op](d.get(field), value)]
+        for field, direction in reversed(self._orders):
+            items.sort(key=lambda item: (item[1].get(field), orders[item[0]]), reverse=(direction == self.DESCENDING))
+        if self._start_after is not None:
+            after_path = self._start_after.reference._path
+            index = next((i for i, (p, _) in enumerate(items) if p == after_path), None)
+            if index is not None: items = items[index + 1:]
+        if self._limit is not None: items = items[:self._limit]
+        _count('firestore_reads', max(1, len(items))) # 0件でも1読み取り課金
+        return [DocumentSnapshot(self._collection.document(path[-1]), data) for path, data in items]
+
+class CollectionReference(Query):
+    def __init__(self, client, path: tuple):
+        self._client, self._path = client, path
+        super().__init__(self)
+    @property
+    def id(self): return self._path[-1]
+    def document(self, document_id=None):
+        return DocumentReference(self._client, self._path + (document_id or uuid.uuid4().hex[:20],))
+
+class WriteBatch:
+    def __init__(self, client):
+        self._client, self._ops = client, []
+    def set(self, reference, data, merge=False): self._ops.append(lambda: reference._write(data, merge))
+    def update(self, reference, data): self._ops.append(lambda: reference._update(data))
+    def commit(self):
+        _sleep('firestore_rpc')
+        return self._apply()
+    def _apply(self):
+        with _store_lock:
+            for op in self._ops: op()
+        return [types.SimpleNamespace(update_time=datetime.now(timezone.utc))]
+
+class Transaction(WriteBatch):
+    pass
+
+def transactional(to_wrap):
+    """Runs the wrapped callable while holding the store lock, then commits (serializable)."""
+    def wrapper(transaction, *args, **kwargs):
+        _sleep('firestore_rpc')
+        with _store_lock:
+            result = to_wrap(transaction, *args, **kwargs)
+            for op in transaction._ops: op()
+            return result
+    return wrapper
+
+_DOCS, _ORDER = {}, {} # 全クライアントで共有 (import 前にデータを投入できるように)
+
+class Client:
+    def __init__(self, database=None, **kwargs):
+        _sleep('firestore_init')
+        self._docs, self._order = _DOCS, _ORDER
+    def collection(self, name): return CollectionReference(self, (name,))
+    def batch(self): return WriteBatch(self)
+    def transaction(self, **kwargs): return Transaction(self)
+
+
+# --- Async Firestore stand-in (同じストアを asyncio.sleep で待つ) ---
+class AsyncDocumentReference(DocumentReference):
+    def collection(self, name): return AsyncCollectionReference(self._client, self._path + (name,))
+    async def get(self, transaction=None, **kwargs):
+        if transaction is None: await _async_sleep('firestore_rpc')
+        return self._read()
+    async def set(self, data, merge=False):
+        await _async_sleep('firestore_rpc'); self._write(data, merge)
+    async def update(self, data):
+        await _async_sleep('firestore_rpc'); self._update(data)
+
+class AsyncQuery(Query):
+    def _copy(self, **changes):
+        fields = dict(orders=self._orders, limit=self._limit, filters=self._filters, start_after=self._start_after)
+        fields.update(changes)
+        return AsyncQuery(self._collection, **fields)
+    async def stream(self, transaction=None):
+        if transaction is None: await _async_sleep('firestore_rpc')
+        for snapshot in self._run():
+            yield snapshot
+
+class AsyncCollectionReference(AsyncQuery, CollectionReference):
+    def document(self, document_id=None):
+        return AsyncDocumentReference(self._client, self._path + (document_id or uuid.uuid4().hex[:20],))
+
+class AsyncWriteBatch(WriteBatch):
+    async def commit(self):
+        await _async_sleep('firestore_rpc')
+        return self._apply()
+
+class AsyncTransaction(WriteBatch):
+    pass
+
+_async_transaction_lock = None # イベントループ内で生成 (トランザクションを直列化)
+
+def async_transactional(to_wrap):
+    async def wrapper(transaction, *args, **kwargs):
+        global _async_transaction_lock
+        if _async_transaction_lock is None: _async_transaction_lock = asyncio.Lock()
+        await _async_sleep('firestore_rpc')
+        async with _async_transaction_lock:
+            result = await to_wrap(transaction, *args, **kwargs)
+            with _store_lock:
+                for op in transaction._ops: op()
+            return result
+    return wrapper
+
+class AsyncClient(Client):
+    def collection(self, name): return AsyncCollectionReference(self, (name,))
+    def batch(self): return AsyncWriteBatch(self)
+    def transaction(self, **kwargs): return AsyncTransaction(self)
+
+
+# --- Secret Manager stand-in ---
+class SecretManagerServiceClient:
+    def access_secret_version(self, request):
+        _sleep('secret')
+        return types.SimpleNamespace(payload=types.SimpleNamespace(data=b"offline-benchmark-key"))
+
+
+# --- Gemini stand-in ---
+class FakeChunk:
+    def __init__(self, text: str):
+        self.text = text
+
+class FakeResponse:
+    """Iterable like genai's streaming response; sleeps before each chunk. Blocking calls consume it upfront."""
+    def __init__(self, chunks: list, prompt: str = ""):
+        self._chunks = chunks
+        self.prompt_feedback = None
+        self.usage_metadata = types.SimpleNamespace(prompt_token_count=len(prompt) // 2, candidates_token_count=sum(len(c) for c in chunks) // 2)
+    def __iter__(self):
+        for i, text in enumerate(self._chunks):
+            _sleep('first_token' if i == 0 else 'chunk')
+            yield FakeChunk(text)
+    @property
+    def text(self) -> str:
+        return "".join(self._chunks)
+    async def __aiter__(self):
+        for i, text in enumerate(self._chunks):
+            await _async_sleep('first_token' if i == 0 else 'chunk')
+            yield FakeChunk(text)
+
+REPLY_CHUNKS = 20
+# モデル名ごとの障害注入: {'gemini-2.0-flash': {'first_token': 0.3} or {'fail': True}} (未指定のモデルは LATENCY のまま)
+MODEL_FAULTS = {}
+MODEL_CALLS = {} # model_name -> 呼び出し回数
+
+def _fake_reply(prompt) -> list:
+    return [f"チャンク{i}。" for i in range(REPLY_CHUNKS)]
+
+def _model_call(model_name: str) -> float:
+    """Counts a call to model_name and returns its extra first-token delay; raises if the model is marked as failing."""
+    _count('model_calls')
+    with _counter_lock: MODEL_CALLS[model_name] = MODEL_CALLS.get(model_name, 0) + 1
+    fault = MODEL_FAULTS.get(model_name, {})
+    if fault.get('fail'):
+        from google.api_core import exceptions as google_exceptions
+        raise google_exceptions.ServiceUnavailable(f"injected failure ({model_name})")
+    return fault.get('first_token', 0.0)
+
+class FakeChatSession:
+    def __init__(self, history=None, model_name: str = 'fake'):
+        self.history, self.model_name = list(history or []), model_name
+    def send_message(self, message, stream: bool = False, **kwargs):
+        delay = _model_call(self.model_name)
+        if delay: time.sleep(delay)
+        response = FakeResponse(_fake_reply(message), str(message))
+        if not stream:
+            for _ in response: pass # 非ストリーミングは全チャンク生成まで待つ
+        return response
+    async def send_message_async(self, message, stream: bool = False, **kwargs):
+        delay = _model_call(self.model_name)
+        if delay: await asyncio.sleep(delay)
+        response = FakeResponse(_fake_reply(message), str(message))
+        if not stream:
+            async for _ in response: pass
+        return response
+
+class GenerativeModel:
+    def __init__(self, model_name, system_instruction=None, **kwargs):
+        self.model_name, self.system_instruction = model_name, system_instruction
+    @classmethod
+    def from_cached_content(cls, cached_content, **kwargs):
+        return cls(cached_content.model, cached_content.system_instruction)
+    def start_chat(self, history=None, **kwargs):
+        return FakeChatSession(history, self.model_name)
+    def generate_content(self, contents, stream: bool = False, **kwargs):
+        return FakeChatSession(model_name=self.model_name).send_message(contents, stream=stream)
+    async def generate_content_async(self, contents, stream: bool = False, **kwargs):
+        return await FakeChatSession(model_name=self.model_name).send_message_async(contents, stream=stream)
+
+class CachedContent:
+    def __init__(self, model, system_instruction):
+        self.model, self.system_instruction = model, system_instruction
+    @classmethod
+    def create(cls, model, system_instruction=None, ttl=None, **kwargs):
+        return cls(model, system_instruction)
+    def delete(self): pass
+
+def _configure(api_key=None, **kwargs):
+    _sleep('gemini_init')
+
+
+def seed_character(character_id: str, data: dict, history: list = (), bucket_size: int | None = None):
+    """Writes a character document (and optional [(role, message), ...] history) straight into the store.
+
+    With bucket_size, history is written in the bucketed layout (HISTORY_STORE=buckets) instead."""
+    with _store_lock:
+        _DOCS[('characters', character_id)] = dict(data)
+        base = datetime.now(timezone.utc).timestamp() - len(history)
+        for i, (role, message) in enumerate(history):
+            timestamp = datetime.fromtimestamp(base + i // 2, timezone.utc)
+            if bucket_size:
+                path = ('characters', character_id, 'historyBuckets', f"{i // bucket_size:08d}")
+                bucket = _DOCS.setdefault(path, {'seq': i // bucket_size, 'messages': []})
+                bucket['messages'].append({'index': i, 'timestamp': timestamp, 'role': role, 'message': message})
+                bucket['lastAt'] = timestamp
+            else:
+                path = ('characters', character_id, 'history', uuid.uuid4().hex[:20])
+                _DOCS[path] = {'timestamp': timestamp, 'role': role, 'message': message}
+            _ORDER[path] = next(_write_clock)
+
+
+def install_stubs():
+    """Registers the stand-ins as google.cloud.firestore / secretmanager / google.generativeai."""
+    for package in ('google', 'google.cloud'):
+        if package not in sys.modules:
+            try: __import__(package)
+            except ImportError: sys.modules[package] = types.ModuleType(package); sys.modules[package].__path__ = []
+
+    firestore = types.ModuleType('google.cloud.firestore')
+    for name in ('Client', 'DocumentReference', 'CollectionReference', 'Query', 'Increment', 'ArrayUnion', 'FieldFilter', 'SERVER_TIMESTAMP', 'transactional', 'Transaction', 'WriteBatch', 'DocumentSnapshot',
+                 'AsyncClient', 'async_transactional'):
+        setattr(firestore, name, globals()[name])
+    secretmanager = types.ModuleType('google.cloud.secretmanager')
+    secretmanager.SecretManagerServiceClient = SecretManagerServiceClient
+    genai = types.ModuleType('google.generativeai')
+    genai.configure, genai.GenerativeModel = _configure, GenerativeModel
+    genai.caching = types.SimpleNamespace(CachedContent=CachedContent)
+
+    for name, module in (('google.cloud.firestore', firestore), ('google.cloud.secretmanager', secretmanager), ('google.generativeai', genai)):
+        sys.modules[name] = module
+        parent, _, child = name.rpartition('.')
+        setattr(sys.modules[parent], child, module)
+
+
+def load_main():
+    """Imports main.py against the stubs (GOOGLE_CLOUD_PROJECT is faked for the Secret Manager path)."""
+    import os
+    os.environ.setdefault("GOOGLE_CLOUD_PROJECT", "offline-benchmark")
+    os.environ.setdefault("LOG_LEVEL", "WARNING") # リクエストごとのトレースログを抑止 (LOG_LEVEL=INFO で確認可)
+    install_stubs()
+    import main
+    return main
+
+
+# --- Benchmarks ---
+def bench_ttfb(args):
+    """Compares time-to-first-byte of the SSE path against the blocking path."""
+    global REPLY_CHUNKS
+    main = load_main()
+    if not main.ensure_initialized('firestore'): raise SystemExit("stub initialization failed")
+    REPLY_CHUNKS = args.chunks
+    LATENCY.update(first_token=args.first_chunk_delay, chunk=args.chunk_delay)
+    # 保存・要約は計測対象外
+    main.finalize_conversation_turn = lambda char_doc_ref, user_msg, ai_msg, reserved_turn_count: reserved_turn_count
+    seed_character('ttfb', {'name': 'ttfb', 'systemPrompt': 'テスト', 'turnCount': 2})
+    char_doc_ref = main.db.collection(main.CHARACTERS_COLLECTION).document('ttfb')
+    # ハンドラーと同じく chat_model_client 経由で送る (chat_sender と同じ send(**kwargs) の形)
+    send = lambda **kwargs: main.chat_model_client.call(lambda: FakeChatSession().send_message("こんにちは", **kwargs))
+
+    stream_ttfb, stream_total, blocking_total = [], [], []
+    for _ in range(args.runs):
+        start = time.perf_counter()
+        first = None
+        for frame in main.stream_chat_events(send, "こんにちは", char_doc_ref, 2):
+            if frame.startswith('event: error'): raise SystemExit(f"stream failed: {frame.strip()}")
+            if first is None: first = time.perf_counter() - start
+        stream_ttfb.append(first)
+        stream_total.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        FakeChatSession().send_message("こんにちは")
+        blocking_total.append(time.perf_counter() - start)
+
+    print(f"runs={args.runs} chunks={args.chunks} first_chunk_delay={args.first_chunk_delay}s chunk_delay={args.chunk_delay}s")
+    print(f"  stream   TTFB  median={statistics.median(stream_ttfb) * 1000:.1f}ms")
+    print(f"  stream   total median={statistics.median(stream_total) * 1000:.1f}ms")
+    print(f"  blocking TTFB  median={statistics.median(blocking_total) * 1000:.1f}ms (= total)")
+
+
+def _coldstart_child(args):
+    """Runs in a fresh interpreter: import main, then time the first OPTIONS / GET / POST."""
+    LATENCY.update(firestore_init=args.firestore_init, secret=args.secret, gemini_init=args.gemini_init)
+    seed_character('bench', {'name': 'ベンチ', 'systemPrompt': 'あなたはテスト用です。', 'turnCount': 0})
+    start = time.perf_counter()
+    main = load_main()
+    timings = {'import': time.perf_counter() - start}
+
+    import flask
+    app = flask.Flask('coldstart')
+    def first_response(method, **kwargs):
+        with app.test_request_context('/', method=method, **kwargs):
+            response = main.handle_chat(flask.request)
+            response.get_data()
+            return response.status_code, time.perf_counter() - start
+
+    _, timings['options'] = first_response('OPTIONS')
+    _, timings['get'] = first_response('GET', query_string={'id': 'bench'})
+    _, timings['post'] = first_response('POST', json={'id': 'bench', 'message': 'こんにちは'})
+    print(json.dumps(timings))
+
+def bench_coldstart(args):
+    """Measures import-to-first-response per request type, one fresh process per run."""
+    child_args = [sys.executable, __file__, 'coldstart', '--child',
+                  '--firestore-init', str(args.firestore_init), '--secret', str(args.secret), '--gemini-init', str(args.gemini_init)]
+    runs = []
+    for _ in range(args.runs):
+        output = subprocess.run(child_args, capture_output=True, text=True, check=True).stdout
+        runs.append(json.loads(output.strip().splitlines()[-1]))
+    print(f"runs={args.runs} firestore_init={args.firestore_init}s secret={args.secret}s gemini_init={args.gemini_init}s (import-to-first-response)")
+    for key in ('import', 'options', 'get', 'post'):
+        print(f"  {key:<8} median={statistics.median(run[key] for run in runs) * 1000:.1f}ms")
+
+
+def _percentile(sorted_values: list, p: float) -> float:
+    if not sorted_values: return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p))]
+
+def bench_load(args):
+    """Drives a GET/POST mix through handle_chat at a fixed concurrency and reports latency and backend ops."""
+    global REPLY_CHUNKS
+    import random
+    from concurrent.futures import ThreadPoolExecutor
+    import flask
+
+    import os
+    os.environ["HISTORY_STORE"] = args.store
+    main = load_main()
+    characters = _seed_bench_characters('bench', args.characters, args.history, main.HISTORY_BUCKET_SIZE if args.store == 'buckets' else None)
+    if not main.ensure_initialized('firestore', 'gemini'): raise SystemExit("stub initialization failed")
+    main.MAX_TOTAL_TURNS = 10 ** 9 # 上限チェックで 403 にならないように
+    main.rate_limiter.burst = 0 # 流量制限も無効 (同じキャラクターへの直列化は有効のまま)
+    if args.no_history_cache: main.history_cache.ttl_seconds = 0
+    REPLY_CHUNKS = args.chunks
+    LATENCY.update(firestore_rpc=args.firestore_rpc, first_token=args.first_token, chunk=args.chunk)
+    for name in COUNTERS: COUNTERS[name] = 0
+
+    app = flask.Flask('load')
+    rng = random.Random(args.seed)
+    plan = [('POST' if rng.random() < args.post_ratio else 'GET', rng.choice(characters)) for _ in range(args.requests)]
+
+    def run_one(item):
+        method, character_id = item
+        _request_counters.set({})
+        start = time.perf_counter()
+        if method == 'GET':
+            context = app.test_request_context('/', method='GET', query_string={'id': character_id})
+        else:
+            context = app.test_request_context('/', method='POST', json={'id': character_id, 'message': 'こんにちは', 'stream': args.stream})
+        with context:
+            response = main.handle_chat(flask.request)
+            for _ in response.response: pass # ストリーミング応答も最後まで読む
+            response.close() # WSGI サーバーと同様に close (call_on_close でターン枠を解放)
+        elapsed = time.perf_counter() - start
+        counters = _request_counters.get(); _request_counters.set(None)
+        return method, response.status_code, elapsed, counters
+
+    wall_start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        results = list(pool.map(run_one, plan))
+    wall = time.perf_counter() - wall_start
+    foreground = dict(COUNTERS)
+    main.summary_job_queue.drain(timeout=60)
+
+    print(f"requests={args.requests} concurrency={args.concurrency} post_ratio={args.post_ratio} characters={args.characters} "
+          f"firestore_rpc={args.firestore_rpc}s first_token={args.first_token}s chunk={args.chunk}s stream={args.stream} store={args.store}")
+    print(f"  throughput={len(results) / wall:.1f} req/s  wall={wall:.2f}s")
+    for method in ('GET', 'POST'):
+        rows = [r for r in results if r[0] == method]
+        if not rows: continue
+        latencies = sorted(r[2] * 1000 for r in rows)
+        statuses = {}
+        for r in rows: statuses[r[1]] = statuses.get(r[1], 0) + 1
+        per_request = {name: sum(r[3].get(name, 0) for r in rows) / len(rows) for name in COUNTERS}
+        print(f"  {method:<4} n={len(rows)} p50={_percentile(latencies, 0.5):.1f}ms p95={_percentile(latencies, 0.95):.1f}ms p99={_percentile(latencies, 0.99):.1f}ms status={statuses}")
+        print(f"       per request: reads={per_request['firestore_reads']:.2f} writes={per_request['firestore_writes']:.2f} model_calls={per_request['model_calls']:.2f}")
+    background = {name: COUNTERS[name] - foreground[name] for name in COUNTERS}
+    print(f"  background (summaries): {background}  queue={main.summary_job_queue.metrics()}")
+    print(f"  caches: history={main.history_cache.stats()} model={main.model_cache.stats()}")
+
+
+def _seed_bench_characters(prefix: str, count: int, history_messages: int, bucket_size: int | None = None) -> list:
+    characters = [f"{prefix}-{i}" for i in range(count)]
+    for character_id in characters:
+        history = [('user' if i % 2 == 0 else 'model', f"過去のメッセージ{i}です。" * 5) for i in range(history_messages)]
+        seed_character(character_id, {'name': character_id, 'systemPrompt': 'あなたはテスト用のキャラクターです。', 'profileText': 'プロフィール', 'turnCount': len(history)}, history, bucket_size)
+    return characters
+
+async def _asgi_call(app, method: str, query: str = '', body: bytes = b'') -> int:
+    """Sends one request through an ASGI app and drains the response. Returns the status code."""
+    scope = {'type': 'http', 'method': method, 'path': '/', 'query_string': query.encode(), 'headers': [(b'content-type', b'application/json')]}
+    status = None
+    async def receive(): return {'type': 'http.request', 'body': body, 'more_body': False}
+    async def send(message):
+        nonlocal status
+        if message['type'] == 'http.response.start': status = message['status']
+    await app(scope, receive, send)
+    return status
+
+def bench_async(args):
+    """Requests/second per instance: sync handle_chat (one at a time, thread pool) vs asgi_app on one event loop."""
+    global REPLY_CHUNKS
+    import random
+    from concurrent.futures import ThreadPoolExecutor
+    import flask
+
+    modes = {'sync-serial': 1, 'sync-threads': args.concurrency, 'async': args.concurrency}
+    characters = {mode: _seed_bench_characters(mode, args.characters, args.history) for mode in modes}
+    main = load_main()
+    if not main.ensure_initialized('firestore', 'gemini'): raise SystemExit("stub initialization failed")
+    main.MAX_TOTAL_TURNS = 10 ** 9
+    main.rate_limiter.burst = 0
+    REPLY_CHUNKS = args.chunks
+    LATENCY.update(firestore_rpc=args.firestore_rpc, first_token=args.first_token, chunk=args.chunk)
+    app = flask.Flask('async-bench')
+    print(f"requests={args.requests} concurrency={args.concurrency} post_ratio={args.post_ratio} characters={args.characters} "
+          f"firestore_rpc={args.firestore_rpc}s first_token={args.first_token}s chunk={args.chunk}s stream={args.stream}")
+
+    post_body = lambda character_id: json.dumps({'id': character_id, 'message': 'こんにちは', 'stream': args.stream})
+    for mode, concurrency in modes.items():
+        rng = random.Random(args.seed)
+        plan = [('POST' if rng.random() < args.post_ratio else 'GET', rng.choice(characters[mode])) for _ in range(args.requests)]
+
+        def run_sync(item):
+            method, character_id = item
+            start = time.perf_counter()
+            if method == 'GET': context = app.test_request_context('/', method='GET', query_string={'id': character_id})
+            else: context = app.test_request_context('/', method='POST', data=post_body(character_id), content_type='application/json')
+            with context:
+                response = main.handle_chat(flask.request)
+                for _ in response.response: pass
+                response.close()
+            return method, response.status_code, time.perf_counter() - start
+
+        async def run_async(concurrency=concurrency, plan=plan):
+            semaphore = asyncio.Semaphore(concurrency)
+            async def run_one(item):
+                method, character_id = item
+                async with semaphore:
+                    start = time.perf_counter()
+                    if method == 'GET': status = await _asgi_call(main.asgi_app, 'GET', f"id={character_id}")
+                    else: status = await _asgi_call(main.asgi_app, 'POST', body=post_body(character_id).encode())
+                    return method, status, time.perf_counter() - start
+            return await asyncio.gather(*(run_one(item) for item in plan))
+
+        wall_start = time.perf_counter()
+        if mode == 'async':
+            results = asyncio.run(run_async())
+        else:
+            with ThreadPoolExecutor(max_workers=concurrency) as pool:
+                results = list(pool.map(run_sync, plan))
+        wall = time.perf_counter() - wall_start
+        main.summary_job_queue.drain(timeout=60)
+
+        statuses = {}
+        for r in results: statuses[r[1]] = statuses.get(r[1], 0) + 1
+        summary = []
+        for method in ('GET', 'POST'):
+            latencies = sorted(r[2] * 1000 for r in results if r[0] == method)
+            if latencies: summary.append(f"{method} p50={_percentile(latencies, 0.5):.1f}ms p99={_percentile(latencies, 0.99):.1f}ms")
+        print(f"  {mode:<12} in-flight={concurrency:<4} throughput={len(results) / wall:7.1f} req/s  {'  '.join(summary)}  status={statuses}")
+
+class _UnlimitedSlot:
+    def release(self): pass
+
+def bench_burst(args):
+    """Fires a burst of concurrent POSTs at one character with and without the admission layer."""
+    global REPLY_CHUNKS
+    from concurrent.futures import ThreadPoolExecutor
+    import flask
+
+    main = load_main()
+    if not main.ensure_initialized('firestore', 'gemini'): raise SystemExit("stub initialization failed")
+    main.MAX_TOTAL_TURNS = 10 ** 9
+    REPLY_CHUNKS = args.chunks
+    LATENCY.update(firestore_rpc=args.firestore_rpc, first_token=args.first_token, chunk=args.chunk)
+    app = flask.Flask('burst')
+    admit_turn = main.admit_turn
+    print(f"requests={args.requests} (all at once, one character) firestore_rpc={args.firestore_rpc}s first_token={args.first_token}s "
+          f"burst={main.RATE_LIMIT_BURST} per_minute={main.RATE_LIMIT_PER_MINUTE} waiters={main.TURN_QUEUE_MAX_WAITERS}")
+
+    for mode in ('no-admission', 'admission'):
+        character_id = f"burst-{mode}"
+        seed_character(character_id, {'name': character_id, 'systemPrompt': 'テスト', 'profileText': 'p', 'turnCount': 0})
+        main.admit_turn = admit_turn if mode == 'admission' else (lambda _character_id: _UnlimitedSlot())
+        for name in COUNTERS: COUNTERS[name] = 0
+        barrier = threading.Barrier(args.requests)
+
+        def run_one(_, character_id=character_id, barrier=barrier):
+            body = json.dumps({'id': character_id, 'message': 'こんにちは', 'stream': args.stream})
+            with app.test_request_context('/', method='POST', data=body, content_type='application/json'):
+                barrier.wait()
+                start = time.perf_counter()
+                response = main.handle_chat(flask.request)
+                for _ in response.response: pass
+                response.close()
+                return response.status_code, response.headers.get('Retry-After'), time.perf_counter() - start
+
+        with ThreadPoolExecutor(max_workers=args.requests) as pool:
+            results = list(pool.map(run_one, range(args.requests)))
+        main.summary_job_queue.drain(timeout=60)
+        statuses = {}
+        for r in results: statuses[r[0]] = statuses.get(r[0], 0) + 1
+        retry_after = sorted({r[1] for r in results if r[1]})
+        stored = main.db.collection(main.CHARACTERS_COLLECTION).document(character_id).get().to_dict()
+        saved = len(main.conversation_store.load_recent(character_id, 10 ** 6))
+        print(f"  {mode:<13} status={statuses} retry_after={retry_after} model_calls={COUNTERS['model_calls']} "
+              f"writes={COUNTERS['firestore_writes']} turnCount={stored.get('turnCount')} saved_messages={saved}")
+    main.admit_turn = admit_turn
+    print(f"  limiter={main.rate_limiter.stats()} gate={main.turn_gate.stats()}")
+
+def bench_resilience(args):
+    """Tail latency of model calls against an injected-fault fake: direct call vs timeout+retry vs +hedging, then an outage."""
+    import random
+    from concurrent.futures import ThreadPoolExecutor
+    from google.api_core import exceptions as google_exceptions
+
+    main = load_main()
+    rng = random.Random(args.seed)
+    rng_lock = threading.Lock()
+
+    def fake_call(transport_timeout: float | None, outage: bool = False):
+        """One provider call: lognormal latency, some 503s, some hangs (cut at the SDK transport timeout when set)."""
+        with rng_lock:
+            roll, latency = rng.random(), rng.lognormvariate(0, 0.3) * args.latency
+        if outage or roll < args.error_rate:
+            time.sleep(args.latency / 4)
+            raise google_exceptions.ServiceUnavailable("injected failure")
+        if roll < args.error_rate + args.hang_rate:
+            if transport_timeout is None: time.sleep(args.hang_seconds); return 'late'
+            time.sleep(min(args.hang_seconds, transport_timeout))
+            raise google_exceptions.DeadlineExceeded("injected hang")
+        time.sleep(latency)
+        return 'ok'
+
+    def make_client(hedge_after: float = 0):
+        breaker = main.CircuitBreaker(main.MODEL_BREAKER_WINDOW, main.MODEL_BREAKER_MIN_CALLS, main.MODEL_BREAKER_FAILURE_RATIO, args.breaker_cooldown)
+        return main.ResilientModelClient(breaker, args.timeout, args.deadline, args.attempts, args.base_delay, args.base_delay * 8, hedge_after)
+
+    def run(label: str, call):
+        def one(_):
+            start = time.perf_counter()
+            try: ok = call() == 'ok'
+            except Exception: ok = False
+            return ok, time.perf_counter() - start
+        wall_start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            results = list(pool.map(one, range(args.calls)))
+        wall = time.perf_counter() - wall_start
+        latencies = sorted(r[1] * 1000 for r in results)
+        failed = sum(1 for r in results if not r[0])
+        print(f"  {label:<22} ok={args.calls - failed:<4} failed={failed:<4} p50={_percentile(latencies, 0.5):7.1f}ms p95={_percentile(latencies, 0.95):7.1f}ms "
+              f"p99={_percentile(latencies, 0.99):7.1f}ms max={latencies[-1]:7.1f}ms wall={wall:.2f}s")
+        return latencies
+
+    print(f"calls={args.calls} concurrency={args.concurrency} latency~{args.latency}s error_rate={args.error_rate} hang_rate={args.hang_rate} hang={args.hang_seconds}s "
+          f"timeout={args.timeout}s deadline={args.deadline}s attempts={args.attempts} hedge_after={args.hedge_after}s")
+    run('direct (no protection)', lambda: fake_call(None))
+    client = make_client()
+    failures = []
+    # 保護ありの p99 は全体の期限 (deadline) 以内に収まること (スケジューリングの揺らぎ分だけ許容)
+    deadline_ms = args.deadline * 1000 + RESILIENCE_SLACK_SECONDS * 1000
+    p99 = _percentile(run('timeout + retry', lambda: client.call(lambda: fake_call(client.timeout))), 0.99)
+    if p99 > deadline_ms: failures.append(f"timeout + retry: p99 {p99:.1f}ms exceeds the {args.deadline}s deadline")
+    hedged = make_client(args.hedge_after)
+    p99 = _percentile(run('timeout + retry + hedge', lambda: hedged.call(lambda: fake_call(hedged.timeout))), 0.99)
+    if p99 > deadline_ms: failures.append(f"timeout + retry + hedge: p99 {p99:.1f}ms exceeds the {args.deadline}s deadline")
+
+    # 障害時: 遮断後はプロバイダを呼ばずに即失敗する
+    outage = make_client()
+    provider_calls = itertools.count()
+    def failing():
+        next(provider_calls)
+        return fake_call(outage.timeout, outage=True)
+    run('outage + breaker', lambda: outage.call(failing))
+    print(f"  outage: provider calls={next(provider_calls)} for {args.calls} requests  breaker={outage.breaker.stats()}")
+
+    failures += check_resilience(main)
+    if failures:
+        for failure in failures: print(f"  FAIL {failure}")
+        raise SystemExit(1)
+    print("  checks: all passed")
+
+RESILIENCE_SLACK_SECONDS = 0.1 # 期限の判定に許容するスレッド切り替え等の遅れ
+
+def check_resilience(main) -> list:
+    """Deterministic checks of ResilientModelClient / CircuitBreaker behaviour; returns the failed expectations."""
+    from google.api_core import exceptions as google_exceptions
+    failures = []
+    def expect(condition: bool, message: str):
+        if not condition: failures.append(message)
+    def counted(fn):
+        calls = []
+        def wrapper():
+            calls.append(1)
+            return fn()
+        return wrapper, calls
+    def hang(): time.sleep(2); return 'late'
+    def unavailable(): raise google_exceptions.ServiceUnavailable("injected")
+    def invalid(): raise google_exceptions.InvalidArgument("bad request")
+
+    # 1. ハングし続ける呼び出しでも deadline 以内に ModelCallError で返る
+    client = main.ResilientModelClient(main.CircuitBreaker(20, 10, 0.5, 30), 0.1, 0.35, 5, 0.01, 0.02)
+    start = time.perf_counter()
+    try: client.call(hang); error = None
+    except Exception as e: error = e
+    elapsed = time.perf_counter() - start
+    expect(isinstance(error, main.ModelCallError), f"hang: expected ModelCallError, got {error!r}")
+    expect(elapsed <= 0.35 + RESILIENCE_SLACK_SECONDS, f"hang: returned after {elapsed:.2f}s, beyond the 0.35s deadline")
+
+    # 2. 入力エラー (リトライ不可) は1回だけ呼び、そのまま返し、遮断の判定にも数えない
+    breaker = main.CircuitBreaker(20, 1, 0.5, 30)
+    client = main.ResilientModelClient(breaker, 1, 5, 3, 0.01, 0.02)
+    for label, invoke in (('sync', lambda fn: client.call(fn)), ('async', lambda fn: asyncio.run(client.call_async(_as_async(fn))))):
+        fn, calls = counted(invalid)
+        try: invoke(fn); error = None
+        except Exception as e: error = e
+        expect(isinstance(error, google_exceptions.InvalidArgument), f"non-retryable ({label}): expected InvalidArgument, got {error!r}")
+        expect(len(calls) == 1, f"non-retryable ({label}): called {len(calls)} times, expected 1")
+    expect(breaker.stats()['state'] == 'closed', f"non-retryable: breaker is {breaker.stats()['state']}, expected closed")
+
+    # 3. min_calls 回の失敗で開き、以降はプロバイダを呼ばずに即失敗する
+    min_calls, cooldown = 5, 0.2
+    breaker = main.CircuitBreaker(20, min_calls, 0.5, cooldown)
+    client = main.ResilientModelClient(breaker, 1, 5, 1, 0.01, 0.02)
+    fn, calls = counted(unavailable)
+    for i in range(min_calls):
+        try: client.call(fn)
+        except main.ModelUnavailableError: pass
+        if i < min_calls - 1: expect(breaker.stats()['state'] == 'closed', f"breaker: opened after {i + 1} calls, before min_calls={min_calls}")
+    expect(breaker.stats()['state'] == 'open', f"breaker: {breaker.stats()['state']} after {min_calls} failures, expected open")
+    start = time.perf_counter()
+    try: client.call(fn); error = None
+    except Exception as e: error = e
+    elapsed = time.perf_counter() - start
+    expect(isinstance(error, main.ModelUnavailableError), f"breaker: open call raised {error!r}, expected ModelUnavailableError")
+    expect(len(calls) == min_calls, f"breaker: provider called {len(calls)} times, expected {min_calls} (open must not call)")
+    expect(elapsed < 0.01, f"breaker: open call took {elapsed * 1000:.1f}ms, expected fail-fast")
+
+    # 4. cooldown 後の試行 (half-open) が成功すれば閉じる
+    time.sleep(cooldown + 0.05)
+    try: result = client.call(lambda: 'ok')
+    except Exception as e: result = e
+    expect(result == 'ok', f"half-open: probe returned {result!r}, expected 'ok'")
+    expect(breaker.stats()['state'] == 'closed', f"half-open: breaker is {breaker.stats()['state']} after a successful probe, expected closed")
+    return failures
+
+def _as_async(fn):
+    async def wrapper(): return fn()
+    return wrapper
+
+def bench_routing(args):
+    """POSTs against a healthy, a slow and a failing primary model: which model answered, and latency; then one memory summary."""
+    from concurrent.futures import ThreadPoolExecutor
+    import flask
+
+    main = load_main()
+    if not main.ensure_initialized('firestore', 'gemini'): raise SystemExit("stub initialization failed")
+    main.MAX_TOTAL_TURNS = 10 ** 9
+    main.rate_limiter.burst = 0 # 同じキャラクターへの連続 POST を計測するので無効化
+    LATENCY.update(firestore_rpc=args.firestore_rpc, first_token=args.first_token)
+    app = flask.Flask('routing')
+    primary, fallback = main.MODEL_NAME, main.FALLBACK_MODEL_NAME
+    print(f"requests={args.requests} concurrency={args.concurrency} primary={primary} fallback={fallback} summary={main.SUMMARY_MODEL_NAME} (calls include background summaries) "
+          f"first_token={args.first_token}s slow_first_token=+{args.slow_first_token}s threshold={args.threshold}s")
+
+    phases = (('healthy', {}), ('slow', {primary: {'first_token': args.slow_first_token}}), ('failing', {primary: {'fail': True}}))
+    for phase, faults in phases:
+        MODEL_FAULTS.clear(); MODEL_FAULTS.update(faults)
+        MODEL_CALLS.clear()
+        # 各フェーズは新しい状態 (ブレーカー / 遅延の移動平均) から始める
+        main.model_router = main.ModelRouter(primary, fallback, main.ALLOWED_MODEL_NAMES, args.threshold, main.MODEL_FALLBACK_MIN_SAMPLES, main.MODEL_FALLBACK_COOLDOWN_SECONDS)
+        characters = []
+        for i in range(args.characters):
+            character_id = f"routing-{phase}-{i}"
+            seed_character(character_id, {'name': character_id, 'systemPrompt': 'テスト', 'profileText': 'p', 'turnCount': 0})
+            characters.append(character_id)
+
+        def run_one(i, characters=characters):
+            body = json.dumps({'id': characters[i % len(characters)], 'message': 'こんにちは', 'stream': args.stream})
+            with app.test_request_context('/', method='POST', data=body, content_type='application/json'):
+                start = time.perf_counter()
+                response = main.handle_chat(flask.request)
+                for _ in response.response: pass
+                response.close()
+                return response.status_code, time.perf_counter() - start
+
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            results = list(pool.map(run_one, range(args.requests)))
+        main.summary_job_queue.drain(timeout=60)
+        statuses = {}
+        for r in results: statuses[r[0]] = statuses.get(r[0], 0) + 1
+        latencies = sorted(r[1] * 1000 for r in results)
+        print(f"  {phase:<8} status={statuses} calls={dict(sorted(MODEL_CALLS.items()))} p50={_percentile(latencies, 0.5):7.1f}ms "
+              f"p95={_percentile(latencies, 0.95):7.1f}ms router={main.model_router.stats()}")
+
+    # 要約は SUMMARY_MODEL_NAME (軽量モデル) で行う
+    MODEL_FAULTS.clear(); MODEL_CALLS.clear()
+    seed_character('routing-summary', {'name': 'routing-summary', 'systemPrompt': 'テスト', 'profileText': 'p'}, [('user', 'こんにちは'), ('model', 'やあ')] * 5)
+    main.generate_memory_summary(main.db.collection(main.CHARACTERS_COLLECTION).document('routing-summary'), 10)
+    print(f"  summary  calls={MODEL_CALLS}")
+
+_SAMPLE_SENTENCES = [
+    "今日は駅前の新しいカフェに行ってきたよ。", "抹茶ラテがすごく美味しかった！", "最近ちょっと仕事が忙しくて疲れ気味なんだ。",
+    "それは大変だったね、ゆっくり休めている？", "週末は映画を観に行く予定です。", "おすすめの本があったら教えてほしいな。",
+    "猫を飼い始めてから毎日が楽しいです。", "昔からピアノを弾くのが好きだったんだよね。", "明日の天気は晴れるといいなあ。",
+    "そういえば、この前話していた旅行の計画はどうなった？", "京都の紅葉がとても綺麗だったよ。", "あなたの好きな食べ物は何ですか？",
+]
+
+# (古い会話に埋め込む事実, それを尋ねる発言, 応答に必要な語)
+_RECALL_FACTS = [
+    ("うちの猫の名前はミケっていうんだ。", "ねえ、うちの猫の名前覚えてる？", "ミケ"),
+    ("私の誕生日は七月十日なんだよ。", "私の誕生日っていつだったか覚えてる？", "七月十日"),
+    ("実はピーマンがどうしても苦手なんだ。", "私の苦手な野菜って何だっけ？", "ピーマン"),
+    ("来月、北海道の札幌に引っ越すことになったよ。", "引っ越し先ってどこだったっけ？", "札幌"),
+    ("妹の名前はさくらっていいます。", "妹の名前、覚えてる？", "さくら"),
+]
+
+def bench_recall(args):
+    """Questions about facts from old turns: long raw history window vs short window + retrieval.
+
+    Reports estimated prompt tokens, history reads and whether the fact reached the model."""
+    import random
+    import flask
+
+    main = load_main()
+    if not main.ensure_initialized('firestore', 'gemini'): raise SystemExit("stub initialization failed")
+    main.MAX_TOTAL_TURNS = 10 ** 9
+    main.SUMMARIZE_INTERVAL = 10 ** 9 # 要約ジョブの読み込みを計測に混ぜない
+    main.rate_limiter.burst = 0
+    app = flask.Flask('recall')
+    rng = random.Random(args.seed)
+    history = [('user' if i % 2 == 0 else 'model', "".join(rng.choice(_SAMPLE_SENTENCES) for _ in range(2))) for i in range(args.history)]
+    positions = [int(args.history * (i + 0.5) / len(_RECALL_FACTS)) // 2 * 2 for i in range(len(_RECALL_FACTS))] # user の発言に均等に散らす
+    for position, (fact, _, _) in zip(positions, _RECALL_FACTS): history[position] = ('user', fact)
+
+    # モデルに届いたコンテキスト (システム指示 + 履歴 + 送信メッセージ) を記録する
+    sent = []
+    send_message = FakeChatSession.send_message
+    def recording_send_message(self, message, **kwargs):
+        texts = [entry['parts'][0]['text'] for entry in self.history] + [message]
+        sent.append({'tokens': sum(main.estimate_tokens(text) for text in texts), 'historyMessages': len(self.history), 'text': "\n".join(texts)})
+        return send_message(self, message, **kwargs)
+    FakeChatSession.send_message = recording_send_message
+
+    print(f"history={args.history} messages, facts at messages {positions}, store={main.HISTORY_STORE}, embedding={args.embedding}, numpy={'yes' if main.numpy else 'no'}")
+    try:
+        for mode, recall_enabled, turns in (('window', False, args.window_turns), ('recall', True, args.recall_turns)):
+            main.MEMORY_RECALL_ENABLED, main.MAX_HISTORY_TURNS = recall_enabled, turns
+            main.history_cache = main.HistoryCache(main.HISTORY_CACHE_MAX_CHARACTERS, main.HISTORY_CACHE_TTL_SECONDS, max(turns * 2, main.MAX_FRONTEND_HISTORY))
+            main.recall_index = main.RecallIndex(main.create_embedding_provider(args.embedding), main.RECALL_INDEX_MAX_CHARACTERS, main.RECALL_INDEX_MAX_MESSAGES,
+                                                 main.RECALL_INDEX_COLD_LOAD_MESSAGES, main.RECALL_INDEX_REFRESH_SECONDS)
+            main.recall_job_queue = main.SummaryJobQueue(main.recall_index.catch_up, name='recall-worker')
+            character_id = f"recall-{mode}"
+            seed_character(character_id, {'name': character_id, 'systemPrompt': 'テスト', 'profileText': 'p', 'turnCount': 0}, history,
+                           bucket_size=main.HISTORY_BUCKET_SIZE if main.HISTORY_STORE == 'buckets' else None)
+            def post(message: str, character_id=character_id) -> tuple:
+                """One chat turn; returns (reads on the request path, reads by the background index jobs it queued)."""
+                COUNTERS['firestore_reads'] = 0
+                per_request = {}
+                token = _request_counters.set(per_request) # ワーカースレッドの読み込みはここに入らない
+                try:
+                    body = json.dumps({'id': character_id, 'message': message})
+                    with app.test_request_context('/', method='POST', data=body, content_type='application/json'):
+                        response = main.handle_chat(flask.request)
+                        if response.status_code != 200: raise SystemExit(f"unexpected status {response.status_code}")
+                finally:
+                    _request_counters.reset(token)
+                main.recall_job_queue.drain(timeout=60)
+                request_reads = per_request.get('firestore_reads', 0)
+                return request_reads, COUNTERS['firestore_reads'] - request_reads
+
+            # 最初のターンで索引の構築が (リクエストの外で) 始まる。以降のターンごとに古い履歴を1ページずつ追加
+            warmup = [post("こんにちは") for _ in range(args.warmup_turns)]
+            sent.clear()
+            reads, found = [], 0
+            for _, question, answer in _RECALL_FACTS:
+                reads.append(post(question)[0])
+                found += answer in sent[-1]['text']
+            tokens = [record['tokens'] for record in sent]
+            print(f"  {mode:<7} window={turns} turns  prompt tokens avg={statistics.mean(tokens):7.1f}  history messages avg={statistics.mean(r['historyMessages'] for r in sent):5.1f}  "
+                  f"reads first turn={warmup[0][0]} (+{sum(w[1] for w in warmup)} in background over {args.warmup_turns} warm-up turns) then avg={statistics.mean(reads):.1f}  "
+                  f"facts reaching the model={found}/{len(_RECALL_FACTS)}")
+        print(f"  index={main.recall_index.stats()}")
+    finally:
+        FakeChatSession.send_message = send_message
+
+def bench_payload(args):
+    """Bytes on the wire and encode/compress time of a typical GET profile: legacy json.dumps vs the compact encoder."""
+    import gzip
+    import random
+    import timeit
+
+    main = load_main()
+    rng = random.Random(args.seed)
+    def text(sentences: int) -> str:
+        return "".join(rng.choice(_SAMPLE_SENTENCES) for _ in range(sentences))
+
+    print(f"message ~{args.sentences} sentences, orjson={'yes' if main.orjson else 'no'}, brotli={'yes' if main.brotli else 'no'}, gzip level={main.GZIP_LEVEL}")
+    for count in args.messages:
+        history = [{'role': 'user' if i % 2 == 0 else 'model', 'message': text(rng.randint(1, args.sentences * 2))} for i in range(count)]
+        char_data = {'name': 'テストキャラ', 'profileText': text(10), 'turnCount': count, 'iconUrl': None}
+        legacy = {'id': 'bench', 'name': char_data['name'], 'iconUrl': None, 'profileText': char_data['profileText'], 'history': history,
+                  'historyCursor': None, 'currentTurnCount': count, 'maxTurns': main.MAX_TOTAL_TURNS * 2}
+        variants = {
+            'legacy json.dumps': lambda legacy=legacy: json.dumps(legacy, ensure_ascii=False).encode('utf-8'),
+            'compact (orjson)' if main.orjson else 'compact': lambda char_data=char_data, history=history: main.build_profile_body('bench', char_data, history, None),
+        }
+        if main.orjson:
+            def compact_stdlib(orjson=main.orjson, char_data=char_data, history=history):
+                main.orjson = None
+                try: return main.build_profile_body('bench', char_data, history, None)
+                finally: main.orjson = orjson
+            variants['compact (stdlib)'] = compact_stdlib
+        print(f"  messages={count}")
+        for label, encode in variants.items():
+            body = encode()
+            encode_us = timeit.timeit(encode, number=args.repeat) / args.repeat * 1e6
+            gzip_us = timeit.timeit(lambda body=body: gzip.compress(body, compresslevel=main.GZIP_LEVEL, mtime=0), number=args.repeat) / args.repeat * 1e6
+            row = f"    {label:<18} raw={len(body):6d}B  gzip={len(gzip.compress(body, compresslevel=main.GZIP_LEVEL)):6d}B"
+            if main.brotli: row += f"  br={len(main.brotli.compress(body, quality=main.BROTLI_QUALITY)):6d}B"
+            print(row + f"  encode={encode_us:7.1f}us  gzip={gzip_us:7.1f}us")
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Offline benchmarks for handle_chat.")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("ttfb", help="time-to-first-byte of streaming vs blocking replies")
+    p.add_argument("--runs", type=int, default=5)
+    p.add_argument("--chunks", type=int, default=20)
+    p.add_argument("--first-chunk-delay", type=float, default=0.3)
+    p.add_argument("--chunk-delay", type=float, default=0.05)
+    p.set_defaults(func=bench_ttfb)
+
+    p = sub.add_parser("coldstart", help="import-to-first-response time with stubbed clients")
+    p.add_argument("--runs", type=int, default=5)
+    p.add_argument("--firestore-init", type=float, default=0.3)
+    p.add_argument("--secret", type=float, default=0.2)
+    p.add_argument("--gemini-init", type=float, default=0.1)
+    p.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    p.set_defaults(func=lambda args: _coldstart_child(args) if args.child else bench_coldstart(args))
+
+    p = sub.add_parser("load", help="GET/POST mix through handle_chat at a fixed concurrency")
+    p.add_argument("--requests", type=int, default=500)
+    p.add_argument("--concurrency", type=int, default=16)
+    p.add_argument("--post-ratio", type=float, default=0.3)
+    p.add_argument("--characters", type=int, default=20)
+    p.add_argument("--history", type=int, default=20, help="seeded history messages per character")
+    p.add_argument("--firestore-rpc", type=float, default=0.01)
+    p.add_argument("--first-token", type=float, default=0.2)
+    p.add_argument("--chunk", type=float, default=0.01)
+    p.add_argument("--chunks", type=int, default=20)
+    p.add_argument("--stream", action="store_true", help="POST with stream: true")
+    p.add_argument("--store", choices=("messages", "buckets"), default="messages", help="history layout (HISTORY_STORE)")
+    p.add_argument("--no-history-cache", action="store_true", help="disable the history cache to see raw storage reads")
+    p.add_argument("--seed", type=int, default=1)
+    p.set_defaults(func=bench_load)
+
+    p = sub.add_parser("async", help="requests/second per instance: sync handle_chat vs asgi_app")
+    p.add_argument("--requests", type=int, default=400)
+    p.add_argument("--concurrency", type=int, default=64, help="in-flight requests (threads for sync, tasks for async)")
+    p.add_argument("--post-ratio", type=float, default=0.3)
+    p.add_argument("--characters", type=int, default=50)
+    p.add_argument("--history", type=int, default=20)
+    p.add_argument("--firestore-rpc", type=float, default=0.01)
+    p.add_argument("--first-token", type=float, default=0.2)
+    p.add_argument("--chunk", type=float, default=0.01)
+    p.add_argument("--chunks", type=int, default=20)
+    p.add_argument("--stream", action="store_true")
+    p.add_argument("--seed", type=int, default=1)
+    p.set_defaults(func=bench_async)
+
+    p = sub.add_parser("burst", help="concurrent POSTs to one character with/without rate limiting and single-flight")
+    p.add_argument("--requests", type=int, default=20)
+    p.add_argument("--firestore-rpc", type=float, default=0.01)
+    p.add_argument("--first-token", type=float, default=0.2)
+    p.add_argument("--chunk", type=float, default=0.01)
+    p.add_argument("--chunks", type=int, default=5)
+    p.add_argument("--stream", action="store_true")
+    p.set_defaults(func=bench_burst)
+
+    p = sub.add_parser("resilience", help="model-call tail latency with injected errors and hangs (retry / hedge / breaker)")
+    p.add_argument("--calls", type=int, default=400)
+    p.add_argument("--concurrency", type=int, default=16)
+    p.add_argument("--latency", type=float, default=0.1, help="median provider latency (lognormal)")
+    p.add_argument("--error-rate", type=float, default=0.05, help="fraction of calls failing with 503")
+    p.add_argument("--hang-rate", type=float, default=0.05, help="fraction of calls that hang")
+    p.add_argument("--hang-seconds", type=float, default=3.0)
+    p.add_argument("--timeout", type=float, default=0.5, help="per-attempt timeout")
+    p.add_argument("--deadline", type=float, default=1.5, help="overall deadline including retries")
+    p.add_argument("--attempts", type=int, default=3)
+    p.add_argument("--base-delay", type=float, default=0.02)
+    p.add_argument("--hedge-after", type=float, default=0.25)
+    p.add_argument("--breaker-cooldown", type=float, default=30)
+    p.add_argument("--seed", type=int, default=1)
+    p.set_defaults(func=bench_resilience)
+
+    p = sub.add_parser("recall", help="recall of old facts and prompt size: long history window vs short window + retrieval")
+    p.add_argument("--history", type=int, default=600, help="stored messages before the questions")
+    p.add_argument("--window-turns", type=int, default=50, help="raw history turns without retrieval (previous MAX_HISTORY_TURNS)")
+    p.add_argument("--recall-turns", type=int, default=20, help="raw history turns with retrieval")
+    p.add_argument("--warmup-turns", type=int, default=2, help="turns before the questions (the index builds and backfills in the background)")
+    p.add_argument("--embedding", default="local", help="EMBEDDING_PROVIDER for the retrieval run (the stubs have no embedding API)")
+    p.add_argument("--seed", type=int, default=1)
+    p.set_defaults(func=bench_recall)
+
+    p = sub.add_parser("payload", help="GET profile size and serialization/compression time")
+    p.add_argument("--messages", type=int, nargs="+", default=[20, 50], help="history messages embedded in the profile")
+    p.add_argument("--sentences", type=int, default=3, help="average sentences per message")
+    p.add_argument("--repeat", type=int, default=2000)
+    p.add_argument("--seed", type=int, default=1)
+    p.set_defaults(func=bench_payload)
+
+    p = sub.add_parser("routing", help="per-character model choice and fallback to a lighter model when the primary is slow or failing")
+    p.add_argument("--requests", type=int, default=40)
+    p.add_argument("--concurrency", type=int, default=4)
+    p.add_argument("--characters", type=int, default=8)
+    p.add_argument("--firestore-rpc", type=float, default=0.002)
+    p.add_argument("--first-token", type=float, default=0.02)
+    p.add_argument("--slow-first-token", type=float, default=0.3, help="extra first-token delay of the primary in the slow phase")
+    p.add_argument("--threshold", type=float, default=0.2, help="latency that moves traffic to the fallback (MODEL_FALLBACK_LATENCY_SECONDS)")
+    p.add_argument("--stream", action="store_true")
+    p.set_defaults(func=bench_routing)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -5,27 +5,146 @@ import functions_framework
 import json
 import os
 from flask import Request, Response
-from datetime import datetime, timezone
-import traceback # エラー出力用にインポート
+from datetime import datetime, timedelta, timezone
+import threading # 非同期要約ワーカー用
+import time
+import hashlib # モデルキャッシュのキー生成用
+import gzip # 応答の圧縮用
+import math
+import operator # ベクトル検索 (numpy が無い場合の内積計算) 用
+import unicodedata # 埋め込みの正規化用
+import zlib # ローカル埋め込みの特徴ハッシュ用
+import random # モデル呼び出しリトライのジッター用
+import logging
+import contextvars
+import sys
+import uuid
+import asyncio # ASGI モード用
+from urllib.parse import parse_qs
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait as wait_futures # 初期化の並行実行 / モデル呼び出しのタイムアウト用
+from contextlib import contextmanager, nullcontext
+
+# --- ★★★ 構造化ログ & リクエストトレース ★★★ ---
+# Cloud Logging は stdout の JSON 1行を構造化ログとして取り込む (severity / message / 任意フィールド)。
+# LOG_LEVEL=DEBUG で詳細ログ (履歴の中身など) も出力。既定の INFO では DEBUG ログは整形もされない。
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+
+try:
+    from opentelemetry import trace as otel_trace # 任意: インストールされていれば各区間を OTel span としても記録
+    _otel_tracer = otel_trace.get_tracer("ai-character-chat")
+except ImportError:
+    _otel_tracer = None
+
+try:
+    import orjson # 任意: インストールされていれば JSON エンコードを高速化 (出力は標準 json のコンパクト形式と同じ)
+except ImportError:
+    orjson = None
+
+try:
+    import brotli # 任意: インストールされていれば Accept-Encoding: br に対応
+except ImportError:
+    brotli = None
+
+try:
+    import numpy # 任意: インストールされていれば過去の会話のベクトル検索を高速化
+except ImportError:
+    numpy = None
+
+_current_trace = contextvars.ContextVar('current_trace', default=None)
+
+class JsonLogFormatter(logging.Formatter):
+    """One JSON object per line, tagged with the current request id / character id."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {'severity': record.levelname, 'message': record.getMessage(), 'logger': record.name}
+        trace = _current_trace.get()
+        if trace is not None:
+            entry['requestId'] = trace.request_id
+            if trace.character_id: entry['characterId'] = trace.character_id
+        fields = getattr(record, 'fields', None)
+        if fields: entry.update(fields)
+        if record.exc_info: entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+logger = logging.getLogger('ai_character_chat')
+if not logger.handlers:
+    _log_handler = logging.StreamHandler(sys.stdout)
+    _log_handler.setFormatter(JsonLogFormatter())
+    logger.addHandler(_log_handler)
+logger.setLevel(LOG_LEVEL)
+logger.propagate = False
+
+class RequestTrace:
+    """Stage timings (ms) and operation counters for one request or job, logged as one line on finish."""
+
+    def __init__(self, kind: str, request_id: str | None = None):
+        self.kind = kind
+        self.request_id = request_id or uuid.uuid4().hex[:16]
+        self.character_id = None
+        self.model = None # 実際に応答したチャットモデル (フォールバック時は代替モデル)
+        self.spans = {}
+        self.counters = {'firestoreReads': 0, 'firestoreWrites': 0, 'modelCalls': 0, 'modelRetries': 0, 'modelHedges': 0, 'modelFallbacks': 0, 'promptTokens': 0, 'outputTokens': 0}
+        self.streaming = False # True: 応答本文 (SSE) の送信完了時に finish する
+        self._start = time.perf_counter()
+        self._finished = False
+
+    @contextmanager
+    def span(self, name: str):
+        start = time.perf_counter()
+        with (_otel_tracer.start_as_current_span(name) if _otel_tracer else nullcontext()) as otel_span:
+            if otel_span is not None:
+                otel_span.set_attribute('request.id', self.request_id)
+                if self.character_id: otel_span.set_attribute('character.id', self.character_id)
+            try:
+                yield
+            finally:
+                self.spans[name] = round(self.spans.get(name, 0.0) + (time.perf_counter() - start) * 1000, 2)
+
+    def finish(self, status, **fields):
+        if self._finished: return
+        self._finished = True
+        logger.info("%s finished", self.kind, extra={'fields': {
+            'kind': self.kind, 'requestId': self.request_id, 'characterId': self.character_id, 'model': self.model, 'status': status,
+            'durationMs': round((time.perf_counter() - self._start) * 1000, 2), 'spansMs': self.spans, **self.counters, **fields,
+        }})
+
+def trace_span(name: str):
+    """Times a stage of the current request (no-op outside a trace)."""
+    trace = _current_trace.get()
+    return trace.span(name) if trace is not None else nullcontext()
+
+def trace_count(name: str, n: int = 1):
+    trace = _current_trace.get()
+    if trace is not None: trace.counters[name] += n
+
+def trace_character(character_id: str):
+    trace = _current_trace.get()
+    if trace is not None: trace.character_id = character_id
+
+def trace_model(model_name: str):
+    trace = _current_trace.get()
+    if trace is not None: trace.model = model_name
+
+def record_model_usage(response):
+    """Counts one model call and its token usage (usage_metadata) on the current trace."""
+    trace_count('modelCalls')
+    usage = getattr(response, 'usage_metadata', None)
+    if usage is not None:
+        trace_count('promptTokens', getattr(usage, 'prompt_token_count', 0) or 0)
+        trace_count('outputTokens', getattr(usage, 'candidates_token_count', 0) or 0)
 
 # --- Firestore Setup ---
 from google.cloud import firestore
 from google.cloud.firestore import Increment # Turn Count 更新用
+from google.cloud.firestore import FieldFilter # 要約カーソル以降の履歴取得用
+from google.api_core import exceptions as google_exceptions # モデル呼び出しのリトライ判定用
 
 firestore_init_error = None
 db = None # Firestoreクライアントオブジェクト
+async_db = None # 非同期 (ASGI) モード用の Firestore AsyncClient
 DATABASE_ID = 'characters' # データベースIDを定数化（任意）
 
-try:
-    print(f"Initializing Firestore client for database '{DATABASE_ID}'...")
-    # database 引数に作成したデータベースのIDを指定する
-    db = firestore.Client(database=DATABASE_ID)
-    print(f"Firestore client initialized successfully for database '{DATABASE_ID}'.")
-except Exception as e:
-    # エラーメッセージにもデータベースIDを含めるとデバッグしやすい
-    firestore_init_error = f"FATAL: Failed to initialize Firestore client for database '{DATABASE_ID}': {e}"
-    print(firestore_init_error); traceback.print_exc()
-
 ## --- Google AI (Gemini) Setup ---
 ## (Geminiの初期化はFirestore初期化が成功した場合のみ行う)
 #import google.generativeai as genai
@@ -53,60 +172,210 @@ except Exception as e:
 
 # --- ▼▼▼ Google AI (Gemini) Setup (Secret Managerから読み込むように変更) ▼▼▼ ---
 # GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY") # ← 環境変数からの取得を削除
-MODEL_NAME = "gemini-2.0-flash"
+import google.generativeai as genai # ★ 上のコメントアウトでインポートも消えていたので復活
+MODEL_NAME = os.environ.get("CHAT_MODEL_NAME", "gemini-2.0-flash") # 既定のチャットモデル (キャラクターの 'model' フィールドで上書き可)
+SUMMARY_MODEL_NAME = os.environ.get("SUMMARY_MODEL_NAME", "gemini-2.0-flash-lite") # 要約 (バックグラウンド) は軽量モデルで十分
+FALLBACK_MODEL_NAME = os.environ.get("FALLBACK_MODEL_NAME", "gemini-2.0-flash-lite") # 主モデルが遅い / 失敗続きのときの代替 ("" で無効)
+# キャラクターの 'model' に指定できるモデル (それ以外は既定のモデルを使う)
+ALLOWED_MODEL_NAMES = {MODEL_NAME, SUMMARY_MODEL_NAME, FALLBACK_MODEL_NAME, "gemini-2.0-flash", "gemini-2.0-flash-lite", "gemini-2.5-flash", "gemini-2.5-flash-lite", "gemini-2.5-pro"} - {""}
 PROJECT_ID = os.environ.get("GOOGLE_CLOUD_PROJECT", None) # ★★★ 環境変数名を修正 ★★★
 
-gemini_model = None
+summary_model = None
 gemini_initialization_error = None
+GEMINI_SECRET_ID = 'gemini-api-key'
+# --- ▲▲▲ Google AI (Gemini) Setup ここまで変更 ▲▲▲ ---
+
+# --- ★★★ 遅延・並行初期化 (Firestore / Secret Manager + Gemini) ★★★ ---
+# import 時は初期化を「開始」するだけで待たない。Firestore と Gemini は別スレッドで並行して初期化し、
+# 各リクエストは必要なものだけを待つ (OPTIONS は待たない / GET は Firestore のみ / POST は両方)。
+# 失敗しても 503 のまま固定せず、INIT_RETRY_INTERVAL_SECONDS 経過後のリクエストで再試行する。
+INIT_TIMEOUT_SECONDS = 30          # リクエストが初期化完了を待つ最大秒数
+INIT_RETRY_INTERVAL_SECONDS = 10   # 初期化失敗後、再試行するまでの最短間隔
+SECRET_CACHE_TTL_SECONDS = 3600    # Secret Manager から取得した値のキャッシュ期間 (経過後はバックグラウンドで再取得)
 
-if not firestore_init_error: # Firestore初期化が成功していることが前提
+_init_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='init')
+_init_lock = threading.Lock()
+_init_state = {name: {'future': None, 'ready': False, 'failed_at': None, 'ready_at': None} for name in ('firestore', 'gemini')}
+_sm_client = None
+_secret_cache = {} # secret_id -> (value, fetched_at)
+
+def get_secret(secret_id: str) -> str:
+    """Returns the latest secret version from Secret Manager, cached for SECRET_CACHE_TTL_SECONDS."""
+    global _sm_client
+    cached = _secret_cache.get(secret_id)
+    if cached and time.monotonic() - cached[1] < SECRET_CACHE_TTL_SECONDS:
+        return cached[0]
     if not PROJECT_ID:
-         gemini_initialization_error = "FATAL: GCP_PROJECT env var not found for Secret Manager."
-         print(gemini_initialization_error)
-    else:
-        try:
-            print("Initializing Secret Manager client for Gemini Key...")
-            sm_client = secretmanager.SecretManagerServiceClient()
-            # ★ Secret Manager で作成したシークレット名を指定 (バージョンは latest が一般的)
-            secret_name = f"projects/{PROJECT_ID}/secrets/gemini-api-key/versions/latest"
-            print(f"Accessing secret: {secret_name}")
-            response = sm_client.access_secret_version(request={"name": secret_name})
-            GEMINI_API_KEY_SM = response.payload.data.decode("UTF-8") # ★ キーを取得・デコード
-            print("Gemini API Key successfully retrieved from Secret Manager.")
-
-            if not GEMINI_API_KEY_SM:
-                 gemini_initialization_error = "FATAL: Got empty API Key from Secret Manager."
-                 print(gemini_initialization_error)
-            else:
-                try:
-                    print("Initializing Gemini with key from Secret Manager...")
-                    genai.configure(api_key=GEMINI_API_KEY_SM) # ★ 取得したキーで設定
-                    gemini_model = genai.GenerativeModel(MODEL_NAME)
-                    print(f"Gemini Initialized. Model: {MODEL_NAME}")
-                except Exception as e:
-                    gemini_initialization_error = f"FATAL: Failed to init Gemini w/ SM Key: {e}"
-                    print(gemini_initialization_error); traceback.print_exc()
-
-        except Exception as e: # Secret Manager アクセスエラーなど
-            gemini_initialization_error = f"FATAL: Failed to access Secret Manager: {e}"
-            print(gemini_initialization_error); traceback.print_exc()
-else:
-    gemini_initialization_error = "Skipped due to Firestore init failure."
-    print("Gemini initialization skipped.")
-# --- ▲▲▲ Google AI (Gemini) Setup ここまで変更 ▲▲▲ ---
+        raise RuntimeError("GCP_PROJECT env var not found for Secret Manager.")
+    if _sm_client is None:
+        logger.info("Initializing Secret Manager client...")
+        _sm_client = secretmanager.SecretManagerServiceClient()
+    # ★ Secret Manager で作成したシークレット名を指定 (バージョンは latest が一般的)
+    secret_name = f"projects/{PROJECT_ID}/secrets/{secret_id}/versions/latest"
+    logger.info("Accessing secret: %s", secret_name)
+    response = _sm_client.access_secret_version(request={"name": secret_name})
+    value = response.payload.data.decode("UTF-8") # ★ キーを取得・デコード
+    _secret_cache[secret_id] = (value, time.monotonic())
+    return value
+
+def _init_firestore():
+    global db, async_db
+    logger.info("Initializing Firestore client for database '%s'...", DATABASE_ID)
+    # database 引数に作成したデータベースのIDを指定する
+    db = firestore.Client(database=DATABASE_ID)
+    async_db = firestore.AsyncClient(database=DATABASE_ID) # ASGI モード用 (接続は最初の呼び出しまで張られない)
+    logger.info("Firestore client initialized successfully for database '%s'.", DATABASE_ID)
+
+def _init_gemini():
+    global summary_model
+    api_key = get_secret(GEMINI_SECRET_ID)
+    if not api_key: raise RuntimeError("Got empty API Key from Secret Manager.")
+    logger.info("Initializing Gemini with key from Secret Manager...")
+    genai.configure(api_key=api_key) # ★ 取得したキーで設定
+    summary_model = genai.GenerativeModel(SUMMARY_MODEL_NAME)
+    logger.info("Gemini Initialized. Model: %s (summary: %s, fallback: %s)", MODEL_NAME, SUMMARY_MODEL_NAME, FALLBACK_MODEL_NAME or 'none')
+
+def _run_initializer(name: str):
+    global firestore_init_error, gemini_initialization_error
+    state = _init_state[name]
+    try:
+        _init_firestore() if name == 'firestore' else _init_gemini()
+        with _init_lock:
+            state['ready'] = True; state['failed_at'] = None; state['ready_at'] = time.monotonic()
+        if name == 'firestore': firestore_init_error = None
+        else: gemini_initialization_error = None
+    except Exception as e:
+        with _init_lock:
+            state['failed_at'] = time.monotonic()
+            still_ready = state['ready'] # 再取得 (リフレッシュ) の失敗なら既存のクライアントを使い続ける
+        # エラーメッセージにもデータベースIDを含めるとデバッグしやすい
+        error = f"FATAL: Failed to initialize Firestore client for database '{DATABASE_ID}': {e}" if name == 'firestore' else f"FATAL: Failed to init Gemini w/ SM Key: {e}"
+        logger.exception(error)
+        if not still_ready:
+            if name == 'firestore': firestore_init_error = error
+            else: gemini_initialization_error = error
+
+def start_initialization(name: str, refresh: bool = False):
+    """Starts (or retries / refreshes) initialization in the background. Returns its Future, if any."""
+    with _init_lock:
+        state = _init_state[name]
+        future = state['future']
+        if future is not None and not future.done(): return future
+        if state['ready'] and not refresh: return future
+        if state['failed_at'] is not None and time.monotonic() - state['failed_at'] < INIT_RETRY_INTERVAL_SECONDS: return future
+        state['future'] = _init_executor.submit(_run_initializer, name)
+        return state['future']
+
+def ensure_initialized(*names: str, timeout: float = INIT_TIMEOUT_SECONDS) -> bool:
+    """Waits for the named components (kicked off concurrently). Returns True if all are ready."""
+    futures = [start_initialization(name) for name in names]
+    for name, future in zip(names, futures):
+        if _init_state[name]['ready']: continue
+        if future is not None:
+            try: future.result(timeout=timeout)
+            except Exception as e: logger.warning("Initialization of %s did not finish: %s", name, e)
+    if 'gemini' in names and _init_state['gemini']['ready'] and time.monotonic() - _init_state['gemini']['ready_at'] > SECRET_CACHE_TTL_SECONDS:
+        start_initialization('gemini', refresh=True) # キーのローテーションに追従 (待たない)
+    return all(_init_state[name]['ready'] for name in names)
+
+# import 時に両方の初期化を並行して開始 (完了は待たない)
+start_initialization('firestore')
+start_initialization('gemini')
 
 # --- 定数 ---
 CHARACTERS_COLLECTION = 'characters' # Firestoreのコレクション名
 HISTORY_SUBCOLLECTION = 'history'    # Firestoreのサブコレクション名
-MAX_HISTORY_TURNS = 50 # ★本番用の会話履歴の参照数に戻す (必要なら調整)
+# ★ 履歴の保存形式: 'messages' (1メッセージ1ドキュメント) / 'buckets' (まとめて保存) / 'sqlite' (ローカル検証用)
+HISTORY_STORE = os.environ.get("HISTORY_STORE", "messages")
+HISTORY_BUCKET_SUBCOLLECTION = 'historyBuckets'
+HISTORY_BUCKET_SIZE = 50 # 1バケットのメッセージ数 (偶数。ドキュメント上限 1MiB に十分収まる量)
+HISTORY_BUCKET_LEGACY_FALLBACK = True # 'buckets' 移行期間中は足りない分を従来形式からも読む (移行完了後 False)
+HISTORY_SQLITE_PATH = os.environ.get("HISTORY_SQLITE_PATH", ":memory:")
+# ★ 過去の会話の検索 (関連する古いやりとりだけをコンテキストに入れる)。MEMORY_RECALL=1 で有効にした場合のみ生の履歴の参照数を減らす
+MEMORY_RECALL_ENABLED = os.environ.get("MEMORY_RECALL", "") == "1"
+MAX_HISTORY_TURNS = 20 if MEMORY_RECALL_ENABLED else 50 # ★本番用の会話履歴の参照数 (必要なら調整)
 SUMMARIZE_INTERVAL = 3 # ★本番用の要約間隔を戻す (必要なら調整)
+# ★ True: 要約をバックグラウンドのジョブキューで実行 (応答を待たせない)
+#   Cloud Functions では応答後のCPUが絞られるため「CPU常時割り当て」(gen2) 推奨。False で従来の同期実行。
+ASYNC_SUMMARIZATION = True
+MAX_MEMORY_CHARS = 2000 # メモリー (memoryPrompt) の最大文字数
+MAX_SUMMARY_SOURCE_MESSAGES = 40 # 1回の要約に渡す新規メッセージの上限 (残りは次回の要約で処理)
+SUMMARY_LATENCY_SAMPLES = 200 # 要約ジョブのレイテンシ統計に保持するサンプル数
+# GenerativeModel キャッシュ (システム指示ごと)
+MODEL_CACHE_MAX_ENTRIES = 200
+# ★★★ モデル呼び出しの耐障害設定 ★★★
+MODEL_CALL_TIMEOUT_SECONDS = 30 # 1回の呼び出し (ストリーミングは最初のチャンクまで) の上限
+MODEL_CALL_DEADLINE_SECONDS = 45 # リトライを含めた全体の上限
+MODEL_RETRY_MAX_ATTEMPTS = 3
+MODEL_RETRY_BASE_DELAY_SECONDS = 0.5 # 指数バックオフの初期値 (0〜上限の間でランダムに待つ full jitter)
+MODEL_RETRY_MAX_DELAY_SECONDS = 4
+MODEL_HEDGE_AFTER_SECONDS = float(os.environ.get("MODEL_HEDGE_AFTER_SECONDS", "0")) # この秒数で応答が無ければ2本目を並行して送る (0 で無効。呼び出し数が増えるので注意)
+MODEL_BREAKER_WINDOW = 20 # 直近この回数の呼び出し結果で遮断を判定 (並行呼び出しでも「連続失敗」に頼らない)
+MODEL_BREAKER_MIN_CALLS = 10 # 判定に必要な最小呼び出し数
+MODEL_BREAKER_FAILURE_RATIO = 0.5 # 直近の失敗率がこれ以上なら遮断
+MODEL_BREAKER_COOLDOWN_SECONDS = 30 # 遮断後、試行を1件だけ通すまでの秒数
+MODEL_CALL_MAX_WORKERS = 32 # 同期呼び出しをタイムアウト付きで実行するスレッド数
+SUMMARY_MODEL_TIMEOUT_SECONDS = 60 # 要約はバックグラウンドなので長めに待ち、ヘッジしない
+# ★★★ モデルの切り替え (主モデルが遅い / 遮断中は FALLBACK_MODEL_NAME へ) ★★★
+MODEL_FALLBACK_LATENCY_SECONDS = 8 # 応答 (ストリーミングは最初のチャンク) までの移動平均がこれを超えたら代替モデルへ
+MODEL_FALLBACK_MIN_SAMPLES = 5 # 遅延の判定に必要な最小呼び出し数
+MODEL_FALLBACK_COOLDOWN_SECONDS = 60 # 代替モデルに切り替えている時間 (経過後に主モデルを再計測)
+# ★ プロバイダ側のコンテキストキャッシュ (Gemini CachedContent)。
+#   対応モデル (バージョン固定の名前が必要な場合あり) かつ最小トークン数以上のシステム指示でのみ有効
+CONTEXT_CACHE_ENABLED = os.environ.get("GEMINI_CONTEXT_CACHE", "") == "1"
+CONTEXT_CACHE_MIN_CHARS = 8000 # これより短いシステム指示はプロバイダの最小トークン数に届かないので使わない
+CONTEXT_CACHE_TTL_SECONDS = 3600
 MAX_TOTAL_TURNS = 5    # ★本番用の会話回数上限 (必要なら調整)
 ALLOWED_ORIGINS = "https://ai-character-chat-frontend.vercel.app" # 設定済み
-# フロントエンドに返す履歴の最大件数 (多すぎるとレスポンスが大きくなる)
-MAX_FRONTEND_HISTORY = 50
+# プロフィール応答に埋め込む最初の履歴ページの件数 (それより古い分は /history で順次取得)
+MAX_FRONTEND_HISTORY = 20
+HISTORY_PAGE_DEFAULT_LIMIT = 30
+HISTORY_PAGE_MAX_LIMIT = 100
+HISTORY_PAGE_CACHE_CONTROL = 'private, max-age=86400' # カーソルより古い履歴は追記されないので長くキャッシュできる
+# 会話履歴キャッシュ (インスタンス内)。他インスタンスの書き込みは TTL 経過後に反映される
+HISTORY_CACHE_MAX_CHARACTERS = 500 # キャッシュするキャラクター数の上限 (LRU で追い出し)
+HISTORY_CACHE_TTL_SECONDS = 300
+# プロフィール応答キャッシュ (ETag 付き)。TTL 内は Firestore を読まずに 304 を返す
+PROFILE_CACHE_MAX_CHARACTERS = 500
+PROFILE_CACHE_TTL_SECONDS = 30
+PROFILE_CACHE_CONTROL = 'private, no-cache' # ブラウザには保存させ、毎回 If-None-Match で再検証させる
+# ★ コンテキストのトークン予算 (システム指示 + メモリー + 履歴 + ユーザー発言、推定値)
+# ★★★ 流量制限 (キャラクターごと) ★★★
+# トークンバケット: 最大 RATE_LIMIT_BURST 回まで連続で送れ、以降は RATE_LIMIT_PER_MINUTE のペースで回復
+RATE_LIMIT_BURST = int(os.environ.get("RATE_LIMIT_BURST", "3"))
+RATE_LIMIT_PER_MINUTE = float(os.environ.get("RATE_LIMIT_PER_MINUTE", "6")) # 0 以下で無効
+RATE_LIMIT_MAX_CHARACTERS = 5000 # バケットを保持するキャラクター数の上限 (LRU で追い出し。追い出されたら満タンから再開)
+# 同じキャラクターへのターンは 1 件ずつ順番に処理する (turnCount の競合とモデルの重複呼び出しを防ぐ)
+TURN_QUEUE_MAX_WAITERS = 2 # 実行中のターンの後ろに並べる数 (超えた分は即 429)
+TURN_QUEUE_WAIT_SECONDS = 30 # 並んだリクエストが待つ最大秒数 (超えたら 429)
+
+# ★★★ 応答の圧縮 (Accept-Encoding で gzip / br を選択) ★★★
+COMPRESSION_MIN_BYTES = 1024 # これより小さい応答は圧縮しない (ヘッダー分と CPU の方が高くつく)
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5 # 動的圧縮向けの速度重視設定 (最大 11)
+
+CONTEXT_TOKEN_BUDGET = 8000
+MEMORY_TOKEN_BUDGET = 1500 # うちメモリーに使う上限 (超えた分は切り詰め)
+RECALL_TOKEN_BUDGET = 600 # うち検索で見つけた過去の会話に使う上限 (MEMORY_RECALL_ENABLED 時は履歴の予算から差し引く)
+
+# ★★★ 過去の会話の検索 (埋め込み + キャラクターごとのベクトル索引) ★★★
+EMBEDDING_PROVIDER = os.environ.get("EMBEDDING_PROVIDER", "gemini") # 'gemini' (埋め込み API) / 'local' (オフライン検証用の特徴ハッシュ。本番では使わない)
+EMBEDDING_MODEL_NAME = "models/text-embedding-004"
+EMBEDDING_DIMENSIONS = 256 # 1メッセージ = 256 バイト (int8 に量子化して保持)
+EMBEDDING_MAX_CHARS = 500 # 埋め込むのはメッセージの先頭この文字数まで
+EMBEDDING_BATCH_SIZE = 100 # 埋め込み API 1回あたりの最大件数
+EMBEDDING_QUERY_TIMEOUT_SECONDS = 2 # 発言の埋め込み (チャットのリクエスト中) 1回の上限
+EMBEDDING_QUERY_DEADLINE_SECONDS = 3 # リトライを含めた上限 (超えたら検索なしで応答)
+EMBEDDING_BATCH_TIMEOUT_SECONDS = 20 # 履歴の埋め込み (バックグラウンドの索引更新) 1バッチの上限
+RECALL_TOP_K = 4
+RECALL_SNIPPET_MAX_TOKENS = 150 # 1件あたりの上限 (超えた分は切り詰め)
+RECALL_INDEX_MAX_CHARACTERS = 100 # 索引を保持するキャラクター数の上限 (LRU で追い出し)
+RECALL_INDEX_MAX_MESSAGES = 1000 # 1キャラクターの索引に入れる最大メッセージ数 (古いものから捨てる)
+RECALL_INDEX_COLD_LOAD_MESSAGES = 300 # 初回の構築で読む直近のメッセージ数 (以降は新しい分だけを追加して RECALL_INDEX_MAX_MESSAGES まで貯める)
+RECALL_INDEX_REFRESH_SECONDS = 60 # 索引を保存済みの履歴に追いつかせる間隔 (それより新しい分は生の履歴に含まれる)
 
 # Charactersコレクションのフィールド名 (コード内で直接文字列を使うので定数化は任意)
-# FIELD_NAME = 'name'; FIELD_SYSPROMPT = 'systemPrompt'; FIELD_ICON = 'iconUrl'; FIELD_PROFILE = 'profileText'; FIELD_MEMORY = 'memoryPrompt'; FIELD_TURNCOUNT = 'turnCount'
+# FIELD_NAME = 'name'; FIELD_SYSPROMPT = 'systemPrompt'; FIELD_ICON = 'iconUrl'; FIELD_PROFILE = 'profileText'; FIELD_MEMORY = 'memoryPrompt'; FIELD_TURNCOUNT = 'turnCount'; FIELD_SUMMARY_CURSOR = 'lastSummarizedAt'; FIELD_LAST_MESSAGE = 'lastMessageAt'
 # Historyサブコレクションのフィールド名
 # FIELD_TS = 'timestamp'; FIELD_ROLE = 'role'; FIELD_MSG = 'message'
 
@@ -115,75 +384,121 @@ MAX_FRONTEND_HISTORY = 50
 @functions_framework.http
 def handle_chat(request: Request) -> Response:
     """Handles PROFILE (GET) and CHAT (POST) requests using Firestore."""
-    print(f"--- Received request: Method={request.method}, URL={request.url} ---")
+    # ★ リクエストごとのトレース (区間タイミング + Firestore/モデルの操作数)。完了時に1行の構造化ログを出力
+    # Cloud Run / Functions が付ける X-Cloud-Trace-Context があればその trace id をリクエスト ID に使う
+    cloud_trace = request.headers.get('X-Cloud-Trace-Context', '')
+    trace = RequestTrace(f"{request.method} chat", cloud_trace.split('/')[0] or None)
+    token = _current_trace.set(trace)
+    status = 500
+    try:
+        logger.debug("Received request: Method=%s, URL=%s", request.method, request.url)
+        response = _handle_request(request)
+        status = response.status_code
+        apply_response_compression(response, request.headers.get('Accept-Encoding', ''))
+        return response
+    finally:
+        _current_trace.reset(token)
+        # ストリーミング応答はジェネレーター側でストリーム終了時に finish する
+        if status != 200 or not trace.streaming: trace.finish(status)
+
+def _handle_request(request: Request) -> Response:
 
     # CORS Preflight
     if request.method == 'OPTIONS':
         headers = {
             'Access-Control-Allow-Origin': ALLOWED_ORIGINS,
             'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
-            'Access-Control-Allow-Headers': 'Content-Type',
+            'Access-Control-Allow-Headers': 'Content-Type, If-None-Match',
             'Access-Control-Max-Age': '3600'
         }
         return Response(status=204, headers=headers)
 
     cors_headers = {'Access-Control-Allow-Origin': ALLOWED_ORIGINS}
 
-    # Initialization Check
-    if firestore_init_error or gemini_initialization_error or not db or not gemini_model:
-        print(f"Responding 503 due to Init Error: Firestore={firestore_init_error}, Gemini={gemini_initialization_error}")
+    # Initialization Check (GET は Firestore のみ、POST は Gemini も待つ)
+    required_components = ('firestore', 'gemini') if request.method == 'POST' else ('firestore',)
+    with trace_span('init_wait'):
+        initialized = ensure_initialized(*required_components)
+    if not initialized:
+        logger.error("Responding 503 due to Init Error: Firestore=%s, Gemini=%s", firestore_init_error, gemini_initialization_error)
         return Response(status=503, response=json.dumps({'error': 'Service temporarily unavailable.'}), mimetype='application/json; charset=utf-8', headers=cors_headers)
 
     # =======================================
     # === Handle GET (Profile & History) ===
     # =======================================
+    if request.method == 'GET' and request.path.rstrip('/').endswith('/history'):
+        status, payload, headers = history_page_result(request.args, cors_headers)
+        return Response(status=status, response=encode_json(payload), mimetype='application/json; charset=utf-8', headers=headers)
+
     if request.method == 'GET':
         try:
             character_id = request.args.get('id')
             if not character_id: raise ValueError("Missing 'id' query parameter.")
-            print(f"GET profile & history: ID={character_id}")
+            trace_character(character_id)
+            logger.debug("GET profile & history: ID=%s", character_id)
+
+            # --- ★★★ 条件付き GET (ETag / 304) ★★★ ---
+            if_none_match = request.headers.get('If-None-Match')
+            profile_headers = dict(cors_headers)
+            profile_headers['Cache-Control'] = PROFILE_CACHE_CONTROL
+            profile_headers['Access-Control-Expose-Headers'] = 'ETag'
+
+            # キャッシュが新しければ Firestore を読まずに判定
+            with trace_span('profile_cache'):
+                cached_profile = profile_cache.get(character_id)
+            if cached_profile and etag_matches(if_none_match, cached_profile[0]):
+                logger.debug("Profile not modified (cached ETag %s), 304 without reads.", cached_profile[0])
+                profile_headers['ETag'] = cached_profile[0]
+                return Response(status=304, headers=profile_headers)
 
             char_doc_ref = db.collection(CHARACTERS_COLLECTION).document(character_id)
-            char_doc = char_doc_ref.get()
+            with trace_span('character_read'):
+                char_doc = char_doc_ref.get()
+            trace_count('firestoreReads')
 
             if not char_doc.exists:
                 raise ValueError(f"Character '{character_id}' not found.")
 
             char_data = char_doc.to_dict()
+            etag = make_profile_etag(char_data)
+            profile_headers['ETag'] = etag
+            if etag_matches(if_none_match, etag):
+                # 変更なし: 履歴は読まずに 304
+                logger.debug("Profile not modified (ETag %s), 304 without history read.", etag)
+                return Response(status=304, headers=profile_headers)
+            if cached_profile and cached_profile[0] == etag:
+                logger.debug("Profile cache hit for %s (ETag %s).", character_id, etag)
+                return Response(response=cached_profile[1], status=200, mimetype='application/json; charset=utf-8', headers=profile_headers)
 
             # --- ★★★ 履歴データの取得処理 ★★★ ---
-            history_data = load_history_for_frontend(character_id, limit=MAX_FRONTEND_HISTORY)
-            print(f"Loaded {len(history_data)} messages for frontend history.")
+            # キャッシュは ETag と同じ turnCount を反映している場合だけ使う (他インスタンスの保存後は読み直す)
+            with trace_span('history_load'):
+                try: history_data, history_cursor = load_history_for_frontend(character_id, limit=MAX_FRONTEND_HISTORY, turn_count=char_data.get('turnCount', 0))
+                except Exception as e: logger.exception("Error loading history for frontend: %s", e); history_data, history_cursor = None, None
+            logger.debug("Loaded %s messages for frontend history.", 'no' if history_data is None else len(history_data))
 
             # --- ★★★ 会話回数と上限を取得 ★★★ ---
             current_turn_count = char_data.get('turnCount', 0)
-            print(f"Current turn count for {character_id}: {current_turn_count}")
-
-            profile_data = {
-                'id': character_id,
-                'name': char_data.get('name', "名前未設定"),
-                'iconUrl': char_data.get('iconUrl'),
-                'profileText': char_data.get('profileText', "プロフィール未設定"),
-                'history': history_data,
-                # ★★★ 残り回数計算用に回数と上限をレスポンスに追加 ★★★
-                'currentTurnCount': current_turn_count,
-                'maxTurns': MAX_TOTAL_TURNS * 2 # フロントエンドはメッセージ数(turnCount)で計算するため2倍
-            }
-            print(f"Profile and history data found for {character_id}")
-            return Response(response=json.dumps(profile_data, ensure_ascii=False), status=200, mimetype='application/json; charset=utf-8', headers=cors_headers)
+            logger.debug("Current turn count for %s: %s", character_id, current_turn_count)
+
+            profile_body = build_profile_body(character_id, char_data, history_data or [], history_cursor)
+            # ★ 履歴を読めなかった本文はこの ETag でキャッシュしない (304 で空の履歴が固定されるため)。ブラウザにも保存させない
+            if history_data is not None: profile_cache.put(character_id, etag, profile_body)
+            else: profile_headers = uncacheable_profile_headers(profile_headers)
+            logger.debug("Profile and history data found for %s", character_id)
+            return Response(response=profile_body, status=200, mimetype='application/json; charset=utf-8', headers=profile_headers)
 
         except ValueError as e: # ID無し or 見つからない
-             print(f"GET Client Error/Not Found: {e}")
+             logger.info("GET Client Error/Not Found: %s", e)
              return Response(status=404, response=json.dumps({'error': str(e)}), mimetype='application/json; charset=utf-8', headers=cors_headers)
         except Exception as e: # その他のエラー
-            print(f"GET Error: {e}"); traceback.print_exc()
+            logger.exception("GET Error: %s", e)
             return Response(status=500, response=json.dumps({'error': 'Internal error processing profile and history.'}), mimetype='application/json; charset=utf-8', headers=cors_headers)
 
     # ===========================
     # === Handle POST (Chat) ===
     # ===========================
     elif request.method == 'POST':
-        character_id = None # finallyで使う可能性のため
         try:
             request_json = request.get_json(silent=True)
             if not request_json: raise ValueError("Invalid JSON.")
@@ -191,85 +506,87 @@ def handle_chat(request: Request) -> Response:
             character_id = request_json.get('id')
             if not user_message: raise ValueError("Missing 'message'.")
             if not character_id: raise ValueError("Missing 'id' (character_id).")
+            wants_stream = bool(request_json.get('stream')) or 'text/event-stream' in request.headers.get('Accept', '')
+            trace_character(character_id)
+        except ValueError as e:
+            logger.info("POST Client Error/Not Found: %s", e)
+            return Response(status=400, response=json.dumps({'error': str(e)}), mimetype='application/json; charset=utf-8', headers=cors_headers)
 
-            # --- Get Character Doc Ref (and check existence) ---
-            print(f"POST chat: Getting Character Ref: {character_id}")
-            char_doc_ref = db.collection(CHARACTERS_COLLECTION).document(character_id)
-            char_doc = char_doc_ref.get()
-            if not char_doc.exists:
-                raise PermissionError(f"Invalid 'id': Character '{character_id}' not found.")
+        # --- ★★★ 流量制限: 上限超過や同じキャラクターの処理待ちが多すぎる場合は 429 ★★★ ---
+        try:
+            turn_slot = admit_turn(character_id)
+        except RateLimitedError as e:
+            logger.info("Rate limited %s: %s (retry after %.1fs)", character_id, e, e.retry_after)
+            payload, limited_headers = rate_limited_result(e, cors_headers)
+            return Response(status=429, response=json.dumps(payload), mimetype='application/json; charset=utf-8', headers=limited_headers)
 
-            char_data = char_doc.to_dict()
+        stream_response = None
+        try:
+            # --- Reserve Turn (existence check + limit check + turnCount 更新を1トランザクションで) ---
+            logger.debug("POST chat: Reserving turn for Character: %s", character_id)
+            char_doc_ref = db.collection(CHARACTERS_COLLECTION).document(character_id)
+            try:
+                with trace_span('reserve_turn'):
+                    char_data, reserved_turn_count = reserve_conversation_turn(char_doc_ref)
+            except TurnLimitReachedError as limit_e:
+                logger.info("Limit reached for %s. Limit: %d turns.", character_id, MAX_TOTAL_TURNS)
+                return Response(status=403, response=json.dumps(limit_reached_payload(limit_e.current_turn_count)), mimetype='application/json; charset=utf-8', headers=cors_headers)
+            logger.debug("Turn reserved. Total messages after this turn: %d", reserved_turn_count)
 
-            # --- Conversation Limit Check ---
-            current_turn_count = char_data.get('turnCount', 0) # メッセージ総数
-            current_turn_number = current_turn_count // 2 # 往復数
-            print(f"Current turn number: {current_turn_number} (Total messages: {current_turn_count})")
-
-            if current_turn_number >= MAX_TOTAL_TURNS:
-                print(f"Limit reached for {character_id}. Limit: {MAX_TOTAL_TURNS} turns.")
-                # ★★★ 上限エラーレスポンスにも回数情報を含める ★★★
-                error_payload = {
-                    'error': f'Conversation limit of {MAX_TOTAL_TURNS} turns reached.',
-                    'code': 'LIMIT_REACHED',
-                    'currentTurnCount': current_turn_count,
-                    'maxTurns': MAX_TOTAL_TURNS * 2
-                }
-                print(f"DEBUG: Returning 403 with payload: {json.dumps(error_payload)}")
-                return Response(status=403, response=json.dumps(error_payload), mimetype='application/json; charset=utf-8', headers=cors_headers)
-
-            # --- Get Prompts & History (for Gemini) ---
-            system_prompt = char_data.get('systemPrompt', "あなたは親切なアシスタントです。")
-            memory_prompt = char_data.get('memoryPrompt')
-            print(f"Memory loaded: {'Yes' if memory_prompt else 'No'}")
-            final_system_instruction = system_prompt + (f"\n\n[会話相手に関する記憶]\n{memory_prompt}" if memory_prompt else "")
-
-            # Gemini APIに渡す用の履歴を読み込む
-            history_for_gemini = load_conversation_history_for_gemini(character_id, limit=MAX_HISTORY_TURNS * 2)
-            print(f"Loaded {len(history_for_gemini)} messages for Gemini history.")
-
-            # --- Call Gemini API ---
-            print(f"Generating chat content...")
-            ai_response_text = "エラーにより応答を生成できませんでした。" # Default in case of API error
             try:
-                # Per-request model init (inefficient but allows dynamic instruction)
-                instructed_model = genai.GenerativeModel(MODEL_NAME, system_instruction=final_system_instruction)
-                chat = instructed_model.start_chat(history=history_for_gemini)
-                response = chat.send_message(user_message)
-
-                if hasattr(response, 'text') and response.text:
-                    ai_response_text = response.text
-                elif hasattr(response, 'prompt_feedback') and response.prompt_feedback:
-                    ai_response_text = f"応答ブロック ({response.prompt_feedback.block_reason})。"
-                else:
-                    # 予期せぬ応答形式の場合
-                    print(f"Warning: Unexpected Gemini response structure: {response}")
-                    ai_response_text = "AIからの予期せぬ応答がありました。"
+                # --- Get Prompts & History (for Gemini) ---
+                system_prompt = char_data.get('systemPrompt', "あなたは親切なアシスタントです。")
+                memory_prompt = char_data.get('memoryPrompt')
+                logger.debug("Memory loaded: %s", 'Yes' if memory_prompt else 'No')
+
+                # Gemini APIに渡す用の履歴を読み込む (MAX_HISTORY_TURNS は候補の上限、実際の量はトークン予算で決める)
+                with trace_span('history_load'):
+                    history_for_gemini = load_conversation_history_for_gemini(character_id, limit=MAX_HISTORY_TURNS * 2, turn_count=reserved_turn_count - 2)
+                logger.debug("Loaded %d messages for Gemini history.", len(history_for_gemini))
+                has_older_history = len(history_for_gemini) >= MAX_HISTORY_TURNS * 2
+
+                # --- ★★★ トークン予算内にコンテキストを組み立てる ★★★ ---
+                with trace_span('context_build'):
+                    memory_prompt, history_for_gemini, context_usage = build_chat_context(system_prompt, memory_prompt, history_for_gemini, user_message, budget=chat_history_budget())
+                # --- ★★★ 履歴に入らなかった古い会話から、今の発言に関係するものだけを足す ★★★ ---
+                with trace_span('recall'):
+                    model_input = recall_into_message(character_id, user_message, context_usage, has_older_history)
+                logger.debug("Context tokens (estimated): %s", context_usage)
+
+                # --- Call Gemini API ---
+                # キャラクターのモデル (遅延・障害時は代替モデル) を選び、システム指示ごとにモデルをキャッシュ (メモリー更新時に無効化)
+                with trace_span('model_setup'):
+                    route = model_router.route(model_router.chat_model(char_data))
+                    model_cache.get_model(character_id, route[0], system_prompt, memory_prompt)
+                    send = chat_sender(character_id, route, system_prompt, memory_prompt, history_for_gemini, model_input)
+                if logger.isEnabledFor(logging.DEBUG): logger.debug("Model cache stats: %s", model_cache.stats())
+
+                # --- ★★★ ストリーミング応答 (SSE) ★★★ ---
+                # リクエストの 'stream': true または Accept: text/event-stream で有効化
+                if wants_stream:
+                    logger.debug("Streaming chat content (SSE)...")
+                    stream_headers = dict(cors_headers)
+                    stream_headers['Cache-Control'] = 'no-cache'
+                    stream_headers['X-Accel-Buffering'] = 'no' # プロキシでのバッファリングを抑止
+                    stream_response = Response(stream_chat_events(send, user_message, char_doc_ref, reserved_turn_count), status=200, mimetype='text/event-stream; charset=utf-8', headers=stream_headers)
+                    # ストリーム終了 (切断含む) まで同じキャラクターの次のターンを待たせる
+                    stream_response.call_on_close(turn_slot.release)
+                    return stream_response
+
+                logger.debug("Generating chat content...")
+                with trace_span('model_call'):
+                    response = send()
+                record_model_usage(response)
+                ai_response_text = reply_text_from_response(response)
 
             except Exception as api_e:
-                 print(f"Error during Gemini Chat Session: {api_e}"); traceback.print_exc()
-                 # Keep default error message or re-raise to be caught below
+                 logger.exception("Error during Gemini Chat Session: %s", api_e)
+                 # 応答を生成できなかったので予約したターンを返却する
+                 release_conversation_turn(char_doc_ref)
                  raise api_e # Let outer exception handler return 500
 
             # --- Save Turn & Trigger Summarization ---
-            new_total_message_count = current_turn_count # Initialize
-            try:
-                 new_total_message_count = save_conversation_turn(char_doc_ref, user_message, ai_response_text)
-                 print(f"Turn saved. New total message count: {new_total_message_count}")
-
-                 new_turn_number = new_total_message_count // 2
-                 print(f"New turn number: {new_turn_number}")
-                 if new_turn_number > 0 and new_turn_number % SUMMARIZE_INTERVAL == 0:
-                     print(f"--- Summarization Triggered (Turn {new_turn_number}) ---")
-                     try:
-                         print("Starting sync summary...");
-                         # Pass doc ref for potential efficiency later if summary needs char data
-                         summary = generate_memory_summary(char_doc_ref, SUMMARIZE_INTERVAL * 2)
-                         if summary: update_memory_prompt(char_doc_ref, summary)
-                         else: print("Summarization gave no result.")
-                     except Exception as summary_e: print(f"Error sync summary: {summary_e}"); traceback.print_exc()
-                     print(f"--- Summarization Finished ---")
-            except Exception as e: print(f"Error saving/summarizing: {e}"); traceback.print_exc()
+            new_total_message_count = finalize_conversation_turn(char_doc_ref, user_message, ai_response_text, reserved_turn_count)
 
             # --- Send Chat Response ---
             # ★★★ 応答データに更新後の回数と上限を追加 ★★★
@@ -278,19 +595,22 @@ def handle_chat(request: Request) -> Response:
                 'currentTurnCount': new_total_message_count,
                 'maxTurns': MAX_TOTAL_TURNS * 2
             }
-            return Response(response=json.dumps(response_data, ensure_ascii=False), status=200, mimetype='application/json; charset=utf-8', headers=cors_headers)
+            return Response(response=encode_json(response_data), status=200, mimetype='application/json; charset=utf-8', headers=cors_headers)
 
         # --- POST Error Handling ---
         except (ValueError, PermissionError) as e: # Bad request / ID not found
-            print(f"POST Client Error/Not Found: {e}")
+            logger.info("POST Client Error/Not Found: %s", e)
             status_code = 404 if isinstance(e, PermissionError) else 400
             return Response(status=status_code, response=json.dumps({'error': str(e)}), mimetype='application/json; charset=utf-8', headers=cors_headers)
+        except ModelCallError as e: # タイムアウト / 遮断中: 500 ではなく 503/504 で再試行の目安を返す
+            logger.warning("POST model unavailable: %s", e)
+            status_code, payload, error_headers = model_error_result(e, cors_headers)
+            return Response(status=status_code, response=json.dumps(payload, ensure_ascii=False), mimetype='application/json; charset=utf-8', headers=error_headers)
         except Exception as e: # Includes potential API errors raised from inner try
-            print(f"POST Processing Error: {e}"); traceback.print_exc()
-            error_message = 'サーバー内部でエラーが発生しました。' # More generic message
-            if "API key not valid" in str(e): error_message = "AIサービスでエラーが発生しました：APIキーが無効です。"
-            # Consider checking for other specific Gemini/API errors here
-            return Response(status=500, response=json.dumps({'error': error_message}), mimetype='application/json; charset=utf-8', headers=cors_headers)
+            logger.exception("POST Processing Error: %s", e)
+            return Response(status=500, response=json.dumps({'error': chat_error_message(e)}), mimetype='application/json; charset=utf-8', headers=cors_headers)
+        finally:
+            if stream_response is None: turn_slot.release()
 
     else: # Other methods
         return Response(status=405, response='Method Not Allowed', headers=cors_headers)
@@ -303,174 +623,2276 @@ def get_cell_value(data_dict: dict, field_name: str, default_value=None):
     value = data_dict.get(field_name)
     return value if value else default_value
 
-def save_conversation_turn(char_doc_ref: firestore.DocumentReference, user_msg: str, ai_msg: str) -> int:
-    """Saves messages to history subcollection and increments turn count."""
-    if not db or firestore_init_error: print("Firestore NA for saving."); return 0
+def encode_json(payload) -> bytes:
+    """Compact UTF-8 JSON (no spaces, non-ASCII as-is); uses orjson when available."""
+    if orjson is not None: return orjson.dumps(payload)
+    return json.dumps(payload, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+def negotiate_encoding(accept_encoding: str) -> str | None:
+    """Picks 'br' or 'gzip' from an Accept-Encoding header (highest q wins, br on a tie), or None."""
+    offered = {}
+    for part in accept_encoding.lower().split(','):
+        name, _, params = part.partition(';')
+        q = 1.0
+        for param in params.split(';'):
+            key, _, value = param.strip().partition('=')
+            if key == 'q':
+                try: q = float(value)
+                except ValueError: q = 0.0
+        if name.strip(): offered[name.strip()] = q
+    candidates = [encoding for encoding in (('br', 'gzip') if brotli else ('gzip',)) if offered.get(encoding, offered.get('*', 0)) > 0]
+    return max(candidates, key=lambda encoding: offered.get(encoding, offered.get('*', 0)), default=None)
+
+def compress_body(body: bytes, accept_encoding: str) -> tuple:
+    """Returns (body, encoding); encoding is None if the body is small or the client accepts neither."""
+    if len(body) < COMPRESSION_MIN_BYTES: return body, None
+    encoding = negotiate_encoding(accept_encoding)
+    if encoding is None: return body, None
+    with trace_span('compress'):
+        if encoding == 'br': return brotli.compress(body, quality=BROTLI_QUALITY), encoding
+        return gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0), encoding
+
+def apply_response_compression(response: Response, accept_encoding: str):
+    """Compresses a buffered 200 response in place (SSE streams are sent as-is so chunks are not held back)."""
+    if response.status_code != 200 or response.is_streamed or 'Content-Encoding' in response.headers: return
+    response.vary.add('Accept-Encoding')
+    body, encoding = compress_body(response.get_data(), accept_encoding)
+    if encoding is None: return
+    response.set_data(body)
+    response.headers['Content-Encoding'] = encoding
+
+def uncacheable_profile_headers(profile_headers: dict) -> dict:
+    """Headers for a profile body built without its history: no ETag, not stored by the browser."""
+    headers = {key: value for key, value in profile_headers.items() if key != 'ETag'}
+    headers['Cache-Control'] = 'no-store'
+    return headers
+
+def build_profile_body(character_id: str, char_data: dict, history_data: list, history_cursor: str | None = None) -> bytes:
+    """Serializes the GET profile response."""
+    profile_data = {
+        'id': character_id,
+        'name': char_data.get('name', "名前未設定"),
+        'profileText': char_data.get('profileText', "プロフィール未設定"),
+        'history': history_data, # 最新の1ページ分のみ
+        # ★★★ 残り回数計算用に回数と上限をレスポンスに追加 ★★★
+        'currentTurnCount': char_data.get('turnCount', 0),
+        'maxTurns': MAX_TOTAL_TURNS * 2 # フロントエンドはメッセージ数(turnCount)で計算するため2倍
+    }
+    # 値が無いフィールドは送らない (フロントエンドは未定義を「なし」として扱う)
+    if char_data.get('iconUrl'): profile_data['iconUrl'] = char_data['iconUrl']
+    if history_cursor: profile_data['historyCursor'] = history_cursor # より古い履歴がある場合、/history?before= に渡すカーソル
+    return encode_json(profile_data)
+
+def limit_reached_payload(current_turn_count: int) -> dict:
+    # ★★★ 上限エラーレスポンスにも回数情報を含める ★★★
+    return {
+        'error': f'Conversation limit of {MAX_TOTAL_TURNS} turns reached.',
+        'code': 'LIMIT_REACHED',
+        'currentTurnCount': current_turn_count,
+        'maxTurns': MAX_TOTAL_TURNS * 2
+    }
+
+def chat_error_message(e: Exception) -> str:
+    """User-facing message for a failed chat turn."""
+    if isinstance(e, ModelCallError): return e.user_message
+    if "API key not valid" in str(e): return "AIサービスでエラーが発生しました：APIキーが無効です。"
+    # Consider checking for other specific Gemini/API errors here
+    return 'サーバー内部でエラーが発生しました。' # More generic message
+
+def reply_text_from_response(response) -> str:
+    """Extracts the reply text from a (non-streaming) Gemini response, or a fallback message."""
+    if hasattr(response, 'text') and response.text:
+        return response.text
+    if hasattr(response, 'prompt_feedback') and response.prompt_feedback:
+        return f"応答ブロック ({response.prompt_feedback.block_reason})。"
+    # 予期せぬ応答形式の場合
+    logger.warning("Unexpected Gemini response structure: %s", response)
+    return "AIからの予期せぬ応答がありました。"
+
+def finalize_conversation_turn(char_doc_ref: firestore.DocumentReference, user_msg: str, ai_msg: str, reserved_turn_count: int) -> int:
+    """Saves the reserved turn and runs summarization if due. Returns the new total message count."""
+    new_total_message_count = reserved_turn_count # Initialize
     try:
-        history_ref = char_doc_ref.collection(HISTORY_SUBCOLLECTION)
-        timestamp_now = firestore.SERVER_TIMESTAMP # サーバータイムスタンプを使用
+         with trace_span('save_turn'):
+             new_total_message_count = save_conversation_turn(char_doc_ref, user_msg, ai_msg, reserved_turn_count)
+         logger.debug("Turn saved. New total message count: %d", new_total_message_count)
 
-        batch = db.batch()
-        user_doc_ref = history_ref.document(); batch.set(user_doc_ref, {'timestamp': timestamp_now, 'role': 'user', 'message': user_msg})
-        ai_doc_ref = history_ref.document(); batch.set(ai_doc_ref, {'timestamp': timestamp_now, 'role': 'model', 'message': ai_msg})
-        # Increment total message count by 2
-        batch.update(char_doc_ref, {'turnCount': firestore.Increment(2)})
-        batch.commit()
-
-        # 更新後のカウントを効率的に取得するのは難しい場合がある。
-        # Increment(2) を行った直後に get しても、反映されていない可能性がある。
-        # 確実性を求めるなら再度 get するが、パフォーマンスへの影響を考慮。
-        # ここではエラーハンドリングを優先し、再度取得する。
-        updated_doc = char_doc_ref.get()
-        if updated_doc.exists:
-            new_count = updated_doc.to_dict().get('turnCount', 0)
-            return new_count
+         if summary_due(new_total_message_count):
+             if ASYNC_SUMMARIZATION:
+                 with trace_span('summary_enqueue'):
+                     summary_job_queue.enqueue(char_doc_ref.id)
+             else:
+                 with trace_span('summary'):
+                     run_summary_job(char_doc_ref.id)
+    except Exception as e: logger.exception("Error saving/summarizing: %s", e)
+    return new_total_message_count
+
+def summary_due(total_message_count: int) -> bool:
+    new_turn_number = total_message_count // 2
+    if new_turn_number > 0 and new_turn_number % SUMMARIZE_INTERVAL == 0:
+        logger.info("Summarization Triggered (Turn %d)", new_turn_number)
+        return True
+    return False
+
+def run_summary_job(character_id: str):
+    """Summarizes recent history for one character and stores it as memoryPrompt."""
+    # 同期実行時は呼び出し元リクエストのトレースに合算、ワーカーからは独自のトレースで記録
+    trace = RequestTrace('summary_job') if _current_trace.get() is None else None
+    token = _current_trace.set(trace) if trace else None
+    trace_character(character_id)
+    status = 'error'
+    try:
+        logger.debug("Starting summary for %s...", character_id)
+        char_doc_ref = db.collection(CHARACTERS_COLLECTION).document(character_id)
+        result = generate_memory_summary(char_doc_ref, SUMMARIZE_INTERVAL * 2)
+        if result:
+            summary, summarized_through = result
+            update_memory_prompt(char_doc_ref, summary, summarized_through)
+            status = 'ok'
         else:
-             print(f"Warning: Failed to refetch document after saving turn for {char_doc_ref.id}")
-             # ここで元々のカウント+2を返すことも検討できるが、確実ではない
-             # 取得失敗時は 0 を返すようにしておく
-             return 0
+            logger.info("Summarization gave no result.")
+            status = 'empty'
+    except Exception as summary_e: logger.exception("Error summary job: %s", summary_e); raise
+    finally:
+        if trace:
+            _current_trace.reset(token)
+            trace.finish(status)
 
-    except Exception as e: print(f"Error saving turn: {e}"); traceback.print_exc(); return 0
+def format_sse_event(event: str, payload: dict) -> str:
+    """Formats one Server-Sent Events frame with a JSON data line."""
+    return f"event: {event}\ndata: {encode_json(payload).decode('utf-8')}\n\n"
 
+def stream_chat_events(send, user_msg: str, char_doc_ref: firestore.DocumentReference, reserved_turn_count: int):
+    """Yields SSE frames for each Gemini chunk, then saves the full turn after the stream closes.
 
-# --- ★★★ 履歴読み込み関数 (変更なし) ★★★ ---
+    send is a chat_sender(); the call is retried/hedged/rerouted only until the first chunk arrives."""
+    # ジェネレーターは handle_chat が戻った後に実行されるので、ここで現在のトレースを引き継ぐ
+    trace = _current_trace.get()
+    if trace is not None: trace.streaming = True
+    return _ReservedTurnStream(trace, _stream_chat_events(trace, send, user_msg, char_doc_ref, reserved_turn_count), char_doc_ref)
 
-def load_conversation_history_for_gemini(character_id: str, limit: int = 100) -> list:
-    """Loads last N messages from Firestore, formatted for Gemini API."""
-    if not db or firestore_init_error: return []
+class _ReservedTurnStream:
+    """Iterates the SSE generator; if the response is closed before the first frame, gives back the reserved turn.
+
+    Once started, the generator itself saves or releases the turn and finishes the trace."""
+
+    def __init__(self, trace, events, char_doc_ref: firestore.DocumentReference):
+        self._trace = trace
+        self._events = events
+        self._char_doc_ref = char_doc_ref
+        self._started = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        self._started = True
+        return next(self._events)
+
+    def close(self):
+        self._events.close()
+        if self._started: return
+        self._started = True
+        # ★ 一度も実行されなかったジェネレーターは close() で本体が走らないので、ここで予約を返却する
+        token = _current_trace.set(self._trace)
+        try:
+            logger.info("Stream for %s closed before it started.", self._char_doc_ref.id)
+            release_conversation_turn(self._char_doc_ref)
+        finally:
+            _current_trace.reset(token)
+            if self._trace is not None: self._trace.finish(200, stream='disconnected')
+
+def _stream_chat_events(trace, send, user_msg: str, char_doc_ref: firestore.DocumentReference, reserved_turn_count: int):
+    token = _current_trace.set(trace)
+    status = 'error'
+    try:
+        yield from _stream_chat_frames(send, user_msg, char_doc_ref, reserved_turn_count)
+        status = 'ok'
+    except GeneratorExit:
+        status = 'disconnected'
+        raise
+    finally:
+        _current_trace.reset(token)
+        if trace is not None: trace.finish(200, stream=status)
+
+def _stream_chat_frames(send, user_msg: str, char_doc_ref: firestore.DocumentReference, reserved_turn_count: int):
+    reply_parts = []
+    stream_start = time.perf_counter()
+    first_chunk_ms = None
     try:
-        print(f"Loading history for Gemini from Firestore for {character_id}, limit {limit}")
-        history_ref = db.collection(CHARACTERS_COLLECTION).document(character_id).collection(HISTORY_SUBCOLLECTION)
-        # Gemini 用は最新の会話が必要なので DESCENDING
-        query = history_ref.order_by('timestamp', direction=firestore.Query.DESCENDING).limit(limit)
-        docs = query.stream()
-        raw_history = [doc.to_dict() for doc in docs]
-        formatted_history = []
-        # Reverse the list so oldest is first for Gemini format
-        for entry in reversed(raw_history):
-            role = entry.get('role')
-            message = entry.get('message')
-            # タイムスタンプの存在もチェック（古いデータにない可能性）
-            timestamp = entry.get('timestamp')
-            if role in ['user', 'model'] and message is not None and timestamp is not None:
-                formatted_history.append({'role': role, 'parts': [{'text': str(message)}]})
+        with trace_span('model_stream'):
+            # SDK は最初のチャンクを受け取ってから戻るので、タイムアウトは最初のチャンクまでに掛かる
+            response = send(stream=True)
+        for chunk in response:
+            if first_chunk_ms is None: first_chunk_ms = (time.perf_counter() - stream_start) * 1000
+            try:
+                chunk_text = chunk.text
+            except ValueError: # ブロックされたチャンクは text を持たない
+                chunk_text = None
+            if chunk_text:
+                reply_parts.append(chunk_text)
+                yield format_sse_event('delta', {'text': chunk_text})
+
+        ai_response_text = "".join(reply_parts)
+        if not ai_response_text:
+            if getattr(response, 'prompt_feedback', None):
+                ai_response_text = f"応答ブロック ({response.prompt_feedback.block_reason})。"
             else:
-                print(f"Skipping history entry due to missing field: {entry}")
-
-        # Ensure history ends with 'model' role for chat session start if needed by Gemini (often handled by library)
-        # The genai library typically handles the turn order automatically. Let's remove the pop logic for now.
-        # if formatted_history and formatted_history[-1]['role'] == 'user':
-        #     print("Popping last user message from history for chat session.")
-        #     formatted_history.pop()
-        print(f"Loaded and formatted {len(formatted_history)} messages for Gemini session.")
-        return formatted_history
-    except Exception as e: print(f"Error loading history for Gemini: {e}"); traceback.print_exc(); return []
+                logger.warning("Unexpected Gemini stream structure: %s", response)
+                ai_response_text = "AIからの予期せぬ応答がありました。"
+            yield format_sse_event('delta', {'text': ai_response_text})
+        record_model_usage(response)
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.spans['model_stream'] = round((time.perf_counter() - stream_start) * 1000, 2)
+            if first_chunk_ms is not None: trace.spans['model_first_chunk'] = round(first_chunk_ms, 2)
+    except GeneratorExit: # クライアントが途中で切断した場合は保存せず予約を返却
+        logger.info("Client disconnected during stream for %s.", char_doc_ref.id)
+        release_conversation_turn(char_doc_ref)
+        raise
+    except Exception as api_e:
+        logger.exception("Error during Gemini Chat Stream: %s", api_e)
+        release_conversation_turn(char_doc_ref)
+        yield format_sse_event('error', {'error': chat_error_message(api_e)})
+        return
+
+    # ストリーム完了後に会話を保存 (非ストリーミング時と同じ処理)
+    new_total_message_count = finalize_conversation_turn(char_doc_ref, user_msg, ai_response_text, reserved_turn_count)
+    yield format_sse_event('done', {
+        'currentTurnCount': new_total_message_count,
+        'maxTurns': MAX_TOTAL_TURNS * 2
+    })
+
+class TurnLimitReachedError(Exception):
+    """Raised by reserve_conversation_turn when MAX_TOTAL_TURNS is used up."""
+    def __init__(self, current_turn_count: int):
+        super().__init__(f"Conversation limit of {MAX_TOTAL_TURNS} turns reached.")
+        self.current_turn_count = current_turn_count
+
+@firestore.transactional
+def _reserve_turn_in_transaction(transaction, char_doc_ref: firestore.DocumentReference) -> tuple:
+    char_doc = char_doc_ref.get(transaction=transaction)
+    return _apply_turn_reservation(transaction, char_doc_ref, char_doc)
+
+def _apply_turn_reservation(transaction, char_doc_ref, char_doc) -> tuple:
+    if not char_doc.exists:
+        raise PermissionError(f"Invalid 'id': Character '{char_doc_ref.id}' not found.")
+    char_data = char_doc.to_dict()
+    current_turn_count = char_data.get('turnCount', 0) # メッセージ総数
+    if current_turn_count // 2 >= MAX_TOTAL_TURNS: # 往復数で判定
+        raise TurnLimitReachedError(current_turn_count)
+    new_turn_count = current_turn_count + 2
+    transaction.update(char_doc_ref, {'turnCount': new_turn_count})
+    return char_data, new_turn_count
+
+def reserve_conversation_turn(char_doc_ref: firestore.DocumentReference) -> tuple:
+    """Reads the character, enforces MAX_TOTAL_TURNS and reserves 2 messages on turnCount in one transaction.
+
+    Returns (character data, new total message count). Concurrent requests cannot both pass the limit."""
+    result = _reserve_turn_in_transaction(db.transaction(), char_doc_ref)
+    trace_count('firestoreReads'); trace_count('firestoreWrites')
+    profile_cache.invalidate(char_doc_ref.id) # turnCount が変わったので ETag も変わる
+    return result
+
+def release_conversation_turn(char_doc_ref: firestore.DocumentReference):
+    """Gives back a reserved turn when no reply could be generated or saved."""
+    try:
+        char_doc_ref.update({'turnCount': firestore.Increment(-2)})
+        trace_count('firestoreWrites')
+        profile_cache.invalidate(char_doc_ref.id)
+        logger.info("Released reserved turn for %s.", char_doc_ref.id)
+    except Exception as e: logger.exception("Error releasing turn: %s", e)
+
+def save_conversation_turn(char_doc_ref: firestore.DocumentReference, user_msg: str, ai_msg: str, reserved_turn_count: int) -> int:
+    """Saves messages to history subcollection for a turn reserved by reserve_conversation_turn.
+
+    Returns the total message count (no re-read needed: the count was fixed at reservation)."""
+    if not db or firestore_init_error: logger.error("Firestore NA for saving."); return 0
+    try:
+        committed_at = conversation_store.save_turn(char_doc_ref.id, user_msg, ai_msg, reserved_turn_count)
+        _record_saved_turn(char_doc_ref.id, committed_at, user_msg, ai_msg, reserved_turn_count)
+        return reserved_turn_count
+
+    except Exception as e:
+        logger.exception("Error saving turn: %s", e)
+        release_conversation_turn(char_doc_ref)
+        return reserved_turn_count - 2
+
+def _record_saved_turn(character_id: str, committed_at, user_msg: str, ai_msg: str, turn_count: int):
+    # ★ 履歴キャッシュへ書き込み (write-through)。保存形式が記録したタイムスタンプと、保存後の turnCount を使う
+    history_cache.append(character_id, [
+        {'timestamp': committed_at, 'role': 'user', 'message': user_msg},
+        {'timestamp': committed_at, 'role': 'model', 'message': ai_msg},
+    ], turn_count)
+    profile_cache.invalidate(character_id)
+
+
+# --- ★★★ 会話履歴キャッシュ (インスタンス内 LRU + TTL) ★★★ ---
+class HistoryCache:
+    """Recent history per character (raw entries, oldest first), LRU-bounded with a TTL.
+
+    Both history loaders project from the same cached list; save_conversation_turn appends to it.
+    Each list is tagged with the turnCount it reflects, so a turn saved by another instance shows up as a miss."""
+
+    def __init__(self, max_characters: int, ttl_seconds: float, max_messages: int):
+        self.max_characters = max_characters
+        self.ttl_seconds = ttl_seconds
+        self.max_messages = max_messages
+        self._lock = threading.Lock()
+        self._entries = OrderedDict() # character_id -> (loaded_at, [entry, ...], turnCount or None)
+        self._stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'expired': 0, 'stale': 0}
+
+    def get(self, character_id: str, turn_count: int | None = None, in_flight: bool = False) -> list | None:
+        """Cached entries, or None on a miss. With turn_count, a list tagged with a different count is a miss.
+
+        in_flight: a turn is reserved but not yet saved on this instance, so a list without it (turn_count - 2) also matches."""
+        with self._lock:
+            cached = self._entries.get(character_id)
+            if cached is not None and time.monotonic() - cached[0] > self.ttl_seconds:
+                # 他インスタンスの書き込みを取りこぼさないよう、一定時間で読み直す
+                del self._entries[character_id]
+                self._stats['expired'] += 1
+                cached = None
+            if cached is not None and turn_count is not None and cached[2] != turn_count and not (in_flight and cached[2] == turn_count - 2):
+                # ★ 他インスタンスが保存したターンが含まれていない (turnCount が合わない) ので読み直す。
+                # 保存前の予約中ターンでも合わないので削除はしない (書き込み側が append で更新する。POST は put で置き換える)
+                self._stats['stale'] += 1
+                cached = None
+            if cached is None:
+                self._stats['misses'] += 1
+                return None
+            self._entries.move_to_end(character_id)
+            self._stats['hits'] += 1
+            return list(cached[1])
+
+    def put(self, character_id: str, entries: list, turn_count: int | None = None):
+        with self._lock:
+            self._entries[character_id] = (time.monotonic(), list(entries[-self.max_messages:]), turn_count)
+            self._entries.move_to_end(character_id)
+            while len(self._entries) > self.max_characters:
+                self._entries.popitem(last=False)
+                self._stats['evictions'] += 1
+
+    def append(self, character_id: str, new_entries: list, turn_count: int | None = None):
+        """Write-through for a saved turn (turn_count: the count after it); no-op if the character is not cached."""
+        with self._lock:
+            cached = self._entries.get(character_id)
+            if cached is None: return
+            entries = (cached[1] + list(new_entries))[-self.max_messages:]
+            self._entries[character_id] = (cached[0], entries, turn_count)
+            self._entries.move_to_end(character_id)
+
+    def __contains__(self, character_id: str) -> bool:
+        with self._lock:
+            return character_id in self._entries
+
+    def confirm(self, character_id: str, turn_count: int) -> bool:
+        """Checks a list read before the turnCount was known: False (and dropped) if it reflects another count.
+
+        An untagged list (loaded concurrently with the reservation) takes the count."""
+        with self._lock:
+            cached = self._entries.get(character_id)
+            if cached is None or cached[2] == turn_count: return True
+            if cached[2] is None:
+                self._entries[character_id] = (cached[0], cached[1], turn_count)
+                return True
+            del self._entries[character_id]
+            self._stats['stale'] += 1
+            return False
+
+    def invalidate(self, character_id: str):
+        with self._lock:
+            self._entries.pop(character_id, None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'size': len(self._entries), **self._stats}
+
+history_cache = HistoryCache(HISTORY_CACHE_MAX_CHARACTERS, HISTORY_CACHE_TTL_SECONDS, max(MAX_HISTORY_TURNS * 2, MAX_FRONTEND_HISTORY))
+
+
+# --- ★★★ プロフィール応答キャッシュ (ETag) ★★★ ---
+def make_profile_etag(char_data: dict) -> str:
+    """Weak ETag from turnCount plus a hash of the profile fields, memory and last save (profileVersion bumps it manually)."""
+    version_source = "\0".join(str(char_data.get(field) or "") for field in ('name', 'iconUrl', 'profileText', 'memoryPrompt', 'lastMessageAt', 'profileVersion'))
+    version = hashlib.sha256(version_source.encode("utf-8")).hexdigest()[:16]
+    return f'W/"{char_data.get("turnCount", 0)}-{version}"'
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    """Weak comparison of an If-None-Match header against an ETag."""
+    if not if_none_match: return False
+    candidates = [candidate.strip() for candidate in if_none_match.split(',')]
+    if '*' in candidates: return True
+    return any(candidate.removeprefix('W/') == etag.removeprefix('W/') for candidate in candidates)
+
+class ProfileCache:
+    """Serialized GET profile responses per character with their ETag, LRU-bounded with a TTL."""
+
+    def __init__(self, max_characters: int, ttl_seconds: float):
+        self.max_characters = max_characters
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._entries = OrderedDict() # character_id -> (cached_at, etag, body bytes)
+
+    def get(self, character_id: str) -> tuple | None:
+        """Returns (etag, body) if cached and fresh."""
+        with self._lock:
+            cached = self._entries.get(character_id)
+            if cached is None: return None
+            if time.monotonic() - cached[0] > self.ttl_seconds:
+                del self._entries[character_id]
+                return None
+            self._entries.move_to_end(character_id)
+            return cached[1], cached[2]
+
+    def put(self, character_id: str, etag: str, body: bytes):
+        with self._lock:
+            self._entries[character_id] = (time.monotonic(), etag, body)
+            self._entries.move_to_end(character_id)
+            while len(self._entries) > self.max_characters:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, character_id: str):
+        with self._lock:
+            self._entries.pop(character_id, None)
+
+profile_cache = ProfileCache(PROFILE_CACHE_MAX_CHARACTERS, PROFILE_CACHE_TTL_SECONDS)
+
+
+# --- ★★★ 流量制限 (トークンバケット + キャラクターごとの直列化) ★★★ ---
+# どちらもインスタンス内の状態なので、複数インスタンスにまたがる上限ではない (最終的な上限は MAX_TOTAL_TURNS のトランザクション)。
+class RateLimitedError(Exception):
+    """Raised when a turn is not admitted right now; retry_after is in seconds."""
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class CharacterRateLimiter:
+    """Token bucket per character, LRU-bounded."""
+
+    def __init__(self, burst: int, per_minute: float, max_characters: int):
+        self.burst = burst
+        self.refill_per_second = per_minute / 60
+        self.max_characters = max_characters
+        self._lock = threading.Lock()
+        self._buckets = OrderedDict() # character_id -> (tokens, updated_at)
+        self._stats = {'allowed': 0, 'limited': 0}
+
+    def check(self, character_id: str):
+        """Takes one token or raises RateLimitedError with the time until the next one."""
+        if self.burst <= 0 or self.refill_per_second <= 0: return
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated_at = self._buckets.pop(character_id, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated_at) * self.refill_per_second)
+            allowed = tokens >= 1
+            if allowed: tokens -= 1
+            self._buckets[character_id] = (tokens, now)
+            while len(self._buckets) > self.max_characters:
+                self._buckets.popitem(last=False)
+            self._stats['allowed' if allowed else 'limited'] += 1
+        if not allowed:
+            raise RateLimitedError("Too many messages for this character.", (1 - tokens) / self.refill_per_second)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'size': len(self._buckets), **self._stats}
+
+class TurnSlot:
+    """The right to run one turn for a character; release() is idempotent."""
+
+    def __init__(self, gate, character_id: str, is_async: bool):
+        self._gate = gate
+        self.character_id = character_id
+        self._is_async = is_async
+        self._acquired_at = time.monotonic()
+        self._released = False
+
+    def release(self):
+        if self._released: return
+        self._released = True
+        self._gate._release(self, time.monotonic() - self._acquired_at)
+
+class TurnGate:
+    """Single-flight per character: one turn runs, up to max_waiters queue behind it, the rest get RateLimitedError.
+
+    acquire() is for the threaded server and acquire_async() for the ASGI event loop; the two keep separate queues."""
+
+    def __init__(self, max_waiters: int, wait_seconds: float):
+        self.max_waiters = max_waiters
+        self.wait_seconds = wait_seconds
+        self._cond = threading.Condition()
+        self._entries = {} # character_id -> [busy, waiters]
+        self._async_entries = {} # character_id -> [asyncio.Lock, waiters]
+        self._avg_turn_seconds = 5.0 # Retry-After の目安 (ターン所要時間の移動平均)
+        self._stats = {'immediate': 0, 'queued': 0, 'rejected': 0, 'timeouts': 0}
+
+    def busy(self, character_id: str) -> bool:
+        """True while a turn for the character holds its slot on this instance."""
+        async_entry = self._async_entries.get(character_id)
+        if async_entry is not None and async_entry[0].locked(): return True
+        with self._cond:
+            entry = self._entries.get(character_id)
+            return entry is not None and entry[0]
+
+    def _busy_error(self, waiters: int) -> RateLimitedError:
+        return RateLimitedError("Another message for this character is still being processed.", self._avg_turn_seconds * (waiters + 1))
+
+    def acquire(self, character_id: str) -> TurnSlot:
+        deadline = time.monotonic() + self.wait_seconds
+        with self._cond:
+            entry = self._entries.setdefault(character_id, [False, 0])
+            if not entry[0]:
+                entry[0] = True
+                self._stats['immediate'] += 1
+                return TurnSlot(self, character_id, False)
+            if entry[1] >= self.max_waiters:
+                self._stats['rejected'] += 1
+                raise self._busy_error(entry[1])
+            entry[1] += 1
+            self._stats['queued'] += 1
+            try:
+                while entry[0]:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._stats['timeouts'] += 1
+                        raise self._busy_error(entry[1] - 1)
+                    self._cond.wait(remaining)
+                entry[0] = True
+            finally:
+                entry[1] -= 1
+        return TurnSlot(self, character_id, False)
+
+    async def acquire_async(self, character_id: str) -> TurnSlot:
+        entry = self._async_entries.get(character_id)
+        if entry is None:
+            entry = self._async_entries[character_id] = [asyncio.Lock(), 0]
+        lock = entry[0]
+        if not lock.locked():
+            await lock.acquire() # 空いていれば待たずに取れる
+            self._stats['immediate'] += 1
+            return TurnSlot(self, character_id, True)
+        if entry[1] >= self.max_waiters:
+            self._stats['rejected'] += 1
+            raise self._busy_error(entry[1])
+        entry[1] += 1
+        self._stats['queued'] += 1
+        try:
+            await asyncio.wait_for(lock.acquire(), self.wait_seconds)
+        except asyncio.TimeoutError:
+            self._stats['timeouts'] += 1
+            raise self._busy_error(entry[1] - 1) from None
+        finally:
+            entry[1] -= 1
+        return TurnSlot(self, character_id, True)
+
+    def _release(self, slot: TurnSlot, held_seconds: float):
+        if slot._is_async:
+            entry = self._async_entries.get(slot.character_id)
+            if entry is None: return
+            entry[0].release()
+            if entry[1] == 0: del self._async_entries[slot.character_id]
+        else:
+            with self._cond:
+                entry = self._entries.get(slot.character_id)
+                if entry is None: return
+                entry[0] = False
+                if entry[1] == 0: del self._entries[slot.character_id]
+                else: self._cond.notify_all()
+        self._avg_turn_seconds = 0.8 * self._avg_turn_seconds + 0.2 * held_seconds
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {'active': len(self._entries) + len(self._async_entries), 'avgTurnSeconds': round(self._avg_turn_seconds, 3), **self._stats}
+
+rate_limiter = CharacterRateLimiter(RATE_LIMIT_BURST, RATE_LIMIT_PER_MINUTE, RATE_LIMIT_MAX_CHARACTERS)
+turn_gate = TurnGate(TURN_QUEUE_MAX_WAITERS, TURN_QUEUE_WAIT_SECONDS)
+
+def rate_limited_result(e: RateLimitedError, cors_headers: dict) -> tuple:
+    """429 payload and headers (Retry-After in whole seconds, exposed to the browser)."""
+    retry_after = max(1, math.ceil(e.retry_after))
+    headers = {**cors_headers, 'Retry-After': str(retry_after), 'Access-Control-Expose-Headers': 'Retry-After'}
+    return {'error': str(e), 'code': 'RATE_LIMITED', 'retryAfter': retry_after}, headers
+
+def admit_turn(character_id: str) -> TurnSlot:
+    """Rate limit, then wait for the character's turn slot. Raises RateLimitedError."""
+    with trace_span('admission'):
+        rate_limiter.check(character_id)
+        return turn_gate.acquire(character_id)
+
+async def admit_turn_async(character_id: str) -> TurnSlot:
+    with trace_span('admission'):
+        rate_limiter.check(character_id)
+        return await turn_gate.acquire_async(character_id)
+
+class _SlotReleasingStream:
+    """Wraps an SSE async iterator so the turn slot is freed when it finishes or is closed (even if never started).
+
+    Closing it before the first frame also gives back the reserved turn, which the generator would otherwise release."""
+
+    def __init__(self, events, slot: TurnSlot, char_doc_ref):
+        self._events = events
+        self._slot = slot
+        self._char_doc_ref = char_doc_ref
+        self._started = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        self._started = True
+        try:
+            return await self._events.__anext__()
+        except BaseException:
+            self._slot.release()
+            raise
+
+    async def aclose(self):
+        try:
+            await self._events.aclose()
+            if not self._started:
+                self._started = True
+                logger.info("Stream for %s closed before it started.", self._char_doc_ref.id)
+                await release_conversation_turn_async(self._char_doc_ref)
+        finally:
+            self._slot.release()
+
+# --- ★★★ 会話履歴ストレージ (レイアウト切り替え) ★★★ ---
+# HISTORY_STORE で保存形式を選ぶ:
+#   'messages': characters/{id}/history にメッセージ1件=1ドキュメント (従来形式)
+#   'buckets' : characters/{id}/historyBuckets にメッセージを HISTORY_BUCKET_SIZE 件ずつまとめて保存。
+#               直近の履歴は 1〜2 ドキュメントの読み込み、1ターンの保存は 2 書き込み (バケット + キャラクター)
+#   'sqlite'  : 履歴をローカルの SQLite に保存 (開発・検証用。キャラクター/メモリーは Firestore のまま)
+# どの形式でもキャッシュ・要約カーソル・ETag の扱いは共通。
+class ConversationStore:
+    """History storage interface. Entries are dicts (timestamp, role, message), oldest first."""
+
+    def load_recent(self, character_id: str, limit: int) -> list:
+        raise NotImplementedError
+
+    def load_since(self, character_id: str, since, limit: int) -> list:
+        """Entries with timestamp > since, oldest first, at most `limit`."""
+        raise NotImplementedError
+
+    def load_before(self, character_id: str, before, limit: int) -> list:
+        """The newest `limit` entries with timestamp < before (newest overall if None), oldest first."""
+        raise NotImplementedError
+
+    def save_turn(self, character_id: str, user_msg: str, ai_msg: str, reserved_turn_count: int):
+        """Stores one user/model pair and returns the timestamp recorded for both."""
+        raise NotImplementedError
+
+    async def load_recent_async(self, character_id: str, limit: int) -> list:
+        return await asyncio.to_thread(self.load_recent, character_id, limit)
+
+    async def load_before_async(self, character_id: str, before, limit: int) -> list:
+        if before is None: return await self.load_recent_async(character_id, limit)
+        return await asyncio.to_thread(self.load_before, character_id, before, limit)
+
+    async def save_turn_async(self, character_id: str, user_msg: str, ai_msg: str, reserved_turn_count: int):
+        return await asyncio.to_thread(self.save_turn, character_id, user_msg, ai_msg, reserved_turn_count)
+
+    def update_memory(self, character_id: str, summary_text: str, summarized_through=None):
+        # メモリーは形式によらずキャラクタードキュメントに保存 (チャット時の予約トランザクションで一緒に読まれる)
+        update_data = {'memoryPrompt': summary_text}
+        if summarized_through is not None: update_data['lastSummarizedAt'] = summarized_through
+        db.collection(CHARACTERS_COLLECTION).document(character_id).update(update_data)
+        trace_count('firestoreWrites')
+
+class _FirestoreStore(ConversationStore):
+    """Shared sync/async plumbing; subclasses build the queries and the batch."""
+
+    def _recent_query(self, client, character_id: str, limit: int): raise NotImplementedError
+    def _entries_from_recent(self, docs: list, limit: int) -> list: raise NotImplementedError
+    def _stage_turn(self, client, batch, character_id: str, user_msg: str, ai_msg: str, reserved_turn_count: int): raise NotImplementedError
+    write_count = 3
+
+    def load_recent(self, character_id: str, limit: int) -> list:
+        docs = list(self._recent_query(db, character_id, limit).stream())
+        trace_count('firestoreReads', max(1, len(docs))) # 0件のクエリも1読み取りとして課金される
+        return self._entries_from_recent(docs, limit)
+
+    async def load_recent_async(self, character_id: str, limit: int) -> list:
+        docs = [doc async for doc in self._recent_query(async_db, character_id, limit).stream()]
+        trace_count('firestoreReads', max(1, len(docs)))
+        return self._entries_from_recent(docs, limit)
+
+    def save_turn(self, character_id: str, user_msg: str, ai_msg: str, reserved_turn_count: int):
+        batch = db.batch()
+        timestamp = self._stage_turn(db, batch, character_id, user_msg, ai_msg, reserved_turn_count)
+        write_results = batch.commit()
+        trace_count('firestoreWrites', self.write_count)
+        return self._committed_at(timestamp, write_results)
+
+    async def save_turn_async(self, character_id: str, user_msg: str, ai_msg: str, reserved_turn_count: int):
+        batch = async_db.batch()
+        timestamp = self._stage_turn(async_db, batch, character_id, user_msg, ai_msg, reserved_turn_count)
+        write_results = await batch.commit()
+        trace_count('firestoreWrites', self.write_count)
+        return self._committed_at(timestamp, write_results)
+
+    @staticmethod
+    def _committed_at(timestamp, write_results):
+        if timestamp is not firestore.SERVER_TIMESTAMP: return timestamp
+        # SERVER_TIMESTAMP はコミット時刻と一致する
+        committed_at = getattr(write_results[0], 'update_time', None) if write_results else None
+        return committed_at or datetime.now(timezone.utc)
+
+class FirestoreMessageStore(_FirestoreStore):
+    """One document per message in characters/{id}/history (the original layout)."""
+
+    def _history_ref(self, client, character_id: str):
+        return client.collection(CHARACTERS_COLLECTION).document(character_id).collection(HISTORY_SUBCOLLECTION)
+
+    def _recent_query(self, client, character_id: str, limit: int):
+        # 最新の会話が必要なので DESCENDING で取得し、Python 側で古い順に並べ替える
+        return self._history_ref(client, character_id).order_by('timestamp', direction=firestore.Query.DESCENDING).limit(limit)
+
+    def _entries_from_recent(self, docs: list, limit: int) -> list:
+        return [doc.to_dict() for doc in reversed(docs)]
+
+    def load_since(self, character_id: str, since, limit: int) -> list:
+        query = self._history_ref(db, character_id).where(filter=FieldFilter('timestamp', '>', since)).order_by('timestamp', direction=firestore.Query.ASCENDING).limit(limit)
+        entries = [doc.to_dict() for doc in query.stream()]
+        trace_count('firestoreReads', max(1, len(entries)))
+        return entries
+
+    def load_before(self, character_id: str, before, limit: int) -> list:
+        if before is None: return self.load_recent(character_id, limit)
+        query = self._history_ref(db, character_id).where(filter=FieldFilter('timestamp', '<', before)).order_by('timestamp', direction=firestore.Query.DESCENDING).limit(limit)
+        entries = [doc.to_dict() for doc in query.stream()]
+        trace_count('firestoreReads', max(1, len(entries)))
+        return list(reversed(entries))
+
+    def _stage_turn(self, client, batch, character_id: str, user_msg: str, ai_msg: str, reserved_turn_count: int):
+        char_doc_ref = client.collection(CHARACTERS_COLLECTION).document(character_id)
+        history_ref = char_doc_ref.collection(HISTORY_SUBCOLLECTION)
+        timestamp_now = firestore.SERVER_TIMESTAMP # サーバータイムスタンプを使用
+        batch.set(history_ref.document(), {'timestamp': timestamp_now, 'role': 'user', 'message': user_msg})
+        batch.set(history_ref.document(), {'timestamp': timestamp_now, 'role': 'model', 'message': ai_msg})
+        # ETag 用: 履歴の保存時刻 (turnCount は予約時点で更新済みのため、保存完了を区別する)
+        batch.update(char_doc_ref, {'lastMessageAt': timestamp_now})
+        return timestamp_now
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+class FirestoreBucketStore(_FirestoreStore):
+    """HISTORY_BUCKET_SIZE messages per document in characters/{id}/historyBuckets/{seq}.
+
+    The bucket is derived from the message index fixed at turn reservation (turnCount), so concurrent
+    turns need no extra read; each append is an ArrayUnion. Array elements cannot hold SERVER_TIMESTAMP,
+    so messages carry the saving instance's clock."""
+    write_count = 2
+
+    def __init__(self, bucket_size: int = 50, legacy_fallback: bool = True):
+        if bucket_size % 2: raise ValueError("bucket_size must be even (a turn never spans two buckets).")
+        self.bucket_size = bucket_size
+        self._legacy = FirestoreMessageStore() if legacy_fallback else None
+
+    def _buckets_ref(self, client, character_id: str):
+        return client.collection(CHARACTERS_COLLECTION).document(character_id).collection(HISTORY_BUCKET_SUBCOLLECTION)
+
+    def _recent_query(self, client, character_id: str, limit: int):
+        bucket_count = -(-limit // self.bucket_size) + 1 # 先頭バケットは途中までしか埋まっていない
+        return self._buckets_ref(client, character_id).order_by('seq', direction=firestore.Query.DESCENDING).limit(bucket_count)
+
+    @staticmethod
+    def _flatten(docs) -> list:
+        entries = [message for doc in docs for message in (doc.to_dict().get('messages') or [])]
+        entries.sort(key=lambda entry: (entry.get('timestamp') or _EPOCH, entry.get('index', 0)))
+        return entries
+
+    def _entries_from_recent(self, docs: list, limit: int) -> list:
+        return self._flatten(docs)[-limit:] if limit > 0 else []
+
+    def load_recent(self, character_id: str, limit: int) -> list:
+        entries = super().load_recent(character_id, limit)
+        if self._legacy and len(entries) < limit: # 移行前のメッセージ形式の履歴で不足分を補う
+            entries = self._legacy.load_recent(character_id, limit - len(entries)) + entries
+        return entries
+
+    async def load_recent_async(self, character_id: str, limit: int) -> list:
+        entries = await super().load_recent_async(character_id, limit)
+        if self._legacy and len(entries) < limit:
+            entries = await self._legacy.load_recent_async(character_id, limit - len(entries)) + entries
+        return entries
+
+    def load_since(self, character_id: str, since, limit: int) -> list:
+        query = self._buckets_ref(db, character_id).where(filter=FieldFilter('lastAt', '>', since)).order_by('lastAt', direction=firestore.Query.ASCENDING).limit(-(-limit // self.bucket_size) + 1)
+        docs = list(query.stream())
+        trace_count('firestoreReads', max(1, len(docs)))
+        entries = [entry for entry in self._flatten(docs) if entry.get('timestamp') is not None and entry['timestamp'] > since]
+        if self._legacy: entries = self._legacy.load_since(character_id, since, limit) + entries
+        return entries[:limit]
+
+    def load_before(self, character_id: str, before, limit: int) -> list:
+        if before is None: return self.load_recent(character_id, limit)
+        buckets_ref = self._buckets_ref(db, character_id)
+        # カーソルをまたぐバケット (lastAt >= before の最古) + それより古いバケット
+        straddling = list(buckets_ref.where(filter=FieldFilter('lastAt', '>=', before)).order_by('lastAt', direction=firestore.Query.ASCENDING).limit(1).stream())
+        older = list(buckets_ref.where(filter=FieldFilter('lastAt', '<', before)).order_by('lastAt', direction=firestore.Query.DESCENDING).limit(-(-limit // self.bucket_size)).stream())
+        trace_count('firestoreReads', max(1, len(straddling)) + max(1, len(older)))
+        entries = [entry for entry in self._flatten(straddling + older) if entry.get('timestamp') is not None and entry['timestamp'] < before][-limit:]
+        if self._legacy and len(entries) < limit:
+            entries = self._legacy.load_before(character_id, entries[0]['timestamp'] if entries else before, limit - len(entries)) + entries
+        return entries
+
+    def _stage_turn(self, client, batch, character_id: str, user_msg: str, ai_msg: str, reserved_turn_count: int):
+        char_doc_ref = client.collection(CHARACTERS_COLLECTION).document(character_id)
+        first_index = max(reserved_turn_count - 2, 0)
+        seq = first_index // self.bucket_size
+        timestamp_now = datetime.now(timezone.utc)
+        messages = [
+            {'index': first_index, 'timestamp': timestamp_now, 'role': 'user', 'message': user_msg},
+            {'index': first_index + 1, 'timestamp': timestamp_now, 'role': 'model', 'message': ai_msg},
+        ]
+        bucket_ref = self._buckets_ref(client, character_id).document(f"{seq:08d}")
+        batch.set(bucket_ref, {'seq': seq, 'messages': firestore.ArrayUnion(messages), 'lastAt': timestamp_now}, merge=True)
+        batch.update(char_doc_ref, {'lastMessageAt': firestore.SERVER_TIMESTAMP})
+        return timestamp_now
+
+class SQLiteConversationStore(ConversationStore):
+    """History in a local SQLite database (':memory:' by default), for development and offline checks.
+
+    Characters, turn counts and memory stay in Firestore; saving still touches lastMessageAt there for the ETag."""
+
+    def __init__(self, path: str = ':memory:'):
+        import sqlite3
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS history (id INTEGER PRIMARY KEY AUTOINCREMENT, character_id TEXT NOT NULL, timestamp INTEGER NOT NULL, role TEXT NOT NULL, message TEXT NOT NULL)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS history_by_character ON history (character_id, timestamp, id)")
+        self._conn.commit()
+
+    @staticmethod
+    def _micros(timestamp) -> int: # カーソル比較で誤差が出ないよう整数マイクロ秒で保存
+        return (timestamp - _EPOCH) // timedelta(microseconds=1)
+
+    @staticmethod
+    def _entry(row) -> dict:
+        return {'timestamp': _EPOCH + timedelta(microseconds=row[0]), 'role': row[1], 'message': row[2]}
 
-def load_history_for_frontend(character_id: str, limit: int = 50) -> list:
-    """Loads last N messages from Firestore, formatted for frontend display (chronological)."""
+    def load_recent(self, character_id: str, limit: int) -> list:
+        with self._lock:
+            rows = self._conn.execute("SELECT timestamp, role, message FROM history WHERE character_id = ? ORDER BY timestamp DESC, id DESC LIMIT ?", (character_id, limit)).fetchall()
+        return [self._entry(row) for row in reversed(rows)]
+
+    def load_since(self, character_id: str, since, limit: int) -> list:
+        with self._lock:
+            rows = self._conn.execute("SELECT timestamp, role, message FROM history WHERE character_id = ? AND timestamp > ? ORDER BY timestamp, id LIMIT ?", (character_id, self._micros(since), limit)).fetchall()
+        return [self._entry(row) for row in rows]
+
+    def load_before(self, character_id: str, before, limit: int) -> list:
+        if before is None: return self.load_recent(character_id, limit)
+        with self._lock:
+            rows = self._conn.execute("SELECT timestamp, role, message FROM history WHERE character_id = ? AND timestamp < ? ORDER BY timestamp DESC, id DESC LIMIT ?", (character_id, self._micros(before), limit)).fetchall()
+        return [self._entry(row) for row in reversed(rows)]
+
+    def save_turn(self, character_id: str, user_msg: str, ai_msg: str, reserved_turn_count: int):
+        timestamp_now = datetime.now(timezone.utc)
+        with self._lock, self._conn:
+            self._conn.executemany("INSERT INTO history (character_id, timestamp, role, message) VALUES (?, ?, ?, ?)",
+                                   [(character_id, self._micros(timestamp_now), 'user', user_msg), (character_id, self._micros(timestamp_now), 'model', ai_msg)])
+        db.collection(CHARACTERS_COLLECTION).document(character_id).update({'lastMessageAt': firestore.SERVER_TIMESTAMP})
+        trace_count('firestoreWrites')
+        return timestamp_now
+
+def create_conversation_store(kind: str) -> ConversationStore:
+    if kind == 'messages': return FirestoreMessageStore()
+    if kind == 'buckets': return FirestoreBucketStore(HISTORY_BUCKET_SIZE, HISTORY_BUCKET_LEGACY_FALLBACK)
+    if kind == 'sqlite': return SQLiteConversationStore(HISTORY_SQLITE_PATH)
+    raise ValueError(f"Unknown HISTORY_STORE '{kind}' (expected messages / buckets / sqlite).")
+
+conversation_store = create_conversation_store(HISTORY_STORE)
+
+# --- ★★★ 履歴読み込み関数 (キャッシュ経由) ★★★ ---
+
+def load_recent_history_entries(character_id: str, limit: int, turn_count: int | None = None) -> list:
+    """Returns the last N valid raw history entries (oldest first), served from history_cache when possible.
+
+    turn_count is the number of messages the history should hold (turnCount before the reserved turn), if known."""
+    cached, fetch_limit = _cached_history_entries(character_id, limit, turn_count)
+    if cached is not None: return cached
+    logger.debug("Loading history for %s, limit %d", character_id, fetch_limit)
+    return _collect_history_entries(character_id, conversation_store.load_recent(character_id, fetch_limit), fetch_limit, limit, turn_count)
+
+def _cached_history_entries(character_id: str, limit: int, turn_count: int | None = None, in_flight: bool = False) -> tuple:
+    """Returns (cached entries or None, how many to fetch on a miss)."""
+    if limit <= history_cache.max_messages:
+        cached = history_cache.get(character_id, turn_count, in_flight)
+        if cached is not None:
+            if logger.isEnabledFor(logging.DEBUG): logger.debug("History cache hit for %s (%d cached). Stats: %s", character_id, len(cached), history_cache.stats())
+            return (cached[-limit:] if limit > 0 else []), 0
+        return None, history_cache.max_messages # キャッシュ容量分まとめて読み込む
+    return None, limit
+
+def _collect_history_entries(character_id: str, raw_entries: list, fetch_limit: int, limit: int, turn_count: int | None = None) -> list:
+    entries = _valid_history_entries(character_id, raw_entries)
+    if fetch_limit == history_cache.max_messages:
+        history_cache.put(character_id, entries, turn_count)
+    return entries[-limit:] if limit > 0 else []
+
+def _valid_history_entries(character_id: str, raw_entries: list) -> list:
+    entries = []
+    skipped = 0
+    for entry in raw_entries:
+        # タイムスタンプの存在もチェック（古いデータにない可能性）
+        if entry.get('role') in ['user', 'model'] and entry.get('message') is not None and entry.get('timestamp') is not None:
+            entries.append({'timestamp': entry.get('timestamp'), 'role': entry.get('role'), 'message': str(entry.get('message'))})
+        else:
+            skipped += 1
+            logger.debug("Skipping history entry due to missing field: %s", entry)
+    if skipped: logger.warning("Skipped %d history entries with missing fields for %s.", skipped, character_id)
+    return entries
+
+def format_history_for_gemini(entries: list) -> list:
+    return [{'role': entry['role'], 'parts': [{'text': entry['message']}]} for entry in entries]
+
+def format_history_for_frontend(entries: list) -> list:
+    return [{'role': entry['role'], 'message': entry['message']} for entry in entries]
+
+def load_conversation_history_for_gemini(character_id: str, limit: int = 100, turn_count: int | None = None) -> list:
+    """Loads last N messages, formatted for Gemini API."""
     if not db or firestore_init_error: return []
     try:
-        print(f"Loading history for frontend from Firestore for {character_id}, limit {limit}")
-        history_ref = db.collection(CHARACTERS_COLLECTION).document(character_id).collection(HISTORY_SUBCOLLECTION)
-        # フロントエンドは古い順に表示するので ASCENDING で取得し、最新N件に絞る (Firestoreクエリの組み合わせ)
-        # Firestore は limit_to_last が直接ないので、一度 DESC で取得して Python で reverse するか、
-        # ASC で取得して全件読み込み後にスライスするのが一般的。件数が多くなる場合は注意。
-        # ここでは DESC で limit 件取得し、Python 側で reverse する方法を採用。
-        query = history_ref.order_by('timestamp', direction=firestore.Query.DESCENDING).limit(limit)
-        docs = query.stream()
-        raw_history = []
-        for doc in docs:
-             entry = doc.to_dict()
-             role = entry.get('role')
-             message = entry.get('message')
-             # タイムスタンプの存在もチェック
-             timestamp = entry.get('timestamp') # デバッグや将来の拡張用に保持しても良い
-             if role in ['user', 'model'] and message is not None and timestamp is not None:
-                  # フロントエンドに必要な形式で格納
-                  raw_history.append({'role': role, 'message': str(message)})
-             else:
-                 print(f"Skipping history entry for frontend due to missing field: {entry}")
+        formatted_history = format_history_for_gemini(load_recent_history_entries(character_id, limit, turn_count))
+        logger.debug("Loaded and formatted %d messages for Gemini session.", len(formatted_history))
+        return formatted_history
+    except Exception as e: logger.exception("Error loading history for Gemini: %s", e); return []
+
+def load_history_for_frontend(character_id: str, limit: int = MAX_FRONTEND_HISTORY, before: str | None = None, turn_count: int | None = None) -> tuple:
+    """Loads one page of messages older than the `before` cursor (newest page if None), formatted for frontend display.
+
+    turn_count (the character's turnCount) restricts the newest page to a cached list that reflects it.
+    Returns (messages oldest first, cursor for the next older page or None)."""
+    before_ts = parse_history_cursor(before)
+    if before_ts is None:
+        # このインスタンスで処理中のターン (予約済み・未保存) は turnCount にだけ入っているので、それを除いた一覧も正しい
+        cached, _ = _cached_history_entries(character_id, limit + 1, turn_count, turn_gate.busy(character_id))
+        if cached is not None: return paginate_history(cached, limit)
+    # 表示に必要な分だけ読む (チャット用の履歴キャッシュは POST 時に容量分まとめて読む)
+    raw_entries = conversation_store.load_before(character_id, before_ts, limit + 1)
+    return paginate_history(_valid_history_entries(character_id, raw_entries), limit)
+
+# --- ★★★ 履歴のページング (カーソル = ページ内で最も古いメッセージのタイムスタンプ) ★★★ ---
+def parse_history_cursor(cursor: str | None):
+    if not cursor: return None
+    try: cursor_ts = datetime.fromisoformat(cursor)
+    except ValueError: raise ValueError("Invalid 'before' cursor.")
+    # ★ タイムゾーンなしのカーソルは UTC とみなす (保存済みのタイムスタンプはすべて UTC で、比較時に TypeError になるため)
+    return cursor_ts if cursor_ts.tzinfo is not None else cursor_ts.replace(tzinfo=timezone.utc)
+
+def parse_history_limit(value) -> int:
+    if value in (None, ''): return HISTORY_PAGE_DEFAULT_LIMIT
+    try: limit = int(value)
+    except ValueError: raise ValueError("Invalid 'limit'.")
+    return max(2, min(limit, HISTORY_PAGE_MAX_LIMIT)) # 2件未満だと user/model の組を分けずにページを切れない
 
-        # DESC で取得したので、フロントエンド用に古い順 (chronological) に並び替える
-        frontend_history = list(reversed(raw_history))
-        print(f"Loaded and formatted {len(frontend_history)} messages for frontend display.")
-        return frontend_history
-    except Exception as e: print(f"Error loading history for frontend: {e}"); traceback.print_exc(); return []
+def paginate_history(entries: list, limit: int) -> tuple:
+    """Cuts the newest `limit` of up to limit + 1 valid entries (oldest first) into a frontend page.
+
+    A page never starts inside a group of messages sharing one timestamp (a user/model pair), so the
+    group's timestamp is a safe cursor. Returns (messages, next cursor or None)."""
+    if len(entries) <= limit: return format_history_for_frontend(entries), None
+    page = entries[-limit:]
+    boundary = entries[-limit - 1]['timestamp']
+    trimmed = [entry for entry in page if entry['timestamp'] != boundary]
+    if trimmed: page = trimmed
+    return format_history_for_frontend(page), page[0]['timestamp'].isoformat()
+
+def history_page_result(args, cors_headers: dict) -> tuple:
+    """GET .../history?id=&before=&limit= : returns (status, payload, headers)."""
+    try:
+        character_id = args.get('id')
+        if not character_id: raise ValueError("Missing 'id' query parameter.")
+        trace_character(character_id)
+        before = args.get('before')
+        limit = parse_history_limit(args.get('limit'))
+        with trace_span('history_page'):
+            history_data, next_cursor = load_history_for_frontend(character_id, limit, before)
+    except ValueError as e:
+        logger.info("History page Client Error: %s", e)
+        return 400, {'error': str(e)}, cors_headers
+    except Exception as e:
+        logger.exception("History page Error: %s", e)
+        return 500, {'error': 'Internal error processing history.'}, cors_headers
+    headers = {**cors_headers, 'Cache-Control': HISTORY_PAGE_CACHE_CONTROL if before else PROFILE_CACHE_CONTROL}
+    return 200, {'history': history_data, 'nextCursor': next_cursor, 'hasMore': next_cursor is not None}, headers
 
 # --- 履歴読み込み関数ここまで ---
 
 
-# --- 要約関数 (変更なし) ---
-def generate_memory_summary(char_doc_ref: firestore.DocumentReference, history_limit: int) -> str | None:
-     """Generates summary (uses Firestore history)."""
+# --- ★★★ 要約関数 (差分要約: 既存メモリー + 前回要約以降の会話のみ) ★★★ ---
+def load_history_entries_since(character_id: str, since, limit: int) -> list:
+    """Loads raw history entries (role, message, timestamp) newer than `since`, oldest first.
+
+    With no cursor, falls back to the newest `limit` messages."""
+    if since is not None:
+        raw_history = conversation_store.load_since(character_id, since, limit)
+        if len(raw_history) >= limit:
+            # 同一タイムスタンプ (同じターンの user/model) を途中で切らないよう、末尾の同時刻分は次回に回す
+            last_ts = raw_history[-1].get('timestamp')
+            trimmed = [entry for entry in raw_history if entry.get('timestamp') != last_ts]
+            if trimmed: raw_history = trimmed
+    else:
+        raw_history = conversation_store.load_recent(character_id, limit)
+    return _valid_history_entries(character_id, raw_history)
+
+def generate_memory_summary(char_doc_ref: firestore.DocumentReference, history_limit: int) -> tuple | None:
+     """Merges messages since the last checkpoint into the existing memory.
+
+     Returns (summary, timestamp of the newest summarized message), or None."""
      character_id = char_doc_ref.id # Get ID from ref
-     if not gemini_model or gemini_initialization_error: print("Gemini NA for summary."); return None
+     if not summary_model or gemini_initialization_error: logger.error("Gemini NA for summary."); return None
      try:
-         # 要約生成には Gemini 用の履歴データを使う
-         history_for_gemini = load_conversation_history_for_gemini(character_id, limit=history_limit)
-         if not history_for_gemini: print("No history for summary."); return None
-
-         # Gemini 形式からテキスト形式へ変換
-         history_text_parts = []
-         for turn in history_for_gemini:
-             role = turn.get('role')
-             text = turn.get('parts', [{}])[0].get('text', '')
-             if role and text:
-                 history_text_parts.append(f"{role}: {text}")
-         history_text = "\n".join(history_text_parts)
+         char_doc = char_doc_ref.get()
+         trace_count('firestoreReads')
+         char_data = char_doc.to_dict() if char_doc.exists else {}
+         previous_memory = char_data.get('memoryPrompt') or ""
+         last_summarized_at = char_data.get('lastSummarizedAt')
+
+         # 前回の要約以降のメッセージだけを読み込む (カーソルが無い場合は直近 history_limit 件)
+         new_entries = load_history_entries_since(character_id, last_summarized_at, MAX_SUMMARY_SOURCE_MESSAGES if last_summarized_at else history_limit)
+         if not new_entries: logger.info("No new history for summary."); return None
+         logger.info("Summarizing %d new messages (cursor: %s).", len(new_entries), last_summarized_at)
 
+         history_text = "\n".join(f"{entry['role']}: {entry['message']}" for entry in new_entries)
          if not history_text.strip():
-             print("History text for summary is empty."); return None
-
-         # TODO: Refine summarization prompt
-         prompt = f"""｛プロンプト｝:
-         あなたは「ユーザーの会話履歴を分析し、ユーザーの好みや性格、考え方を魅力的にまとめる専門家」です。
-         以下の会話ログから、ユーザーの特徴を体系的に抽出し、
-         今後のやり取りでユーザーが「自分のことをよく分かっている」と感じられるようなメモリーデータ（プロフィール情報）を作成してください。
-         1. 目的:
-         将来の会話でユーザーに合わせた返信ができるよう、
-         ユーザーの好みや関心事、価値観、性格傾向などを把握すること。
-         2. 重要項目:
-         - 好きなもの（趣味、食べ物、ブランド、音楽、本など）
-         - 嫌いなもの（苦手な話題、避けたいものなど）
-         - よく使う表現や口癖、コミュニケーションスタイル
-         - 性格や価値観（ポジティブ/ネガティブ、外交的/内向的、保守的/革新的 など）
-         - ユーモアの傾向や笑いのツボ
-         - 他に特徴的なエピソード（仕事・ライフスタイル・目標や夢・悩み など）
-         3. 出力形式:
-         以下のセクションに分けて、わかりやすくコンパクトにまとめてください。
-         必要に応じて短いコメントなども加えてください。出力は以下のセクションに沿った結果のみ出力ください。
-         - 【ユーザー名・基本情報】
-         - 【性格・価値観】
-         - 【興味・関心 / 好きなもの】
-         - 【苦手・嫌いなもの】
-         - 【ストーリー・エピソード】
-         - 【メモ】
-         4. 注意点:
-         - あくまで会話履歴に基づいた情報をまとめてください。分からない情報まで推定するのは絶対にやめてください。分からない箇所は空欄で良いです。
-         - 個人情報やプライバシーには十分に配慮してください。
-         - ユーザーに親しみを感じられるようにまとめてください。
-         [会話履歴]
-         {history_text}
-         [メモリー]
-         """
-         print("Calling Gemini for summarization...")
-         response = gemini_model.generate_content(prompt)
+             logger.info("History text for summary is empty."); return None
+
+         prompt = f"""あなたはユーザーの会話から好み・性格・価値観を記録するメモリー管理者です。
+既存のメモリーに新しい会話の情報を統合し、更新後のメモリー全体を出力してください。
+- セクション: 【ユーザー名・基本情報】【性格・価値観】【興味・関心 / 好きなもの】【苦手・嫌いなもの】【ストーリー・エピソード】【メモ】
+- 会話に無い情報は推定しない (不明な箇所は空欄)。新しい情報と矛盾する古い情報は更新する。
+- 個人情報に配慮し、親しみのある表現で簡潔に。全体で{MAX_MEMORY_CHARS}文字以内。セクション以外は出力しない。
+[既存のメモリー]
+{previous_memory or "(なし)"}
+[新しい会話]
+{history_text}
+[更新後のメモリー]
+"""
+         logger.debug("Calling Gemini for summarization...")
+         with trace_span('summary_model_call'):
+             response = summary_model_client.call(lambda: summary_model.generate_content(prompt, request_options=summary_model_client.request_options()))
+         record_model_usage(response)
          if hasattr(response, 'text') and response.text:
              summary = response.text.strip()
-             print(f"Summarization OK: {summary[:100]}...")
-             return summary
+             if len(summary) > MAX_MEMORY_CHARS:
+                 logger.info("Summary too long (%d chars), truncating to %d.", len(summary), MAX_MEMORY_CHARS)
+                 summary = summary[:MAX_MEMORY_CHARS]
+             logger.debug("Summarization OK: %s...", summary[:100])
+             return summary, new_entries[-1]['timestamp']
          else:
-             print(f"Summarization response empty/blocked. Feedback: {getattr(response, 'prompt_feedback', 'N/A')}")
+             logger.warning("Summarization response empty/blocked. Feedback: %s", getattr(response, 'prompt_feedback', 'N/A'))
              return None
-     except Exception as e: print(f"Error during summary gen: {e}"); traceback.print_exc(); return None
+     except Exception as e: logger.exception("Error during summary gen: %s", e); return None
 
-def update_memory_prompt(char_doc_ref: firestore.DocumentReference, summary_text: str):
-      """Updates the MemoryPrompt field in Firestore."""
-      if not db or firestore_init_error: print("Firestore NA for memory update."); return
+def update_memory_prompt(char_doc_ref: firestore.DocumentReference, summary_text: str, summarized_through=None):
+      """Updates the MemoryPrompt field (and the lastSummarizedAt cursor) in Firestore."""
+      if not db or firestore_init_error: logger.error("Firestore NA for memory update."); return
       try:
-          print(f"Updating memory prompt for {char_doc_ref.id}...")
-          char_doc_ref.update({'memoryPrompt': summary_text})
-          print(f"Memory prompt updated successfully in Firestore.")
-      except Exception as e: print(f"Error updating memory: {e}"); traceback.print_exc()
+          logger.debug("Updating memory prompt for %s...", char_doc_ref.id)
+          conversation_store.update_memory(char_doc_ref.id, summary_text, summarized_through)
+          model_cache.invalidate(char_doc_ref.id) # 古いメモリーを含むモデルを破棄
+          profile_cache.invalidate(char_doc_ref.id)
+          logger.info("Memory prompt updated successfully in Firestore.")
+      except Exception as e: logger.exception("Error updating memory: %s", e)
+
+# --- ★★★ トークン予算つきコンテキスト組み立て ★★★ ---
+MESSAGE_TOKEN_OVERHEAD = 4 # role などメッセージごとの付随トークン (概算)
+
+def estimate_tokens(text: str | None) -> int:
+    """Offline token estimate: ~1 token per CJK/kana character, ~4 characters per token otherwise."""
+    if not text: return 0
+    wide = sum(1 for char in text if ord(char) >= 0x3000)
+    return wide + (len(text) - wide + 3) // 4
+
+def truncate_to_tokens(text: str, max_tokens: int, keep_end: bool = False) -> str:
+    """Cuts text so that estimate_tokens(text) <= max_tokens (keeps the head, or the tail with keep_end)."""
+    if max_tokens <= 0: return ""
+    if estimate_tokens(text) <= max_tokens: return text
+    low, high = 0, len(text) # 収まる最大の文字数を二分探索
+    while low < high:
+        mid = (low + high + 1) // 2
+        if estimate_tokens(text[-mid:] if keep_end else text[:mid]) <= max_tokens: low = mid
+        else: high = mid - 1
+    return text[-low:] if keep_end and low else text[:low]
+
+def build_chat_context(system_prompt: str, memory_prompt: str | None, history_for_gemini: list, user_msg: str, budget: int = CONTEXT_TOKEN_BUDGET) -> tuple:
+    """Fits system prompt + memory + newest history into `budget` estimated tokens.
+
+    The system prompt and the user message are always kept; memory is capped at MEMORY_TOKEN_BUDGET;
+    history is filled newest-first and older turns are dropped. Returns (memory, history, usage)."""
+    usage = {'budget': budget, 'system': estimate_tokens(system_prompt), 'userMessage': estimate_tokens(user_msg) + MESSAGE_TOKEN_OVERHEAD}
+    remaining = budget - usage['system'] - usage['userMessage']
+
+    memory_truncated = False
+    if memory_prompt:
+        memory_limit = min(MEMORY_TOKEN_BUDGET, max(remaining, 0))
+        if estimate_tokens(memory_prompt) > memory_limit:
+            memory_prompt = truncate_to_tokens(memory_prompt, memory_limit) or None
+            memory_truncated = True
+    usage['memory'] = estimate_tokens(memory_prompt)
+    remaining -= usage['memory']
+
+    # 履歴をターン (user から始まるメッセージのまとまり) 単位に分ける。Gemini の履歴は user から始める必要がある
+    turns = []
+    for entry in history_for_gemini:
+        if entry['role'] == 'user' or not turns: turns.append([])
+        turns[-1].append(entry)
+    if turns and turns[0][0]['role'] != 'user': turns.pop(0) # 先頭の user を欠くターンは使わない
+
+    def message_cost(entry): return estimate_tokens(entry['parts'][0]['text']) + MESSAGE_TOKEN_OVERHEAD
+
+    kept_turns = []
+    history_tokens = 0
+    for turn in reversed(turns): # 新しいターンから詰め、入らなくなったら古いターンは捨てる
+        cost = sum(message_cost(entry) for entry in turn)
+        if cost > remaining:
+            per_message = remaining // len(turn) - MESSAGE_TOKEN_OVERHEAD
+            if not kept_turns and per_message > 0:
+                # 最新ターン単体で予算を超える場合は各メッセージの末尾を残して切り詰める
+                turn = [{'role': entry['role'], 'parts': [{'text': truncate_to_tokens(entry['parts'][0]['text'], per_message, keep_end=True)}]} for entry in turn]
+                cost = sum(message_cost(entry) for entry in turn)
+                kept_turns.append(turn)
+                history_tokens += cost; remaining -= cost
+            break
+        kept_turns.append(turn)
+        history_tokens += cost; remaining -= cost
+    kept = [entry for turn in reversed(kept_turns) for entry in turn]
+
+    usage.update({
+        'history': history_tokens,
+        'total': usage['system'] + usage['memory'] + history_tokens + usage['userMessage'],
+        'historyMessages': len(kept),
+        'droppedMessages': len(history_for_gemini) - len(kept),
+        'memoryTruncated': memory_truncated,
+    })
+    return memory_prompt, kept, usage
+
+def chat_history_budget() -> int:
+    """Token budget for build_chat_context (the recall share is reserved when recall is enabled)."""
+    return CONTEXT_TOKEN_BUDGET - RECALL_TOKEN_BUDGET if MEMORY_RECALL_ENABLED else CONTEXT_TOKEN_BUDGET
+
+# --- ★★★ 過去の会話の検索 (埋め込み + キャラクターごとのベクトル索引) ★★★ ---
+# 生の履歴 (直近 MAX_HISTORY_TURNS) より古い会話は、従来はメモリー (要約) からしか参照できなかった。
+# 全履歴を埋め込んで索引にし、今の発言に近いメッセージ上位 RECALL_TOP_K 件だけをユーザーの発言の前に添える。
+# システム指示ではなく発言側に入れるので、モデルキャッシュ・コンテキストキャッシュはそのまま効く。
+class EmbeddingProvider:
+    """Turns texts into unit-length vectors of `dimensions` floats."""
+    dimensions = EMBEDDING_DIMENSIONS
+    min_score = 0.0 # これ未満の類似度 (コサイン) のメッセージは入れない (埋め込みごとに分布が異なる)
+
+    def embed(self, texts: list, query: bool = False) -> list:
+        raise NotImplementedError
+
+def _normalize_vector(vector: list) -> list:
+    norm = math.sqrt(sum(value * value for value in vector))
+    return [value / norm for value in vector] if norm else vector
+
+class LocalHashEmbedding(EmbeddingProvider):
+    """Deterministic offline stand-in: signed feature hashing of ASCII words and of kanji/katakana runs
+    (each kanji, plus bi/tri-grams). Needs no tokenizer for Japanese; hiragana (particles, endings) is ignored."""
+    min_score = 0.25 # 無関係な文どうしでも共通の漢字で 0.1〜0.3 程度は重なる
+
+    def __init__(self, dimensions: int = EMBEDDING_DIMENSIONS):
+        self.dimensions = dimensions
+
+    def embed(self, texts: list, query: bool = False) -> list:
+        return [self._embed_one(text) for text in texts]
+
+    def _embed_one(self, text: str) -> list:
+        counts = {}
+        for feature in self._features(unicodedata.normalize('NFKC', text[:EMBEDDING_MAX_CHARS]).lower()):
+            counts[feature] = counts.get(feature, 0) + 1
+        vector = [0.0] * self.dimensions
+        for feature, count in counts.items():
+            digest = zlib.crc32(feature.encode('utf-8'))
+            vector[digest % self.dimensions] += (1.0 + math.log(count)) * (1 if digest & 0x80000000 else -1)
+        return _normalize_vector(vector)
+
+    @staticmethod
+    def _features(text: str):
+        for word in text.split():
+            if word.isascii() and word.isalnum(): yield word
+        run = [] # 連続する漢字・カタカナ (内容語の大半)
+        for char in text + ' ':
+            if not char.isascii() and not '\u3040' <= char <= '\u309f' and (char.isalnum() or char == 'ー'):
+                run.append(char)
+                continue
+            for kanji in run:
+                if '\u4e00' <= kanji <= '\u9fff': yield kanji
+            for size in (2, 3):
+                for i in range(len(run) - size + 1): yield "".join(run[i:i + size])
+            run = []
+
+class GeminiEmbedding(EmbeddingProvider):
+    """Gemini embedding API (retrieval_document for history, retrieval_query for the user message)."""
+    min_score = 0.55 # 意味の近くない文でも 0.3〜0.5 程度になる
+
+    def __init__(self, model_name: str = EMBEDDING_MODEL_NAME, dimensions: int = EMBEDDING_DIMENSIONS):
+        self.model_name, self.dimensions = model_name, dimensions
+
+    def embed(self, texts: list, query: bool = False) -> list:
+        vectors = []
+        # 検索語 (リクエスト中) は短い期限で、履歴 (バックグラウンドの索引更新) は長めの期限で。遮断は共通
+        client = embedding_query_client if query else embedding_batch_client
+        for start in range(0, len(texts), EMBEDDING_BATCH_SIZE):
+            batch = [text[:EMBEDDING_MAX_CHARS] for text in texts[start:start + EMBEDDING_BATCH_SIZE]]
+            result = client.call(lambda batch=batch: genai.embed_content(model=self.model_name, content=batch, task_type='retrieval_query' if query else 'retrieval_document',
+                                                                         output_dimensionality=self.dimensions, request_options=client.request_options()))
+            vectors.extend(_normalize_vector(vector) for vector in result['embedding'])
+        return vectors
+
+def create_embedding_provider(kind: str) -> EmbeddingProvider:
+    if kind == 'local': return LocalHashEmbedding()
+    if kind == 'gemini': return GeminiEmbedding()
+    raise ValueError(f"Unknown EMBEDDING_PROVIDER '{kind}' (expected local / gemini).")
+
+def _quantize(vector: list) -> bytes:
+    """Unit vector -> int8 bytes (dot product / 127**2 approximates cosine similarity)."""
+    return bytes(max(-127, min(127, round(value * 127))) & 0xFF for value in vector)
+
+def _dot_scores(vectors: bytearray, count: int, dimensions: int, query: bytes) -> list:
+    if numpy is not None:
+        matrix = numpy.frombuffer(vectors, dtype=numpy.int8, count=count * dimensions).reshape(count, dimensions)
+        return (matrix.astype(numpy.int32) @ numpy.frombuffer(query, dtype=numpy.int8).astype(numpy.int32)).tolist()
+    query_values = memoryview(query).cast('b').tolist()
+    with memoryview(vectors) as view, view.cast('b') as signed:
+        return [sum(map(operator.mul, signed[i * dimensions:(i + 1) * dimensions], query_values)) for i in range(count)]
+
+class _CharacterVectors:
+    """One character's messages (oldest first) and their int8 vectors packed in a bytearray (same order)."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.messages = []
+        self.vectors = bytearray()
+        self.cursor = None # ストアから読み込んだ最新メッセージのタイムスタンプ
+        self.refreshed_at = 0.0
+        self.complete = False # 最古のメッセージまで (または上限まで) 読み込み済み
+
+class RecallIndex:
+    """Per-character vector index over the conversation history (in-process, LRU-bounded).
+
+    Searches never touch the store: building and catching up (store reads + embedding) run in
+    recall_job_queue via catch_up(), and a character is skipped until its index is built."""
+
+    def __init__(self, embedder: EmbeddingProvider, max_characters: int, max_messages: int, cold_load_messages: int, refresh_seconds: float):
+        self.embedder = embedder
+        self.max_characters = max_characters
+        self.max_messages = max_messages
+        self.cold_load_messages = cold_load_messages
+        self.refresh_seconds = refresh_seconds
+        self._lock = threading.Lock()
+        self._indexes = OrderedDict() # character_id -> _CharacterVectors
+        self._stats = {'hits': 0, 'misses': 0, 'builds': 0, 'refreshes': 0, 'evictions': 0, 'embedded': 0, 'searches': 0}
+        self._search_seconds = 0.0
+
+    def needs_catch_up(self, character_id: str) -> bool:
+        """True if the character has no index yet, older history is still to be backfilled, or it was last caught up more than refresh_seconds ago."""
+        with self._lock:
+            index = self._indexes.get(character_id)
+        return index is None or not index.complete or time.monotonic() - index.refreshed_at >= self.refresh_seconds
+
+    def search(self, character_id: str, query: str, k: int, exclude_last: int = 0, min_score: float | None = None) -> list | None:
+        """Top-k distinct messages most similar to query, excluding the newest `exclude_last` (already in the context).
+
+        Returns [(score, entry), ...] oldest first, or None if the character's index is not built yet."""
+        with self._lock:
+            index = self._indexes.get(character_id)
+            if index is None:
+                self._stats['misses'] += 1
+                return None
+            self._indexes.move_to_end(character_id)
+            self._stats['hits'] += 1
+        if k <= 0 or len(index.messages) <= exclude_last: return []
+        start = time.perf_counter()
+        query_vector = _quantize(self.embedder.embed([query], query=True)[0]) # 索引のロックの外で (API 呼び出しの場合がある)
+        with index.lock:
+            count = len(index.messages) - exclude_last
+            if count <= 0: return []
+            scores = _dot_scores(index.vectors, count, self.embedder.dimensions, query_vector)
+            threshold = (self.embedder.min_score if min_score is None else min_score) * 127 * 127
+            top, seen = [], set()
+            for i in sorted(range(count), key=scores.__getitem__, reverse=True):
+                if scores[i] < threshold or len(top) >= k: break
+                if index.messages[i]['message'] in seen: continue # 同じ文面の繰り返しは1件だけ
+                seen.add(index.messages[i]['message']); top.append(i)
+            results = [(scores[i] / (127 * 127), index.messages[i]) for i in sorted(top)]
+        with self._lock:
+            self._stats['searches'] += 1
+            self._search_seconds += time.perf_counter() - start
+        return results
+
+    def catch_up(self, character_id: str):
+        """Job handler: builds the index from the newest cold_load_messages, then on each run adds the messages newer than
+        its cursor and backfills one page (cold_load_messages) of older history until max_messages or the first message."""
+        try:
+            with self._lock:
+                index = self._indexes.get(character_id) or _CharacterVectors()
+            # ジョブは1本のワーカーで直列に実行されるので、索引を書き換えるのはここだけ
+            cursor, complete = index.cursor, index.complete
+            older_entries = []
+            if cursor is None:
+                raw_entries = conversation_store.load_recent(character_id, self.cold_load_messages)
+                new_entries = _valid_history_entries(character_id, raw_entries)
+                complete = len(raw_entries) < self.cold_load_messages
+            else:
+                new_entries = load_history_entries_since(character_id, cursor, self.max_messages)
+                room = self.max_messages - len(index.messages) - len(new_entries)
+                if not complete and room > 0 and index.messages:
+                    limit = min(self.cold_load_messages, room)
+                    raw_entries = conversation_store.load_before(character_id, index.messages[0]['timestamp'], limit)
+                    older_entries = _valid_history_entries(character_id, raw_entries)
+                    complete = len(raw_entries) < limit or room <= limit
+                else:
+                    complete = True
+            # 埋め込みは索引のロックの外で (検索を待たせない)
+            embedded = older_entries + new_entries
+            vectors = b"".join(_quantize(vector) for vector in self.embedder.embed([entry['message'] for entry in embedded])) if embedded else b""
+            split = len(older_entries) * self.embedder.dimensions
+            with index.lock:
+                index.messages[:0] = older_entries
+                index.vectors[:0] = vectors[:split]
+                index.messages.extend(new_entries)
+                index.vectors += vectors[split:]
+                if new_entries: index.cursor = new_entries[-1]['timestamp']
+                index.complete = complete
+                overflow = len(index.messages) - self.max_messages
+                if overflow > 0:
+                    del index.messages[:overflow]
+                    del index.vectors[:overflow * self.embedder.dimensions]
+                index.refreshed_at = time.monotonic()
+            with self._lock:
+                self._stats['builds' if cursor is None else 'refreshes'] += 1
+                self._stats['embedded'] += len(embedded)
+                self._indexes[character_id] = index
+                self._indexes.move_to_end(character_id)
+                while len(self._indexes) > self.max_characters:
+                    self._indexes.popitem(last=False)
+                    self._stats['evictions'] += 1
+        except Exception as e:
+            logger.exception("Recall index update failed for %s: %s", character_id, e)
+            raise
+
+    def invalidate(self, character_id: str):
+        with self._lock:
+            self._indexes.pop(character_id, None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            searches = self._stats['searches']
+            messages = sum(len(index.messages) for index in self._indexes.values())
+            return {'size': len(self._indexes), 'messages': messages, 'vectorBytes': messages * self.embedder.dimensions, **self._stats,
+                    'avgSearchMs': round(self._search_seconds / searches * 1000, 3) if searches else 0.0}
+
+recall_index = RecallIndex(create_embedding_provider(EMBEDDING_PROVIDER), RECALL_INDEX_MAX_CHARACTERS, RECALL_INDEX_MAX_MESSAGES, RECALL_INDEX_COLD_LOAD_MESSAGES, RECALL_INDEX_REFRESH_SECONDS)
+
+def recall_into_message(character_id: str, user_msg: str, usage: dict, has_older_history: bool) -> str:
+    """Returns the text to send for user_msg: prefixed with relevant older messages found by recall_index, if any.
+
+    Skipped when every stored message already fits in the history (no older history), and while the
+    character's index is still being built in the background. Updates usage in place."""
+    usage['recall'], usage['recalledMessages'] = 0, 0
+    if not MEMORY_RECALL_ENABLED or not db or firestore_init_error: return user_msg
+    if not has_older_history and usage.get('droppedMessages', 0) == 0: return user_msg
+    try:
+        # 索引の構築・追いつき (履歴の読み込み + 埋め込み) はリクエストの外で行う
+        if recall_index.needs_catch_up(character_id): recall_job_queue.enqueue(character_id)
+        results = recall_index.search(character_id, user_msg, RECALL_TOP_K, exclude_last=usage.get('historyMessages', 0))
+    except ModelCallError as e: # 埋め込み API のタイムアウト / 遮断中
+        logger.warning("Recall skipped for %s (embedding unavailable): %s", character_id, e)
+        return user_msg
+    except Exception as e:
+        logger.exception("Recall failed for %s (continuing without it): %s", character_id, e)
+        return user_msg
+    if results is None:
+        logger.debug("Recall index for %s is not built yet; skipping recall.", character_id)
+        return user_msg
+
+    lines = []
+    remaining = RECALL_TOKEN_BUDGET
+    for _, entry in results:
+        speaker = 'ユーザー' if entry['role'] == 'user' else 'あなた'
+        timestamp = entry['timestamp']
+        date = f"{timestamp:%Y-%m-%d} " if isinstance(timestamp, datetime) else ""
+        line = f"- {date}{speaker}: {truncate_to_tokens(entry['message'], RECALL_SNIPPET_MAX_TOKENS)}"
+        cost = estimate_tokens(line)
+        if cost > remaining: break
+        lines.append(line); remaining -= cost
+    if not lines: return user_msg
+    usage['recall'], usage['recalledMessages'] = RECALL_TOKEN_BUDGET - remaining, len(lines)
+    usage['total'] += usage['recall']
+    return "[関連する過去の会話 (参考。必要なときだけ自然に触れてください)]\n" + "\n".join(lines) + f"\n\n[ユーザーの発言]\n{user_msg}"
+
+# --- ★★★ モデル呼び出し (タイムアウト・リトライ・ヘッジ・サーキットブレーカー) ★★★ ---
+class ModelCallError(Exception):
+    """A model call that failed fast or ran out of time; http_status is what the handler responds with."""
+    http_status = 503
+    code = 'MODEL_UNAVAILABLE'
+    user_message = 'AIサービスが混み合っています。しばらくしてからもう一度お試しください。'
+
+    def __init__(self, message: str, retry_after: float | None = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class ModelUnavailableError(ModelCallError):
+    """Raised without calling the provider while the circuit breaker is open."""
+
+class ModelDeadlineError(ModelCallError):
+    """The per-call timeout or the overall deadline expired."""
+    http_status = 504
+    code = 'MODEL_TIMEOUT'
+    user_message = 'AIの応答に時間がかかりすぎたため中断しました。もう一度お試しください。'
+
+# 一時的な障害として再試行するエラー (入力エラーやブロックは再試行しない)
+RETRYABLE_MODEL_ERRORS = (
+    google_exceptions.ServiceUnavailable, google_exceptions.TooManyRequests, google_exceptions.ResourceExhausted,
+    google_exceptions.InternalServerError, google_exceptions.DeadlineExceeded, google_exceptions.GatewayTimeout,
+    ModelDeadlineError, ConnectionError, TimeoutError,
+)
+
+def is_retryable_model_error(e: BaseException) -> bool:
+    return isinstance(e, RETRYABLE_MODEL_ERRORS)
+
+class CircuitBreaker:
+    """Opens when at least `failure_ratio` of the last `window` calls failed; after `cooldown_seconds` lets one probe through."""
+
+    def __init__(self, window: int, min_calls: int, failure_ratio: float, cooldown_seconds: float):
+        self.min_calls = min_calls
+        self.failure_ratio = failure_ratio
+        self.cooldown_seconds = cooldown_seconds
+        self._lock = threading.Lock()
+        self._state = 'closed' # closed -> open -> half_open -> closed / open
+        self._outcomes = deque(maxlen=window) # True = 失敗
+        self._opened_at = 0.0
+        self._probing = False
+        self._stats = {'opened': 0, 'rejected': 0}
+
+    def before_call(self):
+        """Raises ModelUnavailableError if calls should fail fast right now."""
+        with self._lock:
+            if self._state == 'closed': return
+            remaining = self._opened_at + self.cooldown_seconds - time.monotonic()
+            if self._state == 'open' and remaining <= 0:
+                self._state = 'half_open'
+                self._probing = False
+            if self._state == 'half_open' and not self._probing:
+                self._probing = True # この呼び出しだけを試行として通す
+                logger.info("Model circuit half-open: probing provider.")
+                return
+            self._stats['rejected'] += 1
+        raise ModelUnavailableError("Model provider is degraded (circuit open).", max(remaining, 1.0))
+
+    def is_open(self) -> bool:
+        """True while calls would be rejected without a probe (open and still cooling down)."""
+        with self._lock:
+            return self._state == 'open' and time.monotonic() < self._opened_at + self.cooldown_seconds
+
+    def record_success(self):
+        with self._lock:
+            if self._state != 'closed':
+                logger.info("Model circuit closed.")
+                self._outcomes.clear()
+            self._state = 'closed'
+            self._outcomes.append(False)
+
+    def record_failure(self):
+        with self._lock:
+            self._outcomes.append(True)
+            failures = sum(self._outcomes)
+            if self._state == 'half_open' or (self._state == 'closed' and len(self._outcomes) >= self.min_calls
+                                              and failures >= self.failure_ratio * len(self._outcomes)):
+                if self._state == 'closed': self._stats['opened'] += 1
+                self._state = 'open'
+                self._opened_at = time.monotonic()
+                logger.warning("Model circuit open for %ss (%d of the last %d calls failed).", self.cooldown_seconds, failures, len(self._outcomes))
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'state': self._state, 'recentFailures': sum(self._outcomes), 'recentCalls': len(self._outcomes), **self._stats}
+
+class ResilientModelClient:
+    """Runs model calls with a per-attempt timeout, an overall deadline, jittered retries, optional hedging and a breaker.
+
+    `call(fn)` / `call_async(fn)` (optionally with a per-model breaker) take a zero-argument function that starts one independent attempt
+    (e.g. a fresh chat session per attempt), so a retry or hedge never shares state with an earlier one.
+    `end` (time.monotonic()) replaces the deadline when several calls share one budget."""
+
+    def __init__(self, breaker: CircuitBreaker, timeout: float, deadline: float, max_attempts: int,
+                 base_delay: float, max_delay: float, hedge_after: float = 0):
+        self.breaker = breaker
+        self.timeout = timeout
+        self.deadline = deadline
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.hedge_after = hedge_after
+        self._executor = None
+        self._executor_lock = threading.Lock()
+
+    def _backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+    def _next_attempt(self, breaker: CircuitBreaker, attempt: int, error: Exception, end: float) -> float:
+        """Records a failed attempt and returns the delay before the next one; re-raises when giving up."""
+        if not is_retryable_model_error(error):
+            breaker.record_success() # プロバイダは応答している (入力エラー等) ので遮断の判定には数えない
+            raise error
+        breaker.record_failure()
+        delay = self._backoff(attempt)
+        if attempt >= self.max_attempts or time.monotonic() + delay >= end:
+            if isinstance(error, ModelCallError): raise error
+            # 再試行しても回復しなかった一時的エラーは 500 ではなく「混雑中」として返す
+            raise ModelUnavailableError(f"Model call failed after {attempt} attempts: {error}") from error
+        trace_count('modelRetries')
+        logger.info("Model call attempt %d failed (%s: %s); retrying in %.2fs.", attempt, type(error).__name__, error, delay)
+        return delay
+
+    def call(self, fn, breaker: CircuitBreaker | None = None, end: float | None = None):
+        breaker = breaker or self.breaker
+        end = end if end is not None else time.monotonic() + self.deadline
+        attempt = 0
+        while True:
+            attempt += 1
+            breaker.before_call()
+            try:
+                result = self._attempt(fn, end)
+            except Exception as e:
+                time.sleep(self._next_attempt(breaker, attempt, e, end))
+                continue
+            breaker.record_success()
+            return result
+
+    async def call_async(self, fn, breaker: CircuitBreaker | None = None, end: float | None = None):
+        breaker = breaker or self.breaker
+        end = end if end is not None else time.monotonic() + self.deadline
+        attempt = 0
+        while True:
+            attempt += 1
+            breaker.before_call()
+            try:
+                result = await self._attempt_async(fn, end)
+            except Exception as e:
+                await asyncio.sleep(self._next_attempt(breaker, attempt, e, end))
+                continue
+            breaker.record_success()
+            return result
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=MODEL_CALL_MAX_WORKERS, thread_name_prefix='model-call')
+            return self._executor
+
+    def _attempt(self, fn, end: float):
+        """One attempt (plus a hedge if it is slow). A timed-out call keeps running in its worker but is no longer awaited."""
+        start = time.monotonic()
+        attempt_end = min(end, start + self.timeout)
+        hedge_at = start + self.hedge_after if self.hedge_after > 0 else None
+        executor = self._get_executor()
+        pending = {executor.submit(contextvars.copy_context().run, fn)}
+        last_error = None
+        while True:
+            wait_until = min(attempt_end, hedge_at) if hedge_at is not None else attempt_end
+            done, pending = wait_futures(pending, timeout=max(0.0, wait_until - time.monotonic()), return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None: return future.result()
+                last_error = future.exception()
+            if hedge_at is not None and pending and time.monotonic() >= hedge_at:
+                hedge_at = None
+                trace_count('modelHedges')
+                pending.add(executor.submit(contextvars.copy_context().run, fn))
+                continue
+            if not pending: raise last_error
+            if time.monotonic() >= attempt_end:
+                raise ModelDeadlineError(f"Model call timed out after {attempt_end - start:.1f}s.")
+
+    async def _attempt_async(self, fn, end: float):
+        start = time.monotonic()
+        attempt_end = min(end, start + self.timeout)
+        hedge_at = start + self.hedge_after if self.hedge_after > 0 else None
+        pending = {asyncio.ensure_future(fn())}
+        last_error = None
+        try:
+            while True:
+                wait_until = min(attempt_end, hedge_at) if hedge_at is not None else attempt_end
+                done, pending = await asyncio.wait(pending, timeout=max(0.0, wait_until - time.monotonic()), return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None: return task.result()
+                    last_error = task.exception()
+                if hedge_at is not None and pending and time.monotonic() >= hedge_at:
+                    hedge_at = None
+                    trace_count('modelHedges')
+                    pending.add(asyncio.ensure_future(fn()))
+                    continue
+                if not pending: raise last_error
+                if time.monotonic() >= attempt_end:
+                    raise ModelDeadlineError(f"Model call timed out after {attempt_end - start:.1f}s.")
+        finally:
+            for task in pending: task.cancel() # 負けた側 / 時間切れの呼び出しは取り消す
+
+    def request_options(self) -> dict:
+        """Transport timeout for the SDK so abandoned attempts do not hold a worker forever."""
+        return {'timeout': self.timeout}
+
+class ModelRouter:
+    """Chooses the chat model per character and moves traffic to a lighter fallback model while the primary is slow or failing.
+
+    Errors are tracked by one CircuitBreaker per model; latency by a moving average of successful calls."""
+
+    def __init__(self, default_model: str, fallback_model: str, allowed_models: set, latency_threshold: float, min_samples: int, cooldown_seconds: float):
+        self.default_model = default_model
+        self.fallback_model = fallback_model
+        self.allowed_models = allowed_models
+        self.latency_threshold = latency_threshold
+        self.min_samples = min_samples
+        self.cooldown_seconds = cooldown_seconds
+        self._lock = threading.Lock()
+        self._breakers = {} # model_name -> CircuitBreaker
+        self._latency = {} # model_name -> (移動平均秒, サンプル数)
+        self._slow_until = {} # model_name -> 代替モデルを使う期限 (monotonic)
+        self._stats = {'fallbacks': 0, 'slowTrips': 0}
+
+    def breaker(self, model_name: str) -> CircuitBreaker:
+        with self._lock:
+            breaker = self._breakers.get(model_name)
+            if breaker is None:
+                breaker = self._breakers[model_name] = CircuitBreaker(MODEL_BREAKER_WINDOW, MODEL_BREAKER_MIN_CALLS, MODEL_BREAKER_FAILURE_RATIO, MODEL_BREAKER_COOLDOWN_SECONDS)
+            return breaker
+
+    def chat_model(self, char_data: dict) -> str:
+        """The character's 'model' field if it is an allowed model, else the default."""
+        model_name = char_data.get('model') or self.default_model
+        if model_name not in self.allowed_models:
+            logger.warning("Character model '%s' is not allowed; using %s.", model_name, self.default_model)
+            return self.default_model
+        return model_name
+
+    def route(self, model_name: str) -> tuple:
+        """(model to call, model to fall back to on failure or None)."""
+        fallback = self.fallback_model if self.fallback_model and self.fallback_model != model_name else None
+        if fallback and self._degraded(model_name):
+            self._count_fallback()
+            return fallback, None
+        return model_name, fallback
+
+    def _degraded(self, model_name: str) -> bool:
+        if self.breaker(model_name).is_open(): return True
+        with self._lock:
+            return time.monotonic() < self._slow_until.get(model_name, 0)
+
+    def _count_fallback(self):
+        trace_count('modelFallbacks')
+        with self._lock: self._stats['fallbacks'] += 1
+
+    def record_latency(self, model_name: str, seconds: float):
+        with self._lock:
+            average, samples = self._latency.get(model_name, (seconds, 0))
+            average = 0.8 * average + 0.2 * seconds if samples else seconds
+            samples += 1
+            if samples >= self.min_samples and average >= self.latency_threshold:
+                self._slow_until[model_name] = time.monotonic() + self.cooldown_seconds
+                self._latency.pop(model_name, None) # 期限後は測り直す
+                self._stats['slowTrips'] += 1
+                logger.warning("Chat model %s is slow (avg %.1fs); using %s for %ss.", model_name, average, self.fallback_model, self.cooldown_seconds)
+            else:
+                self._latency[model_name] = (average, samples)
+
+    def _fall_back(self, model_name: str, fallback: str, error: Exception):
+        logger.warning("Chat model %s unavailable (%s); falling back to %s.", model_name, error, fallback)
+        self._count_fallback()
+        trace_model(fallback)
+
+    def call(self, route: tuple, attempt):
+        """attempt(model_name) starts one call; retried per chat_model_client, rerouted once if the model is unavailable.
+
+        The fallback gets only the time left of chat_model_client's deadline, so rerouting never extends the request."""
+        model_name, fallback = route
+        trace_model(model_name)
+        start = time.monotonic()
+        end = start + chat_model_client.deadline
+        try:
+            response = chat_model_client.call(lambda: attempt(model_name), self.breaker(model_name), end)
+        except ModelUnavailableError as e: # タイムアウト (ModelDeadlineError) は待ち時間が伸びるだけなので切り替えない
+            if fallback is None or time.monotonic() >= end: raise
+            self._fall_back(model_name, fallback, e)
+            return chat_model_client.call(lambda: attempt(fallback), self.breaker(fallback), end)
+        self.record_latency(model_name, time.monotonic() - start)
+        return response
+
+    async def call_async(self, route: tuple, attempt):
+        model_name, fallback = route
+        trace_model(model_name)
+        start = time.monotonic()
+        end = start + chat_model_client.deadline
+        try:
+            response = await chat_model_client.call_async(lambda: attempt(model_name), self.breaker(model_name), end)
+        except ModelUnavailableError as e:
+            if fallback is None or time.monotonic() >= end: raise
+            self._fall_back(model_name, fallback, e)
+            return await chat_model_client.call_async(lambda: attempt(fallback), self.breaker(fallback), end)
+        self.record_latency(model_name, time.monotonic() - start)
+        return response
+
+    def stats(self) -> dict:
+        with self._lock:
+            latency = {name: round(average, 3) for name, (average, _) in self._latency.items()}
+            breakers = {name: breaker.stats()['state'] for name, breaker in self._breakers.items()}
+            return {**self._stats, 'avgLatencySeconds': latency, 'breakers': breakers}
+
+model_router = ModelRouter(MODEL_NAME, FALLBACK_MODEL_NAME, ALLOWED_MODEL_NAMES, MODEL_FALLBACK_LATENCY_SECONDS, MODEL_FALLBACK_MIN_SAMPLES, MODEL_FALLBACK_COOLDOWN_SECONDS)
+chat_model_client = ResilientModelClient(model_router.breaker(MODEL_NAME), MODEL_CALL_TIMEOUT_SECONDS, MODEL_CALL_DEADLINE_SECONDS, MODEL_RETRY_MAX_ATTEMPTS,
+                                         MODEL_RETRY_BASE_DELAY_SECONDS, MODEL_RETRY_MAX_DELAY_SECONDS, MODEL_HEDGE_AFTER_SECONDS)
+summary_model_client = ResilientModelClient(model_router.breaker(SUMMARY_MODEL_NAME), SUMMARY_MODEL_TIMEOUT_SECONDS, SUMMARY_MODEL_TIMEOUT_SECONDS * 2, MODEL_RETRY_MAX_ATTEMPTS,
+                                            MODEL_RETRY_BASE_DELAY_SECONDS, MODEL_RETRY_MAX_DELAY_SECONDS)
+# 埋め込み API (過去の会話の検索用)。チャットとは別のブレーカーで、障害時は検索なしで応答する
+embedding_breaker = CircuitBreaker(MODEL_BREAKER_WINDOW, MODEL_BREAKER_MIN_CALLS, MODEL_BREAKER_FAILURE_RATIO, MODEL_BREAKER_COOLDOWN_SECONDS)
+embedding_query_client = ResilientModelClient(embedding_breaker, EMBEDDING_QUERY_TIMEOUT_SECONDS, EMBEDDING_QUERY_DEADLINE_SECONDS, 2,
+                                              MODEL_RETRY_BASE_DELAY_SECONDS, MODEL_RETRY_MAX_DELAY_SECONDS)
+embedding_batch_client = ResilientModelClient(embedding_breaker, EMBEDDING_BATCH_TIMEOUT_SECONDS, EMBEDDING_BATCH_TIMEOUT_SECONDS * 2, MODEL_RETRY_MAX_ATTEMPTS,
+                                              MODEL_RETRY_BASE_DELAY_SECONDS, MODEL_RETRY_MAX_DELAY_SECONDS)
+
+def chat_sender(character_id: str, route: tuple, system_prompt: str, memory_prompt: str | None, history_for_gemini: list, user_msg: str):
+    """Returns send(**kwargs) -> response: one routed, retried send_message(user_msg) on a fresh chat session per attempt."""
+    def attempt(model_name: str, **kwargs):
+        chat = model_cache.get_model(character_id, model_name, system_prompt, memory_prompt).start_chat(history=history_for_gemini)
+        return chat.send_message(user_msg, request_options=chat_model_client.request_options(), **kwargs)
+    return lambda **kwargs: model_router.call(route, lambda model_name: attempt(model_name, **kwargs))
+
+def chat_sender_async(character_id: str, route: tuple, system_prompt: str, memory_prompt: str | None, history_for_gemini: list, user_msg: str):
+    """Async counterpart of chat_sender (send(**kwargs) returns an awaitable)."""
+    def attempt(model_name: str, **kwargs):
+        chat = model_cache.get_model(character_id, model_name, system_prompt, memory_prompt).start_chat(history=history_for_gemini)
+        return chat.send_message_async(user_msg, request_options=chat_model_client.request_options(), **kwargs)
+    return lambda **kwargs: model_router.call_async(route, lambda model_name: attempt(model_name, **kwargs))
+
+def model_error_result(e: ModelCallError, cors_headers: dict) -> tuple:
+    """(status, payload, headers) for a failed-fast / timed-out model call."""
+    headers = dict(cors_headers)
+    if e.retry_after is not None:
+        headers['Retry-After'] = str(max(1, math.ceil(e.retry_after)))
+        headers['Access-Control-Expose-Headers'] = 'Retry-After'
+    return e.http_status, {'error': e.user_message, 'code': e.code}, headers
+
+# --- ★★★ GenerativeModel キャッシュ (システム指示ごと) ★★★ ---
+def build_system_instruction(system_prompt: str, memory_prompt: str | None) -> str:
+    """Combines the character's system prompt with its memory."""
+    return system_prompt + (f"\n\n[会話相手に関する記憶]\n{memory_prompt}" if memory_prompt else "")
+
+class ModelCache:
+    """Bounded LRU of GenerativeModel objects keyed by hash(model name, system prompt, memoryPrompt)."""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict() # key -> (model, expires_at or None, cached_content or None)
+        self._keys_by_character = {}  # character_id -> {key, ...} (メモリー更新時の無効化用。主モデルと代替モデルの両方)
+        self._characters_by_key = {}  # key -> {character_id, ...} (追い出し時に上の対応表から外す。同じプロンプトなら共有される)
+        self._stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0, 'contextCacheCreated': 0, 'contextCacheFailed': 0}
+        self._build_seconds = 0.0
+
+    @staticmethod
+    def make_key(model_name: str, system_prompt: str, memory_prompt: str | None) -> str:
+        return hashlib.sha256("\0".join([model_name, system_prompt, memory_prompt or ""]).encode("utf-8")).hexdigest()
+
+    def get_model(self, character_id: str, model_name: str, system_prompt: str, memory_prompt: str | None):
+        key = self.make_key(model_name, system_prompt, memory_prompt)
+        with self._lock:
+            cached = self._entries.get(key)
+            if cached is not None and (cached[1] is None or time.monotonic() < cached[1]):
+                self._entries.move_to_end(key)
+                self._link(character_id, key)
+                self._stats['hits'] += 1
+                return cached[0]
+            self._stats['misses'] += 1
+
+        build_start = time.perf_counter()
+        model, expires_at, cached_content = self._build(model_name, build_system_instruction(system_prompt, memory_prompt))
+        build_seconds = time.perf_counter() - build_start
+
+        evicted = []
+        with self._lock:
+            self._build_seconds += build_seconds
+            current = self._entries.get(key)
+            if current is not None and (current[1] is None or time.monotonic() < current[1]):
+                # ★ 同時ミスで先に入った有効なエントリーを使い、今作ったものはコンテキストキャッシュごと捨てる
+                self._entries.move_to_end(key)
+                self._link(character_id, key)
+                duplicate, model = cached_content, current[0]
+            else:
+                # 失効したエントリーを置き換える場合は、古いコンテキストキャッシュを削除する
+                if current is not None: evicted.append(current)
+                duplicate = None
+                self._entries[key] = (model, expires_at, cached_content)
+                self._entries.move_to_end(key)
+                self._link(character_id, key)
+                while len(self._entries) > self.max_entries:
+                    evicted.append(self._remove(next(iter(self._entries))))
+                    self._stats['evictions'] += 1
+        for entry in evicted: self._delete_context_cache(entry[2])
+        self._delete_context_cache(duplicate)
+        return model
+
+    def _link(self, character_id: str, key: str):
+        self._keys_by_character.setdefault(character_id, set()).add(key)
+        self._characters_by_key.setdefault(key, set()).add(character_id)
+
+    def _remove(self, key: str):
+        """Drops an entry and its key from every character that used it (caller holds the lock)."""
+        for character_id in self._characters_by_key.pop(key, ()):
+            keys = self._keys_by_character.get(character_id)
+            if keys is None: continue
+            keys.discard(key)
+            if not keys: del self._keys_by_character[character_id]
+        return self._entries.pop(key, None)
+
+    def _build(self, model_name: str, system_instruction: str) -> tuple:
+        if CONTEXT_CACHE_ENABLED and len(system_instruction) >= CONTEXT_CACHE_MIN_CHARS:
+            try:
+                # 静的なシステム指示をプロバイダ側にキャッシュし、毎回の入力トークン課金と処理を減らす
+                cached_content = genai.caching.CachedContent.create(model=model_name, system_instruction=system_instruction, ttl=timedelta(seconds=CONTEXT_CACHE_TTL_SECONDS))
+                with self._lock: self._stats['contextCacheCreated'] += 1
+                expires_at = time.monotonic() + CONTEXT_CACHE_TTL_SECONDS * 0.9 # 失効前に作り直す
+                return genai.GenerativeModel.from_cached_content(cached_content), expires_at, cached_content
+            except Exception as e:
+                logger.warning("Context cache unavailable, using plain model: %s", e)
+                with self._lock: self._stats['contextCacheFailed'] += 1
+        return genai.GenerativeModel(model_name, system_instruction=system_instruction), None, None
+
+    @staticmethod
+    def _delete_context_cache(cached_content):
+        if cached_content is None: return
+        try: cached_content.delete()
+        except Exception as e: logger.warning("Failed to delete context cache: %s", e)
+
+    def invalidate(self, character_id: str):
+        with self._lock:
+            entries = [self._remove(key) for key in list(self._keys_by_character.get(character_id, ()))]
+            entries = [entry for entry in entries if entry is not None]
+            self._stats['invalidations'] += len(entries)
+        for entry in entries: self._delete_context_cache(entry[2])
+
+    def stats(self) -> dict:
+        """Hit/miss counters plus model setup time spent on misses and estimated time saved by hits."""
+        with self._lock:
+            avg_build_ms = (self._build_seconds / self._stats['misses'] * 1000) if self._stats['misses'] else 0.0
+            return {
+                'size': len(self._entries),
+                **self._stats,
+                'avgBuildMs': round(avg_build_ms, 3),
+                'estimatedSavedMs': round(avg_build_ms * self._stats['hits'], 1),
+            }
+
+model_cache = ModelCache(MODEL_CACHE_MAX_ENTRIES)
+
+# --- ★★★ 非同期要約ジョブキュー (プロセス内) ★★★ ---
+class SummaryJobQueue:
+    """In-process per-character job queue (summaries, recall index updates); one daemon worker, jobs coalesced per character."""
+
+    def __init__(self, handler, name: str = 'summary-worker'):
+        self._handler = handler
+        self._name = name
+        self._cond = threading.Condition()
+        self._order = deque()   # 実行待ちのキャラクターID (FIFO)
+        self._pending = {}      # character_id -> 最初にキューに入った時刻
+        self._running = None
+        self._worker = None
+        self._latencies = deque(maxlen=SUMMARY_LATENCY_SAMPLES) # キュー投入〜完了 (秒)
+        self._counts = {'enqueued': 0, 'coalesced': 0, 'completed': 0, 'failed': 0}
+
+    def enqueue(self, character_id: str) -> bool:
+        """Queues a summary job. Returns False if one is already waiting for this character."""
+        with self._cond:
+            if character_id in self._pending:
+                # 未実行のジョブがあれば統合 (そのジョブが最新の履歴を要約する)
+                self._counts['coalesced'] += 1
+                logger.debug("%s: job for %s coalesced (queue depth %d).", self._name, character_id, len(self._order))
+                return False
+            self._pending[character_id] = time.monotonic()
+            self._order.append(character_id)
+            self._counts['enqueued'] += 1
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run, name=self._name, daemon=True)
+                self._worker.start()
+            self._cond.notify()
+            logger.debug("%s: job for %s enqueued (queue depth %d).", self._name, character_id, len(self._order))
+            return True
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._order:
+                    self._cond.wait()
+                character_id = self._order.popleft()
+                enqueued_at = self._pending.pop(character_id)
+                self._running = character_id
+            ok = True
+            try:
+                self._handler(character_id)
+            except Exception:
+                ok = False # ハンドラー側でログ済み
+            with self._cond:
+                self._running = None
+                self._latencies.append(time.monotonic() - enqueued_at)
+                self._counts['completed' if ok else 'failed'] += 1
+                self._cond.notify_all()
+            if logger.isEnabledFor(logging.DEBUG): logger.debug("Summary queue metrics: %s", self.metrics())
+
+    def drain(self, timeout: float | None = None) -> bool:
+        """Blocks until the queue is empty and idle (for benchmarks). Returns False on timeout."""
+        with self._cond:
+            return self._cond.wait_for(lambda: not self._order and self._running is None, timeout=timeout)
+
+    def metrics(self) -> dict:
+        """Queue depth, job counters and job latency percentiles in milliseconds."""
+        with self._cond:
+            latencies = sorted(self._latencies)
+            def percentile(p):
+                if not latencies: return None
+                return round(latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000, 1)
+            return {
+                'queueDepth': len(self._order),
+                'running': self._running is not None,
+                **self._counts,
+                'latencyP50Ms': percentile(0.50),
+                'latencyP99Ms': percentile(0.99),
+            }
+
+summary_job_queue = SummaryJobQueue(run_summary_job)
+recall_job_queue = SummaryJobQueue(recall_index.catch_up, name='recall-worker') # 要約と分けて、索引の構築が要約を待たないようにする
+
+# --- ★★★ 非同期 (ASGI) モード ★★★ ---
+# `uvicorn main:asgi_app` などの ASGI サーバーで起動する (functions_framework の handle_chat と同じ API)。
+# モデル応答を待つ間も同じインスタンスで他のリクエストを処理でき、キャラクター読み込みと履歴クエリは並行して発行する。
+# キャッシュ・要約キュー・トレースは同期モードと共有。
+
+async def ensure_initialized_async(*names: str) -> bool:
+    if all(_init_state[name]['ready'] for name in names):
+        return ensure_initialized(*names) # 準備済みなら待たない (キーのリフレッシュ判定のみ)
+    return await asyncio.to_thread(ensure_initialized, *names)
+
+async def load_recent_history_entries_async(character_id: str, limit: int, turn_count: int | None = None) -> list:
+    """Async counterpart of load_recent_history_entries (same cache, AsyncClient query)."""
+    cached, fetch_limit = _cached_history_entries(character_id, limit, turn_count)
+    if cached is not None: return cached
+    return _collect_history_entries(character_id, await conversation_store.load_recent_async(character_id, fetch_limit), fetch_limit, limit, turn_count)
+
+async def load_history_for_frontend_async(character_id: str, limit: int = MAX_FRONTEND_HISTORY, before: str | None = None, turn_count: int | None = None, use_cache: bool = True) -> tuple:
+    """Async counterpart of load_history_for_frontend (use_cache=False always reads the store)."""
+    before_ts = parse_history_cursor(before)
+    if before_ts is None and use_cache:
+        cached, _ = _cached_history_entries(character_id, limit + 1, turn_count, turn_gate.busy(character_id))
+        if cached is not None: return paginate_history(cached, limit)
+    raw_entries = await conversation_store.load_before_async(character_id, before_ts, limit + 1)
+    return paginate_history(_valid_history_entries(character_id, raw_entries), limit)
+
+async def _first_history_page_or_none(character_id: str, turn_count: int | None = None, use_cache: bool = True) -> tuple:
+    """First history page, or (None, None) if it could not be loaded."""
+    with trace_span('history_load'):
+        try: return await load_history_for_frontend_async(character_id, MAX_FRONTEND_HISTORY, turn_count=turn_count, use_cache=use_cache)
+        except Exception as e: logger.exception("Error loading history for frontend: %s", e); return None, None
+
+async def _load_history_entries_or_empty(character_id: str, limit: int, turn_count: int | None = None) -> list:
+    with trace_span('history_load'):
+        try: return await load_recent_history_entries_async(character_id, limit, turn_count)
+        except Exception as e: logger.exception("Error loading history for %s: %s", character_id, e); return []
+
+@firestore.async_transactional
+async def _reserve_turn_in_async_transaction(transaction, char_doc_ref) -> tuple:
+    char_doc = await char_doc_ref.get(transaction=transaction)
+    return _apply_turn_reservation(transaction, char_doc_ref, char_doc)
+
+async def reserve_conversation_turn_async(char_doc_ref) -> tuple:
+    result = await _reserve_turn_in_async_transaction(async_db.transaction(), char_doc_ref)
+    trace_count('firestoreReads'); trace_count('firestoreWrites')
+    profile_cache.invalidate(char_doc_ref.id) # turnCount が変わったので ETag も変わる
+    return result
+
+async def release_conversation_turn_async(char_doc_ref):
+    try:
+        await char_doc_ref.update({'turnCount': firestore.Increment(-2)})
+        trace_count('firestoreWrites')
+        profile_cache.invalidate(char_doc_ref.id)
+        logger.info("Released reserved turn for %s.", char_doc_ref.id)
+    except Exception as e: logger.exception("Error releasing turn: %s", e)
+
+async def finalize_conversation_turn_async(char_doc_ref, user_msg: str, ai_msg: str, reserved_turn_count: int) -> int:
+    """Async counterpart of finalize_conversation_turn."""
+    try:
+        with trace_span('save_turn'):
+            committed_at = await conversation_store.save_turn_async(char_doc_ref.id, user_msg, ai_msg, reserved_turn_count)
+        _record_saved_turn(char_doc_ref.id, committed_at, user_msg, ai_msg, reserved_turn_count)
+    except Exception as e:
+        logger.exception("Error saving turn: %s", e)
+        await release_conversation_turn_async(char_doc_ref)
+        return reserved_turn_count - 2
+    try:
+        if summary_due(reserved_turn_count):
+            if ASYNC_SUMMARIZATION:
+                with trace_span('summary_enqueue'):
+                    summary_job_queue.enqueue(char_doc_ref.id)
+            else:
+                with trace_span('summary'):
+                    await asyncio.to_thread(run_summary_job, char_doc_ref.id)
+    except Exception as e: logger.exception("Error summarizing: %s", e)
+    return reserved_turn_count
+
+async def stream_chat_events_async(send, user_msg: str, char_doc_ref, reserved_turn_count: int):
+    """Async counterpart of stream_chat_events (send_message_async(stream=True))."""
+    reply_parts = []
+    stream_start = time.perf_counter()
+    first_chunk_ms = None
+    try:
+        with trace_span('model_stream'):
+            response = await send(stream=True)
+        async for chunk in response:
+            if first_chunk_ms is None: first_chunk_ms = (time.perf_counter() - stream_start) * 1000
+            try:
+                chunk_text = chunk.text
+            except ValueError: # ブロックされたチャンクは text を持たない
+                chunk_text = None
+            if chunk_text:
+                reply_parts.append(chunk_text)
+                yield format_sse_event('delta', {'text': chunk_text})
+
+        ai_response_text = "".join(reply_parts)
+        if not ai_response_text:
+            if getattr(response, 'prompt_feedback', None):
+                ai_response_text = f"応答ブロック ({response.prompt_feedback.block_reason})。"
+            else:
+                logger.warning("Unexpected Gemini stream structure: %s", response)
+                ai_response_text = "AIからの予期せぬ応答がありました。"
+            yield format_sse_event('delta', {'text': ai_response_text})
+        record_model_usage(response)
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.spans['model_stream'] = round((time.perf_counter() - stream_start) * 1000, 2)
+            if first_chunk_ms is not None: trace.spans['model_first_chunk'] = round(first_chunk_ms, 2)
+    except GeneratorExit: # クライアントが途中で切断した場合は保存せず予約を返却
+        logger.info("Client disconnected during stream for %s.", char_doc_ref.id)
+        await release_conversation_turn_async(char_doc_ref)
+        raise
+    except Exception as api_e:
+        logger.exception("Error during Gemini Chat Stream: %s", api_e)
+        await release_conversation_turn_async(char_doc_ref)
+        yield format_sse_event('error', {'error': chat_error_message(api_e)})
+        return
+
+    new_total_message_count = await finalize_conversation_turn_async(char_doc_ref, user_msg, ai_response_text, reserved_turn_count)
+    yield format_sse_event('done', {
+        'currentTurnCount': new_total_message_count,
+        'maxTurns': MAX_TOTAL_TURNS * 2
+    })
+
+def _json_result(status: int, payload: dict, headers: dict) -> tuple:
+    return status, {**headers, 'Content-Type': 'application/json; charset=utf-8'}, encode_json(payload)
+
+async def handle_chat_async(method: str, args: dict, headers: dict, body: bytes, path: str = '/') -> tuple:
+    """Same API as handle_chat. `headers` keys are lower-case.
+
+    Returns (status, headers, body) where body is str or bytes, or an async iterator of str for SSE."""
+    if method == 'OPTIONS':
+        return 204, {
+            'Access-Control-Allow-Origin': ALLOWED_ORIGINS,
+            'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
+            'Access-Control-Allow-Headers': 'Content-Type, If-None-Match',
+            'Access-Control-Max-Age': '3600'
+        }, ''
+
+    cors_headers = {'Access-Control-Allow-Origin': ALLOWED_ORIGINS}
+    required_components = ('firestore', 'gemini') if method == 'POST' else ('firestore',)
+    with trace_span('init_wait'):
+        initialized = await ensure_initialized_async(*required_components)
+    if not initialized:
+        logger.error("Responding 503 due to Init Error: Firestore=%s, Gemini=%s", firestore_init_error, gemini_initialization_error)
+        return _json_result(503, {'error': 'Service temporarily unavailable.'}, cors_headers)
+
+    if method == 'GET' and path.rstrip('/').endswith('/history'):
+        # 古いページの読み込みはスレッドで実行 (カーソル指定のクエリは同期クライアントを使う)
+        status, payload, response_headers = await asyncio.to_thread(history_page_result, args, cors_headers)
+        return _json_result(status, payload, response_headers)
+
+    if method == 'GET':
+        try:
+            character_id = args.get('id')
+            if not character_id: raise ValueError("Missing 'id' query parameter.")
+            trace_character(character_id)
+            if_none_match = headers.get('if-none-match')
+            profile_headers = {**cors_headers, 'Cache-Control': PROFILE_CACHE_CONTROL, 'Access-Control-Expose-Headers': 'ETag'}
+
+            with trace_span('profile_cache'):
+                cached_profile = profile_cache.get(character_id)
+            if cached_profile and etag_matches(if_none_match, cached_profile[0]):
+                return 304, {**profile_headers, 'ETag': cached_profile[0]}, ''
+
+            char_doc_ref = async_db.collection(CHARACTERS_COLLECTION).document(character_id)
+            history_task = None
+            if not if_none_match and character_id not in history_cache:
+                # 再検証でなければ 304 になり得ないので、履歴クエリをキャラクター読み込みと並行して発行
+                # (キャッシュは turnCount と照合してから使うので、並行するのはキャッシュにない場合のストア読み込みだけ)
+                history_task = asyncio.ensure_future(_first_history_page_or_none(character_id, use_cache=False))
+            try:
+                with trace_span('character_read'):
+                    char_doc = await char_doc_ref.get()
+                trace_count('firestoreReads')
+                if not char_doc.exists:
+                    raise ValueError(f"Character '{character_id}' not found.")
+                char_data = char_doc.to_dict()
+                etag = make_profile_etag(char_data)
+                profile_headers['ETag'] = etag
+                if etag_matches(if_none_match, etag):
+                    return 304, profile_headers, ''
+                if cached_profile and cached_profile[0] == etag:
+                    return 200, {**profile_headers, 'Content-Type': 'application/json; charset=utf-8'}, cached_profile[1]
+                history_data, history_cursor = await (history_task or _first_history_page_or_none(character_id, char_data.get('turnCount', 0)))
+            finally:
+                if history_task is not None and not history_task.done(): history_task.cancel()
+
+            profile_body = build_profile_body(character_id, char_data, history_data or [], history_cursor)
+            if history_data is not None: profile_cache.put(character_id, etag, profile_body)
+            else: profile_headers = uncacheable_profile_headers(profile_headers)
+            return 200, {**profile_headers, 'Content-Type': 'application/json; charset=utf-8'}, profile_body
+        except ValueError as e:
+            logger.info("GET Client Error/Not Found: %s", e)
+            return _json_result(404, {'error': str(e)}, cors_headers)
+        except Exception as e:
+            logger.exception("GET Error: %s", e)
+            return _json_result(500, {'error': 'Internal error processing profile and history.'}, cors_headers)
+
+    elif method == 'POST':
+        try:
+            try: request_json = json.loads(body) if body else None
+            except ValueError: request_json = None
+            if not isinstance(request_json, dict): raise ValueError("Invalid JSON.")
+            user_message = request_json.get('message')
+            character_id = request_json.get('id')
+            if not user_message: raise ValueError("Missing 'message'.")
+            if not character_id: raise ValueError("Missing 'id' (character_id).")
+            wants_stream = bool(request_json.get('stream')) or 'text/event-stream' in headers.get('accept', '')
+            trace_character(character_id)
+        except ValueError as e:
+            logger.info("POST Client Error/Not Found: %s", e)
+            return _json_result(400, {'error': str(e)}, cors_headers)
+
+        try:
+            turn_slot = await admit_turn_async(character_id)
+        except RateLimitedError as e:
+            logger.info("Rate limited %s: %s (retry after %.1fs)", character_id, e, e.retry_after)
+            payload, limited_headers = rate_limited_result(e, cors_headers)
+            return _json_result(429, payload, limited_headers)
+
+        stream_body = None
+        try:
+            # ターン予約 (トランザクション) と履歴読み込みを並行して実行。予約に失敗したら履歴は捨てる
+            char_doc_ref = async_db.collection(CHARACTERS_COLLECTION).document(character_id)
+            async def reserve():
+                with trace_span('reserve_turn'):
+                    return await reserve_conversation_turn_async(char_doc_ref)
+            reservation, entries = await asyncio.gather(reserve(), _load_history_entries_or_empty(character_id, MAX_HISTORY_TURNS * 2), return_exceptions=True)
+            if isinstance(reservation, TurnLimitReachedError):
+                logger.info("Limit reached for %s. Limit: %d turns.", character_id, MAX_TOTAL_TURNS)
+                return _json_result(403, limit_reached_payload(reservation.current_turn_count), cors_headers)
+            if isinstance(reservation, BaseException): raise reservation
+            char_data, reserved_turn_count = reservation
+            if not history_cache.confirm(character_id, reserved_turn_count - 2):
+                # 予約前に読んだキャッシュが他インスタンスの保存を含んでいなかったので読み直す
+                entries = await _load_history_entries_or_empty(character_id, MAX_HISTORY_TURNS * 2, reserved_turn_count - 2)
+
+            try:
+                system_prompt = char_data.get('systemPrompt', "あなたは親切なアシスタントです。")
+                with trace_span('context_build'):
+                    memory_prompt, history_for_gemini, context_usage = build_chat_context(system_prompt, char_data.get('memoryPrompt'), format_history_for_gemini(entries), user_message, budget=chat_history_budget())
+                with trace_span('recall'):
+                    # 索引の読み込み・埋め込みは同期 I/O / CPU 処理なのでスレッドで実行
+                    model_input = await asyncio.to_thread(recall_into_message, character_id, user_message, context_usage, len(entries) >= MAX_HISTORY_TURNS * 2)
+                logger.debug("Context tokens (estimated): %s", context_usage)
+                with trace_span('model_setup'):
+                    route = model_router.route(model_router.chat_model(char_data))
+                    model_cache.get_model(character_id, route[0], system_prompt, memory_prompt)
+                    send = chat_sender_async(character_id, route, system_prompt, memory_prompt, history_for_gemini, model_input)
+
+                if wants_stream:
+                    stream_headers = {**cors_headers, 'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no', 'Content-Type': 'text/event-stream; charset=utf-8'}
+                    stream_body = _SlotReleasingStream(stream_chat_events_async(send, user_message, char_doc_ref, reserved_turn_count), turn_slot, char_doc_ref)
+                    return 200, stream_headers, stream_body
+
+                with trace_span('model_call'):
+                    response = await send()
+                record_model_usage(response)
+                ai_response_text = reply_text_from_response(response)
+            except Exception as api_e:
+                logger.exception("Error during Gemini Chat Session: %s", api_e)
+                await release_conversation_turn_async(char_doc_ref)
+                raise api_e
+
+            new_total_message_count = await finalize_conversation_turn_async(char_doc_ref, user_message, ai_response_text, reserved_turn_count)
+            return _json_result(200, {'reply': ai_response_text, 'currentTurnCount': new_total_message_count, 'maxTurns': MAX_TOTAL_TURNS * 2}, cors_headers)
+
+        except (ValueError, PermissionError) as e:
+            logger.info("POST Client Error/Not Found: %s", e)
+            return _json_result(404 if isinstance(e, PermissionError) else 400, {'error': str(e)}, cors_headers)
+        except ModelCallError as e:
+            logger.warning("POST model unavailable: %s", e)
+            return _json_result(*model_error_result(e, cors_headers))
+        except Exception as e:
+            logger.exception("POST Processing Error: %s", e)
+            return _json_result(500, {'error': chat_error_message(e)}, cors_headers)
+        finally:
+            if stream_body is None: turn_slot.release()
+
+    return 405, cors_headers, 'Method Not Allowed'
+
+async def asgi_app(scope, receive, send):
+    """ASGI entry point: `uvicorn main:asgi_app`."""
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                start_initialization('firestore'); start_initialization('gemini')
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+    if scope['type'] != 'http': return
+
+    body = b''
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if not message.get('more_body'): break
+    headers = {key.decode('latin-1').lower(): value.decode('latin-1') for key, value in scope.get('headers', [])}
+    args = {key: values[0] for key, values in parse_qs(scope.get('query_string', b'').decode('latin-1')).items()}
+    method = scope['method']
+
+    trace = RequestTrace(f"{method} chat", headers.get('x-cloud-trace-context', '').split('/')[0] or None)
+    token = _current_trace.set(trace)
+    status = 500
+    try:
+        try:
+            status, response_headers, response_body = await handle_chat_async(method, args, headers, body, scope.get('path', '/'))
+        except Exception as e:
+            logger.exception("Unhandled error: %s", e)
+            status, response_headers, response_body = _json_result(500, {'error': chat_error_message(e)}, {'Access-Control-Allow-Origin': ALLOWED_ORIGINS})
+        if isinstance(response_body, (str, bytes)):
+            body_bytes = response_body.encode('utf-8') if isinstance(response_body, str) else response_body
+            if status == 200:
+                body_bytes, encoding = compress_body(body_bytes, headers.get('accept-encoding', ''))
+                response_headers = {**response_headers, 'Vary': 'Accept-Encoding'}
+                if encoding: response_headers['Content-Encoding'] = encoding
+        raw_headers = [(key.lower().encode('latin-1'), str(value).encode('latin-1')) for key, value in response_headers.items()]
+        if isinstance(response_body, (str, bytes)):
+            await send({'type': 'http.response.start', 'status': status, 'headers': raw_headers})
+            await send({'type': 'http.response.body', 'body': body_bytes})
+        else:
+            try:
+                await send({'type': 'http.response.start', 'status': status, 'headers': raw_headers})
+                async for frame in response_body:
+                    await send({'type': 'http.response.body', 'body': frame.encode('utf-8'), 'more_body': True})
+            finally:
+                await response_body.aclose() # 送信失敗 (切断) 時はジェネレーター側で予約を返却し、ターン枠も解放
+            await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        _current_trace.reset(token)
+        trace.finish(status)
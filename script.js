@@ -2,7 +2,10 @@
 
 // --- Constants and Configuration ---
 const API_ENDPOINT = 'https://asia-northeast1-aillm-456406.cloudfunctions.net/my-chat-api'; // 必要に応じて更新
+const USE_STREAMING = true; // ★ true の場合、AI応答を SSE で逐次受信する
 const WELCOME_MESSAGE = 'チャットを開始します！'; // 履歴がない場合に表示
+const HISTORY_PAGE_SIZE = 30; // ★ 上にスクロールした時に追加で読み込む過去メッセージ数
+const HISTORY_LOAD_THRESHOLD_PX = 80; // ★ 上端からこの距離まで来たら過去の履歴を読み込む
 const ERROR_MESSAGES = {
     NETWORK: 'ネットワークエラーが発生しました。接続を確認してください。',
     API_RESPONSE: 'AIからの応答がありませんでした。',
@@ -10,7 +13,8 @@ const ERROR_MESSAGES = {
     INVALID_ID: 'キャラクターが見つからないか、アクセスが許可されていません。',
     ID_FETCH_ERROR: 'URLからキャラクターIDを取得できませんでした。',
     PROFILE_FETCH_ERROR: 'キャラクター情報の取得に失敗しました。',
-    LIMIT_REACHED: 'このキャラクターとの会話上限に達しました。'
+    LIMIT_REACHED: 'このキャラクターとの会話上限に達しました。',
+    RATE_LIMITED: 'メッセージの送信が集中しています。少し待ってからもう一度お試しください。'
 };
 
 // --- DOM Elements ---
@@ -36,6 +40,8 @@ let typingIndicatorId = null;
 let characterId = null;
 let characterIconUrl = null; // アイコンURLを保持するグローバル変数
 let hasLoadedHistory = false; // 履歴読み込み済みフラグ
+let historyCursor = null; // ★ これより古い履歴を取得するためのカーソル (null なら古い履歴なし)
+let isLoadingOlderHistory = false; // ★ 過去履歴の読み込み中フラグ (二重リクエスト防止)
 // ★★★ 会話回数関連の変数を追加 ★★★
 let currentTurnCount = 0;
 let maxTurns = 0; // ここではメッセージ総数(turnCount)の上限値
@@ -57,6 +63,8 @@ document.addEventListener('DOMContentLoaded', async () => {
         // Optional: Adjust textarea height dynamically
         // userInput.addEventListener('input', adjustTextareaHeight);
     } else { console.error("User input not found"); }
+    // ★ 上端付近までスクロールしたら過去の履歴を遅延読み込み
+    if(chatHistory) { chatHistory.addEventListener('scroll', handleHistoryScroll, { passive: true }); }
 });
 
 // --- Profile & History Loading ---
@@ -64,7 +72,8 @@ async function loadProfileAndHistoryData(id) {
     showLoadingState(true);
     if(profileError) profileError.style.display = 'none';
     try {
-        const response = await fetch(`${API_ENDPOINT}?id=${id}`, { method: 'GET' });
+        // ★ cache: 'no-cache' でブラウザキャッシュを毎回 ETag 再検証 (変更が無ければ 304 で本文の転送なし)
+        const response = await fetch(`${API_ENDPOINT}?id=${id}`, { method: 'GET', cache: 'no-cache' });
         if (!response.ok) {
             let errorMsg = ERROR_MESSAGES.PROFILE_FETCH_ERROR;
             try {
@@ -77,22 +86,15 @@ async function loadProfileAndHistoryData(id) {
 
         // ★★★ プロファイル表示関数内で回数も更新 ★★★
         displayProfileData(data); // ここで characterIconUrl, currentTurnCount, maxTurns が設定される
+        // ★ プロフィールには直近の一部だけが含まれる。残りは historyCursor を使って遡って取得
+        historyCursor = data.historyCursor || null;
 
         // 履歴データの表示処理
         if (data.history && Array.isArray(data.history) && data.history.length > 0) {
             console.log(`Loading ${data.history.length} messages from history...`);
             if (chatHistory) {
                 chatHistory.innerHTML = ''; // 既存の表示をクリア
-                data.history.forEach(message => {
-                    if (message.role && message.message) {
-                        // ★★★ Firestore の 'model' を フロントエンドの 'ai' に変換 ★★★
-                        const senderType = message.role === 'model' ? 'ai' : message.role;
-                        // ★★★ 変換後の senderType ('ai' or 'user') を appendMessage に渡す ★★★
-                        appendMessage(senderType, message.message, false); // スクロールは最後に行う
-                    } else {
-                        console.warn("Skipping history item due to missing role or message:", message);
-                    }
-                });
+                renderHistoryMessages(data.history, null); // スクロールは最後に行う
                 hasLoadedHistory = true; // 履歴読み込みフラグを立てる
                  // 履歴表示後、一番下にスクロール
                 scrollToBottom(chatHistory, 'auto');
@@ -166,6 +168,62 @@ function showLoadingState(isLoading) {
     }
 }
 
+// ★ 履歴メッセージを描画する。anchor を指定するとその要素の前に (古い履歴として) 挿入
+function renderHistoryMessages(messages, anchor) {
+    messages.forEach(message => {
+        if (message.role && message.message) {
+            // ★★★ Firestore の 'model' を フロントエンドの 'ai' に変換 ★★★
+            const senderType = message.role === 'model' ? 'ai' : message.role;
+            // ★★★ 変換後の senderType ('ai' or 'user') を appendMessage に渡す ★★★
+            appendMessage(senderType, message.message, false, anchor);
+        } else {
+            console.warn("Skipping history item due to missing role or message:", message);
+        }
+    });
+}
+
+// ★ historyCursor より古い履歴を 1 ページ取得し、表示位置を保ったまま先頭に追加
+async function loadOlderHistory() {
+    if (!chatHistory || !characterId || !historyCursor || isLoadingOlderHistory) return;
+    isLoadingOlderHistory = true;
+    try {
+        const url = `${API_ENDPOINT}/history?id=${encodeURIComponent(characterId)}`
+            + `&before=${encodeURIComponent(historyCursor)}&limit=${HISTORY_PAGE_SIZE}`;
+        const response = await fetch(url, { method: 'GET' });
+        if (!response.ok) throw new Error(`HTTP ${response.status}`);
+        const data = await response.json();
+        const messages = Array.isArray(data.history) ? data.history : [];
+
+        const previousScrollHeight = chatHistory.scrollHeight;
+        renderHistoryMessages(messages, chatHistory.firstChild);
+        // 追加した分だけスクロール位置をずらし、読んでいた位置が動かないようにする
+        chatHistory.scrollTop += chatHistory.scrollHeight - previousScrollHeight;
+
+        historyCursor = data.hasMore ? (data.nextCursor || null) : null;
+        console.log(`Loaded ${messages.length} older messages. More: ${historyCursor !== null}`);
+    } catch (error) {
+        // 取得に失敗してもチャットは継続できるので、ログのみ (次のスクロールで再試行)
+        console.error("Failed to load older history:", error);
+    } finally {
+        isLoadingOlderHistory = false;
+    }
+}
+
+function handleHistoryScroll() {
+    if (chatHistory && chatHistory.scrollTop < HISTORY_LOAD_THRESHOLD_PX) {
+        loadOlderHistory();
+    }
+}
+
+// ★ 表示中の履歴が画面を埋めずスクロールできない場合は、埋まるまで過去の履歴を読み込む
+async function fillHistoryViewport() {
+    while (chatHistory && historyCursor && chatHistory.scrollHeight <= chatHistory.clientHeight) {
+        const cursorBefore = historyCursor;
+        await loadOlderHistory();
+        if (historyCursor === cursorBefore) break; // 失敗時や進まない場合は打ち切り
+    }
+}
+
 // --- View Switching ---
 function startChat() {
     if(!profileView || !chatView || !userInput || !chatHistory) { console.error("Cannot switch views."); return; }
@@ -185,6 +243,7 @@ function startChat() {
     // 画面表示後に一番下にスクロール
     setTimeout(() => {
         scrollToBottom(chatHistory, 'auto');
+        fillHistoryViewport();
     }, 100);
 }
 
@@ -217,10 +276,17 @@ async function sendMessage() {
     try {
         const response = await fetch(API_ENDPOINT, {
             method: 'POST',
-            headers: { 'Content-Type': 'application/json', },
-            body: JSON.stringify({ message: userMessageText, id: characterId })
+            headers: { 'Content-Type': 'application/json', 'Accept': 'text/event-stream, application/json' },
+            body: JSON.stringify({ message: userMessageText, id: characterId, stream: USE_STREAMING })
         });
 
+        // ★★★ ストリーミング応答 (SSE) の場合はチャンクごとに表示 ★★★
+        const contentType = response.headers.get('Content-Type') || '';
+        if (response.ok && contentType.includes('text/event-stream')) {
+            await readStreamingReply(response);
+            return;
+        }
+
         let responseData = null; // スコープを広げる
         try {
             responseData = await response.json(); // エラー時もJSONを先にパース試行
@@ -245,6 +311,10 @@ async function sendMessage() {
                     currentTurnCount = responseData.currentTurnCount ?? currentTurnCount;
                     maxTurns = responseData.maxTurns ?? maxTurns;
                     updateTurnCounter(currentTurnCount, maxTurns);
+                } else if (response.status === 429) {
+                    // ★ 流量制限: サーバーが示す待ち時間 (秒) を添えて表示
+                    const retryAfter = responseData?.retryAfter ?? response.headers.get('Retry-After');
+                    errorMessage = retryAfter ? `${ERROR_MESSAGES.RATE_LIMITED} (約${retryAfter}秒後)` : ERROR_MESSAGES.RATE_LIMITED;
                 } else if (response.status === 404) {
                     errorMessage = responseData?.error || ERROR_MESSAGES.INVALID_ID;
                 } else if (responseData?.error) {
@@ -279,6 +349,67 @@ async function sendMessage() {
 }
 
 
+// --- ★★★ ストリーミング応答の読み込み ★★★ ---
+async function readStreamingReply(response) {
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder('utf-8');
+    let buffer = '';
+    let replyText = '';
+    let replyBubble = null;
+
+    while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+
+        // SSE のイベントは空行 (\n\n) 区切り
+        let separatorIndex;
+        while ((separatorIndex = buffer.indexOf('\n\n')) !== -1) {
+            const rawEvent = buffer.slice(0, separatorIndex);
+            buffer = buffer.slice(separatorIndex + 2);
+            const { event, data } = parseSseEvent(rawEvent);
+            if (!data) continue;
+
+            if (event === 'delta') {
+                if (!replyBubble) {
+                    // 最初のチャンク到着時にタイピングインジケーターを応答バブルに置き換える
+                    removeTypingIndicator();
+                    replyBubble = appendMessage('ai', '', true);
+                }
+                replyText += data.text || '';
+                renderBubbleText(replyBubble, 'ai', replyText);
+                scrollToBottom(chatHistory, 'auto');
+            } else if (event === 'done') {
+                currentTurnCount = data.currentTurnCount ?? currentTurnCount;
+                maxTurns = data.maxTurns ?? maxTurns;
+                updateTurnCounter(currentTurnCount, maxTurns);
+            } else if (event === 'error') {
+                throw new Error(data.error || ERROR_MESSAGES.GENERAL);
+            }
+        }
+    }
+
+    if (!replyBubble) {
+        throw new Error(ERROR_MESSAGES.API_RESPONSE);
+    }
+}
+
+function parseSseEvent(rawEvent) {
+    let event = 'message';
+    const dataLines = [];
+    rawEvent.split('\n').forEach(line => {
+        if (line.startsWith('event:')) { event = line.slice(6).trim(); }
+        else if (line.startsWith('data:')) { dataLines.push(line.slice(5).trim()); }
+    });
+    if (dataLines.length === 0) return { event, data: null };
+    try {
+        return { event, data: JSON.parse(dataLines.join('\n')) };
+    } catch (e) {
+        console.warn("Failed to parse SSE data:", rawEvent, e);
+        return { event, data: null };
+    }
+}
+
 // --- State Management (Chat) ---
 function setAiResponding(isResponding) {
     isAiResponding = isResponding;
@@ -287,8 +418,8 @@ function setAiResponding(isResponding) {
 }
 
 // --- UI Update Functions (Chat) ---
-// appendMessage 関数 (変更なし)
-function appendMessage(senderType, text, shouldScroll = true) {
+// appendMessage 関数 (★ anchor を指定するとその要素の前に挿入。過去履歴の先頭追加用)
+function appendMessage(senderType, text, shouldScroll = true, anchor = null) {
     if(!chatHistory) return;
     const messageId = `${senderType}-${Date.now()}`;
     const fragment = document.createDocumentFragment();
@@ -327,11 +458,13 @@ function appendMessage(senderType, text, shouldScroll = true) {
     else { messageRow.appendChild(icon); messageRow.appendChild(content); }
 
     fragment.appendChild(messageRow);
-    chatHistory.appendChild(fragment);
+    chatHistory.insertBefore(fragment, anchor); // anchor が null なら末尾に追加
 
     if (shouldScroll) {
         scrollToBottom(chatHistory, 'auto');
     }
+    // ストリーミング表示で後から本文を更新できるようにバブル要素を返す
+    return content.querySelector('.message__bubble');
 }
 
 
@@ -358,7 +491,19 @@ function createMessageContentElement(senderType, text) {
     content.className = 'message__content';
     const bubble = document.createElement('div');
     bubble.className = 'message__bubble';
+    renderBubbleText(bubble, senderType, text);
+
+    const timestamp = document.createElement('div');
+    timestamp.className = 'message__timestamp';
+    timestamp.textContent = getCurrentTime();
+
+    content.appendChild(bubble);
+    if (senderType !== 'error') { content.appendChild(timestamp); }
+    return content;
+}
 
+
+function renderBubbleText(bubble, senderType, text) {
     const linkRegex = /\[([^\]]+)]\((https?:\/\/[^\s)]+)\)/g;
     const processedText = text.replaceAll('\n', '<br>');
 
@@ -367,14 +512,6 @@ function createMessageContentElement(senderType, text) {
     } else {
          bubble.innerHTML = processedText;
     }
-
-    const timestamp = document.createElement('div');
-    timestamp.className = 'message__timestamp';
-    timestamp.textContent = getCurrentTime();
-
-    content.appendChild(bubble);
-    if (senderType !== 'error') { content.appendChild(timestamp); }
-    return content;
 }
 
 